@@ -4,76 +4,123 @@
 ### This file is part of the BBS software (Bioconductor Build System).
 ###
 ### Author: Hervé Pagès <hpages.on.github@gmail.com>
-### Last modification: Oct 6, 2020
+### Last modification: Oct 19, 2026
 ###
 
 import sys
 import os
 import time
+import sqlite3
 
 import bbs.parse
+import bbs.statusdb
 import BBSutils
 import BBSvars
 import BBSreportutils
 
-def _read_status_from_summary_file(pkg, node_id, stage):
+def _read_summary_file(pkg, node_id, stage):
     summary_file = '%s.%s-summary.dcf' % (pkg, stage)
     summary_path = os.path.join('products-in', node_id, stage, summary_file)
     try:
         summary = bbs.parse.parse_DCF(summary_path, merge_records=True)
     except FileNotFoundError:
-        status = 'NA'
-    else:
-        status = summary['Status']
-    return status
+        summary = None
+    return summary
+
+### Return the number at the beginning of 'val' (e.g. 123.4 for
+### "123.4 seconds"), or None if 'val' is None or doesn't start with a
+### number (e.g. "NA").
+def _parse_number(val, type=float):
+    if val == None:
+        return None
+    try:
+        return type(val.split(' ')[0])
+    except ValueError:
+        return None
+
+### Return a (pkg, node_id, stage, status, version, ellapsed, warnings) tuple
+### (this is what bbs.statusdb.BuildStatusDB.add_statuses() expects). Only
+### the status is written to BUILD_STATUS_DB.txt, and it's obtained exactly
+### like before the history DB existed. The other fields are only for the
+### history DB and are None when they can't be parsed.
+def _make_status_row(pkg, node_id, stage, status=None):
+    if status != None:
+        return (pkg, node_id, stage, status, None, None, None)
+    summary = _read_summary_file(pkg, node_id, stage)
+    if summary == None:
+        return (pkg, node_id, stage, 'NA', None, None, None)
+    ## e.g. "EllapsedTime: 123.4 seconds"
+    ellapsed = _parse_number(summary.get('EllapsedTime'))
+    warnings = _parse_number(summary.get('Warnings'), int)
+    return (pkg, node_id, stage, summary['Status'], summary.get('Version'),
+            ellapsed, warnings)
 
 def _write_status_to_BUILD_STATUS_DB(out, pkg, node_id, stage, status):
     out.write('%s#%s#%s: %s\n' % (pkg, node_id, stage, status))
     return
 
-def _write_pkg_results_to_BUILD_STATUS_DB(pkg, out):
+def _get_pkg_status_rows(pkg):
+    rows = []
     for node in BBSreportutils.supported_nodes(pkg):
         # INSTALL status
         if BBSvars.buildtype != 'bioc-longtests':
             stage = 'install'
-            status = _read_status_from_summary_file(pkg, node.node_id, stage)
-            _write_status_to_BUILD_STATUS_DB(out, pkg, node.node_id, stage,
-                                             status)
+            rows.append(_make_status_row(pkg, node.node_id, stage))
         # BUILD status
         stage = 'buildsrc'
-        status = _read_status_from_summary_file(pkg, node.node_id, stage)
-        _write_status_to_BUILD_STATUS_DB(out, pkg, node.node_id, stage,
-                                         status)
-        skipped_is_OK = status in ['TIMEOUT', 'ERROR']
+        row = _make_status_row(pkg, node.node_id, stage)
+        rows.append(row)
+        skipped_is_OK = row[3] in ['TIMEOUT', 'ERROR']
         # CHECK status
         if BBSvars.buildtype not in ['workflows', 'books', 'bioc-mac-arm64']:
             stage = 'checksrc'
             if skipped_is_OK:
-                status = 'skipped'
+                row = _make_status_row(pkg, node.node_id, stage, 'skipped')
             else:
-                status = _read_status_from_summary_file(pkg, node.node_id,
-                                                        stage)
-            _write_status_to_BUILD_STATUS_DB(out, pkg, node.node_id, stage,
-                                             status)
+                row = _make_status_row(pkg, node.node_id, stage)
+            rows.append(row)
         # BUILD BIN status
         if BBSreportutils.is_doing_buildbin(node):
             stage = 'buildbin'
             if skipped_is_OK:
-                status = 'skipped'
+                row = _make_status_row(pkg, node.node_id, stage, 'skipped')
             else:
-                status = _read_status_from_summary_file(pkg, node.node_id,
-                                                        stage)
-            _write_status_to_BUILD_STATUS_DB(out, pkg, node.node_id, stage,
-                                             status)
-    return
+                row = _make_status_row(pkg, node.node_id, stage)
+            rows.append(row)
+    return rows
 
 def make_BUILD_STATUS_DB(pkgs):
     print('BBS> Writing %s ...' % BBSreportutils.BUILD_STATUS_DB_file, end=' ')
     sys.stdout.flush()
-    out = open(BBSreportutils.BUILD_STATUS_DB_file, 'w')
-    for pkg in pkgs:
-        _write_pkg_results_to_BUILD_STATUS_DB(pkg, out)
-    out.close()
+    rows = []
+    with open(BBSreportutils.BUILD_STATUS_DB_file, 'w') as out:
+        for pkg in pkgs:
+            pkg_rows = _get_pkg_status_rows(pkg)
+            for row in pkg_rows:
+                _write_status_to_BUILD_STATUS_DB(out, *row[0:4])
+            rows += pkg_rows
+    print('OK')
+    record_statuses_in_history_DB(rows)
+    return
+
+### Also record the statuses (plus some details) in the history DB. This is
+### for the record only: a problem with the history DB is reported but must
+### not prevent the build report from being produced.
+def record_statuses_in_history_DB(rows):
+    db_path = BBSreportutils.BUILD_STATUS_HISTORY_DB_file
+    print('BBS> Recording statuses in %s ...' % db_path, end=' ')
+    sys.stdout.flush()
+    try:
+        db = bbs.statusdb.BuildStatusDB(db_path)
+        try:
+            run_id = db.new_run(buildtype=BBSvars.buildtype,
+                                bioc_version=BBSvars.bioc_version)
+            db.add_statuses(run_id, rows)
+        finally:
+            db.close()
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print('FAILED! (%s)' % e)
+        return
     print('OK')
     return
 
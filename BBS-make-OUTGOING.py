@@ -14,6 +14,7 @@ import shutil
 
 import bbs.fileutils
 import bbs.parse
+import bbs.dcfstore
 import BBSutils
 import BBSvars
 
@@ -96,7 +97,7 @@ def copy_outgoing_pkgs(fresh_pkgs_subdir, source_node):
                                    BBSutils.meat_index_file)
     pkgs = bbs.parse.get_meat_packages_for_node(meat_index_path, node_hostname,
                                                 node_Arch, node_pkgType)
-    meat_index = bbs.parse.get_meat_packages(meat_index_path, as_dict=True)
+    meat_index = bbs.dcfstore.open_indexed_DCF(meat_index_path, 'Package')
     for pkg in pkgs:
         if pkgMustBeRejected(node_hostname, node_id, pkg):
             continue
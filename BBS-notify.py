@@ -58,6 +58,10 @@ def collect_problems(pkg, node):
         if status in ["TIMEOUT", "ERROR"]:
             problem_desc = "%s for '%s' on %s" % \
                            (status, stage2command[stage], node.node_id)
+            nb_days = BBSreportutils.get_nb_consecutive_failures(pkg,
+                                                    node.node_id, stage)
+            if nb_days != None and nb_days >= 2:
+                problem_desc += " (failing for %d consecutive days)" % nb_days
             rurl = BBSreportutils.get_leafreport_rel_url(pkg, node.node_id,
                                                          stage)
             problem_desc = "  o %s. See the details here:\n      %s%s\n" % \
@@ -11,6 +11,7 @@ import sys
 import os
 import shutil
 import time
+import json
 
 import bbs.fileutils
 import bbs.manifest
@@ -38,17 +39,12 @@ def remakeCentralRdir(Central_rdir):
 
 ### Return 0 if package goes to the "meat index", 1 if it's skipped (in which
 ### case it wil go to the "skipped index"), and 2 if it's ignored.
-def _add_or_skip_or_ignore_package(pkgsrctree, meat_index):
+def _add_or_skip_or_ignore_package(pkgsrctree, meat_index, meat_snapshot):
     options = bbs.parse.parse_BBSoptions_from_pkgsrctree(pkgsrctree)
     if BBSvars.buildtype == "bioc-longtests":
         ## Ignore the package if it has no .BBSoptions file, or if the file
         ## has no RunLongTests entry, or if the entry is not TRUE.
-        if options == None:
-            return 2  # package will be ignored
-        run_long_tests = options.get('RunLongTests')
-        if run_long_tests == None:
-            return 2  # package will be ignored
-        if run_long_tests.lower() != "true":
+        if not bbs.parse.get_BBSoption_flag(pkgsrctree, 'RunLongTests'):
             return 2  # package will be ignored
     DESCRIPTION_path = bbs.parse.get_DESCRIPTION_path(pkgsrctree)
     try:
@@ -107,8 +103,42 @@ def _add_or_skip_or_ignore_package(pkgsrctree, meat_index):
         unsupported = options.get('UnsupportedPlatforms')
         meat_index.write('UnsupportedPlatforms: %s\n' % unsupported)
     meat_index.write('\n')
+    _add_package_to_meat_snapshot(pkgsrctree, options, meat_snapshot)
     return 0  # package will be added to the "meat index"
 
+### The values must be exactly what the bbs.parse functions would return
+### on the nodes so we use these functions to extract them.
+def _add_package_to_meat_snapshot(pkgsrctree, options, meat_snapshot):
+    try:
+        entry = {
+            'Package': bbs.parse.get_Package_from_pkgsrctree(pkgsrctree),
+            'Version': bbs.parse.get_Version_from_pkgsrctree(pkgsrctree),
+            'PackageStatus': bbs.parse.get_PackageStatus_pkgsrctree(pkgsrctree),
+            'BBSoptions': options,
+            'vcs': None,
+            'signatures': bbs.parse.get_pkg_snapshot_signatures(pkgsrctree)
+        }
+    except bbs.parse.DcfFieldNotFoundError:
+        return  # the nodes will read the DESCRIPTION file
+    meat_snapshot['packages'][os.path.basename(pkgsrctree)] = entry
+    return
+
+### Return the "key: value" pairs of a vcs-meta file as a dict. Like
+### BBSreportutils.get_vcs_meta(), the first occurrence of a key wins.
+def _read_vcs_meta_file(path):
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    vals = {}
+    for line in lines:
+        line = bbs.parse.bytes2str(line)
+        pos = line.find(':')
+        if pos <= 0 or line[0] in ' \t#':
+            continue
+        key = line[:pos]
+        if key not in vals:
+            vals[key] = bbs.parse.get_next_DCF_val(lines, key, True)
+    return vals
+
 def build_meat_index(pkgs, meat_path):
     doing_what = 'creating the meat index for the %s target package' % len(pkgs)
     if BBSvars.buildtype == "bioc-incremental":
@@ -124,10 +154,23 @@ def build_meat_index(pkgs, meat_path):
                                       BBSutils.skipped_index_file)
     meat_index = open(meat_index_path, 'w')
     skipped_index = open(skipped_index_path, 'w')
+    meat_snapshot = {'format': bbs.parse.pkg_snapshot_format,
+                     'created_at': bbs.jobs.currentDateString(),
+                     'vcs': None,
+                     'packages': {}}
     nadded = nskipped = 0
+    if BBSvars.buildtype != "bioc-longtests":
+        ## Resolve the Maintainer of all the packages at once instead of
+        ## starting Rscript twice per package in the loop below. For
+        ## bioc-longtests most packages are ignored so we don't bother.
+        pkgsrctrees = [os.path.join(meat_path, pkg) for pkg in pkgs]
+        nresolved = bbs.parse.prefetch_Maintainers(pkgsrctrees)
+        print('BBS> [build_meat_index] Maintainer of %d/%d pkgs prefetched' % \
+              (nresolved, len(pkgs)))
     for pkg in pkgs:
         pkgsrctree = os.path.join(meat_path, pkg)
-        retcode = _add_or_skip_or_ignore_package(pkgsrctree, meat_index)
+        retcode = _add_or_skip_or_ignore_package(pkgsrctree, meat_index,
+                                                 meat_snapshot)
         meat_index.flush()
         if retcode == 2:
             ## Ignore package.
@@ -154,11 +197,27 @@ def build_meat_index(pkgs, meat_path):
     print("BBS>   --> %d pkgs made it to the meat index" % nadded)
     print()
     sys.stdout.flush()
-    return meat_index_path
+    return (meat_index_path, meat_snapshot)
 
 def buildAndUploadMeatIndex(pkgs, meat_path):
-    meat_index_path = build_meat_index(pkgs, meat_path)
+    meat_index_path, meat_snapshot = build_meat_index(pkgs, meat_path)
     BBSvars.Central_rdir.Put(meat_index_path, True, True)
+    return meat_snapshot
+
+### Must be called after collect_vcs_meta() (svn- and git-based builds).
+def writeAndUploadMeatSnapshot(meat_snapshot):
+    if BBSvars.MEAT0_type == 1 or BBSvars.MEAT0_type == 3:
+        vcsmeta_path = os.path.join(BBSvars.work_topdir, BBSvars.vcsmeta_file)
+        meat_snapshot['vcs'] = _read_vcs_meta_file(vcsmeta_path)
+        for pkg, entry in meat_snapshot['packages'].items():
+            pkg_vcsmeta_path = "-%s.".join(vcsmeta_path.rsplit(".", 1)) % pkg
+            if os.path.exists(pkg_vcsmeta_path):
+                entry['vcs'] = _read_vcs_meta_file(pkg_vcsmeta_path)
+    meat_snapshot_path = os.path.join(BBSvars.work_topdir,
+                                      BBSutils.meat_snapshot_file)
+    with open(meat_snapshot_path, 'w') as f:
+        json.dump(meat_snapshot, f, separators=(',', ':'))
+    BBSvars.Central_rdir.Put(meat_snapshot_path, True, True)
     return
 
 def uploadSkippedIndex(work_topdir):
@@ -321,8 +380,9 @@ def writeAndUploadMeatInfo(work_topdir):
         update_MEAT0(MEAT0_path, snapshot_date)
         manifest_path = BBSvars.manifest_path
         pkgs = bbs.manifest.read(manifest_path)
-    buildAndUploadMeatIndex(pkgs, MEAT0_path)
+    meat_snapshot = buildAndUploadMeatIndex(pkgs, MEAT0_path)
     collect_vcs_meta(snapshot_date)
+    writeAndUploadMeatSnapshot(meat_snapshot)
     uploadSkippedIndex(work_topdir)
     return
 
@@ -459,6 +519,7 @@ if __name__ == "__main__":
     print("BBS> %s" % time.asctime())
     print("BBS> ==============================================================")
     print()
+    bbs.fileutils.reap_trash()
     argc = len(sys.argv)
     if argc > 1:
         arg1 = sys.argv[1]
@@ -496,7 +557,8 @@ if __name__ == "__main__":
     if (arg1 == "" or arg1 == subtask) and BBSvars.MEAT0_type == 2:
         print("BBS> [prerun] STARTING %s at %s..." % (subtask, time.asctime()))
         pkgs = extractSrcPkgTarballs(meat_path)
-        buildAndUploadMeatIndex(pkgs, meat_path)
+        meat_snapshot = buildAndUploadMeatIndex(pkgs, meat_path)
+        writeAndUploadMeatSnapshot(meat_snapshot)
         print("BBS> [prerun] DONE %s at %s." % (subtask, time.asctime()))
 
     subtask = "make-target-repo"
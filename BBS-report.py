@@ -20,6 +20,7 @@ import bbs.fileutils
 import bbs.parse
 import bbs.jobs
 import bbs.rdir
+import bbs.depgraph
 import BBSutils
 import BBSvars
 import BBSreportutils
@@ -2065,6 +2066,13 @@ if __name__ == "__main__":
               (BBSreportutils.PROPAGATION_STATUS_DB_file, report_path))
         shutil.copy(BBSreportutils.PROPAGATION_STATUS_DB_file, report_path)
 
+    if os.path.exists(BBSutils.meat_snapshot_file):
+        print("BBS> [stage6d] Loading %s ..." % BBSutils.meat_snapshot_file,
+              end=" ")
+        sys.stdout.flush()
+        bbs.parse.load_pkg_snapshot(BBSutils.meat_snapshot_file)
+        print("OK")
+
     print("BBS> [stage6d] cd %s/" % report_path)
     os.chdir(report_path)
 
@@ -2098,7 +2106,8 @@ if __name__ == "__main__":
         print("BBS> [stage6d] Loading %s file ..." % \
               BBSutils.pkg_dep_graph_file, end=" ")
         sys.stdout.flush()
-        pkg_dep_graph = bbs.parse.load_pkg_dep_graph(BBSutils.pkg_dep_graph_file)
+        pkg_dep_graph = bbs.depgraph.load_pkg_dep_graph(
+                            BBSutils.pkg_dep_graph_file)
         print("OK")
         allpkgs_inner_rev_deps = BBSreportutils.get_inner_reverse_deps(
                                      allpkgs,
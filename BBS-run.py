@@ -9,13 +9,24 @@
 
 import sys
 import os
+import re
 import time
+import json
+import shutil
+import subprocess
 import urllib.request
 from functools import lru_cache
 
 import bbs.fileutils
 import bbs.parse
 import bbs.jobs
+import bbs.rdir
+import bbs.ingest
+import bbs.depgraph
+import bbs.rlib
+import bbs.pkgstore
+import bbs.ccache
+import bbs.cpubroker
 import BBSutils
 import BBSvars
 import BBSbase
@@ -35,10 +46,29 @@ def make_stage_out_dir(stage):
     return out_dir
 
 def make_products_push_cmd(out_dir, rdir):
+    if (rdir.host == None or rdir.host == 'localhost') and \
+       bbs.fileutils.same_filesystem(out_dir, rdir.path):
+        ## The central node is also a build node. Hard-link the products
+        ## instead of copying them. This is safe because the product buffer
+        ## is remade at the beginning of each stage.
+        if sys.platform == "win32":
+            out_dir = bbs.fileutils.to_cygwin_style(out_dir)
+        return '%s -av --link-dest=%s %s/ %s' % \
+               (BBSvars.rsync_cmd, os.path.abspath(out_dir), out_dir,
+                rdir.get_full_remote_path())
+    if not isinstance(rdir, bbs.rdir.IngestRemoteDir):
+        if sys.platform == "win32":
+            out_dir = bbs.fileutils.to_cygwin_style(out_dir)
+        return '%s -av %s/ %s' % (BBSvars.rsync_rsh_cmd, out_dir,
+                                  rdir.get_full_remote_path())
+    ## Push thru the ingest channel and fall back to rsync if that fails.
+    ingest_cmd = rdir.make_push_cmd(out_dir)
     if sys.platform == "win32":
         out_dir = bbs.fileutils.to_cygwin_style(out_dir)
-    dest = rdir.get_full_remote_path()
-    return '%s -av %s/ %s' % (BBSvars.rsync_rsh_cmd, out_dir, dest)
+    rsync_cmd = '%s -av --exclude=%s %s/ %s' % \
+                (BBSvars.rsync_rsh_cmd, bbs.ingest.push_manifest_file,
+                 out_dir, rdir.get_full_remote_path())
+    return '%s || %s' % (ingest_cmd, rsync_cmd)
 
 
 ##############################################################################
@@ -60,18 +90,70 @@ def getRconfigValue(var):
         val = val[:-1]
     return val
 
-def appendRconfigValue(file, var, is_first=False):
-    val = getRconfigValue(var)
-    if is_first and os.path.exists(file):
-        os.remove(file)
-    f = open(file, 'a')
-    f.write('%s: %s\n' % (var, val))
-    f.close()
-    return
-
+# Return the path to the Makeconf file used by 'R CMD config' (or None if
+# we can't find it).
+def get_Makeconf_path():
+    R_ARCH = os.environ.get('R_ARCH', '')
+    candidates = [os.path.join(BBSvars.r_home, 'etc' + R_ARCH, 'Makeconf')]
+    if sys.platform == 'win32':
+        candidates.append(os.path.join(BBSvars.r_home, 'etc', 'x64',
+                                       'Makeconf'))
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+# Same as calling getRconfigValue() on each variable but with a single
+# 'make' command instead of one 'R CMD config' command per variable: like
+# 'R CMD config' does, we let make evaluate the variables from the Makeconf
+# file and the user Makevars file (if any), and we append the C++ standard
+# to the C++ compilers (e.g. 'R CMD config CXX17' gives
+# '$(CXX17) $(CXX17STD)'). Return a dict mapping each variable to its value,
+# or None if this didn't work (in which case the caller should use
+# getRconfigValue()).
+def getRconfigValues(vars):
+    makeconf = get_Makeconf_path()
+    if makeconf == None:
+        return None
+    makefiles = ['-f', makeconf]
+    user_Makevars = bbs.ccache.get_user_Makevars()
+    if user_Makevars != None:
+        if not os.path.isfile(user_Makevars):
+            return None
+        makefiles += ['-f', user_Makevars]
+    def expr(var):
+        if re.fullmatch(r'CXX[0-9]*', var):
+            return '$(%s) $(%sSTD)' % (var, var)
+        return '$(%s)' % var
+    # Use markers so we don't get confused by what make could print.
+    makefile = ''.join('$(info @@BBS@@%s@@BBS@@%s)\n' % (var, expr(var))
+                       for var in vars) + 'print: ;\n'
+    env = dict(os.environ, R_HOME=BBSvars.r_home)
+    make = os.environ.get('MAKE', 'make')
+    try:
+        p = subprocess.run([make, '-s'] + makefiles + ['-f', '-', 'print'],
+                           input=makefile, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, env=env,
+                           universal_newlines=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if p.returncode != 0:
+        return None
+    vals = {}
+    for line in p.stdout.splitlines():
+        if not line.startswith('@@BBS@@'):
+            continue
+        var, val = line[7:].split('@@BBS@@', 1)
+        # 'R CMD config' uses 'echo $(VAR)' so the shell collapses the
+        # whitespaces.
+        vals[var] = ' '.join(val.split())
+    if any(var not in vals for var in vars):
+        return None
+    return vals
+
+# Return a dict mapping the variables written to R-config.txt to their values.
 def write_R_config():
     file = 'R-config.txt'
-    appendRconfigValue(file, 'MAKE', True)
     C_vars = ['CC', 'CFLAGS', 'CPICFLAGS']
     Cplusplus_vars = ['CXX', 'CXXFLAGS', 'CXXPICFLAGS']
     #Cplusplus98_vars = ['CXX98', 'CXX98FLAGS', 'CXX98PICFLAGS', 'CXX98STD']
@@ -87,73 +169,295 @@ def write_R_config():
     #       Cplusplus14_vars + \
     #       Fortran77_vars + \
     #       Fortran9x_vars
-    vars = C_vars + \
+    vars = ['MAKE'] + \
+           C_vars + \
            Cplusplus_vars + \
            Cplusplus11_vars + \
            Cplusplus14_vars + \
            Cplusplus17_vars
+    vals = getRconfigValues(vars)
+    if vals == None:
+        vals = {var: getRconfigValue(var) for var in vars}
+    f = open(file, 'w')
     for var in vars:
-        appendRconfigValue(file, var)
-    return
+        f.write('%s: %s\n' % (var, vals[var]))
+    f.close()
+    return vals
 
 # If the command is not found (like gfortran on churchill) then the '2>&1'
 # guarantees that 'file' will be created anyway but with the shell error
 # message inside (e.g. '-bash: gfortran: command not found') instead of
 # the command output. 
-def write_sys_command_version(var):
+def write_sys_command_version(var, cmd):
     file = '%s-version.txt' % var
-    cmd = getRconfigValue(var)
     if cmd.strip():
         syscmd = '%s --version >%s 2>&1' % (cmd, file)
         bbs.jobs.call(syscmd) # ignore retcode
     return
 
+# The NodeInfo files (except R-instpkgs.txt) only depend on the R and
+# compiler installations. We use the mtimes and sizes of the R command,
+# Makeconf file, user Makevars file, and compilers (as found in the
+# R-config.txt file of the previous update) to detect when they need to be
+# regenerated.
+def get_NodeInfo_signature(NodeInfo_path):
+    paths = [shutil.which(BBSvars.r_cmd) or BBSvars.r_cmd,
+             get_Makeconf_path(),
+             bbs.ccache.get_user_Makevars()]
+    Rconfig_path = os.path.join(NodeInfo_path, 'R-config.txt')
+    if not os.path.exists(Rconfig_path):
+        return None
+    for var in ['CC', 'CXX', 'CXX11', 'CXX14', 'CXX17']:
+        f = open(Rconfig_path, 'rb')
+        cmd = bbs.parse.get_next_DCF_val(f, var, True)
+        f.close()
+        if cmd != None and cmd.strip():
+            paths.append(shutil.which(cmd.split()[0]))
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except (OSError, TypeError):
+            signature.append([path, None])
+        else:
+            signature.append([path, st.st_mtime_ns, st.st_size])
+    return signature
+
 def makeNodeInfo():
     # Generate the NodeInfo files (the files containing some node related info)
     NodeInfo_subdir = 'NodeInfo'
     print('BBS>   Updating BBS_WORK_TOPDIR/%s' % NodeInfo_subdir)
     NodeInfo_path = os.path.join(BBSvars.work_topdir, NodeInfo_subdir)
-    bbs.fileutils.remake_dir(NodeInfo_path)
-    os.chdir(NodeInfo_path)
-    write_R_version()
-    write_R_config()
-    write_sys_command_version('CC')
-    write_sys_command_version('CXX')
-    #write_sys_command_version('CXX98')
-    write_sys_command_version('CXX11')
-    write_sys_command_version('CXX14')
-    write_sys_command_version('CXX17')
-    #write_sys_command_version('F77')
-    #write_sys_command_version('FC')
-    Rexpr = 'sessionInfo()'
-    bbs.jobs.runJob(BBSbase.Rexpr2syscmd(Rexpr), \
-                    'R-sessionInfo.txt', 60.0, True) # ignore retcode
-    Rexpr = "options(width=500);print(installed.packages()[,c('LibPath','Version','Built')],quote=FALSE)"
-    bbs.jobs.runJob(BBSbase.Rexpr2syscmd(Rexpr), \
-                    'R-instpkgs.txt', 120.0, True) # ignore retcode
+    signature_path = NodeInfo_path + '-signature.json'
+    # The signature file also records the files generated by the last full
+    # update. Anything else in NodeInfo (e.g. a ccache-<stage>.txt file from
+    # a previous run) is stale.
+    try:
+        f = open(signature_path, 'r')
+        old_signature = json.load(f)
+        f.close()
+        NodeInfo_files = old_signature['files']
+        old_signature = old_signature['signature']
+    except (OSError, ValueError, TypeError, KeyError):
+        old_signature = None
+    signature = get_NodeInfo_signature(NodeInfo_path)
+    if signature != None and signature == old_signature:
+        print('BBS>   R and compilers did not change since last update', end=' ')
+        print('=> only update R-instpkgs.txt')
+        os.chdir(NodeInfo_path)
+        for file in os.listdir('.'):
+            if file in NodeInfo_files:
+                continue
+            if os.path.isdir(file) and not os.path.islink(file):
+                shutil.rmtree(file)
+            else:
+                os.remove(file)
+    else:
+        if os.path.exists(signature_path):
+            os.remove(signature_path)
+        bbs.fileutils.remake_dir(NodeInfo_path)
+        os.chdir(NodeInfo_path)
+        write_R_version()
+        Rconfig_vals = write_R_config()
+        write_sys_command_version('CC', Rconfig_vals['CC'])
+        write_sys_command_version('CXX', Rconfig_vals['CXX'])
+        #write_sys_command_version('CXX98', Rconfig_vals['CXX98'])
+        write_sys_command_version('CXX11', Rconfig_vals['CXX11'])
+        write_sys_command_version('CXX14', Rconfig_vals['CXX14'])
+        write_sys_command_version('CXX17', Rconfig_vals['CXX17'])
+        #write_sys_command_version('F77', Rconfig_vals['F77'])
+        #write_sys_command_version('FC', Rconfig_vals['FC'])
+        Rexpr = 'sessionInfo()'
+        bbs.jobs.runJob(BBSbase.Rexpr2syscmd(Rexpr), \
+                        'R-sessionInfo.txt', 60.0, True) # ignore retcode
+        f = open(signature_path, 'w')
+        json.dump({'signature': get_NodeInfo_signature(NodeInfo_path),
+                   'files': sorted(os.listdir('.'))}, f)
+        f.close()
+    # Same as
+    #   options(width=500)
+    #   print(installed.packages()[,c('LibPath','Version','Built')],quote=FALSE)
+    # but without starting R.
+    lib_paths = bbs.rlib.get_lib_paths(BBSvars.r_home)
+    bbs.rlib.write_installed_pkgs_table(lib_paths, 'R-instpkgs.txt')
     print('BBS>   cd BBS_WORK_TOPDIR')
     os.chdir(BBSvars.work_topdir)
     BBSvars.Node_rdir.Put(NodeInfo_subdir, True, True)
     return
 
 
+##############################################################################
+## Compiler cache (see bbs/ccache.py)
+##############################################################################
+
+# Set to True by set_up_compiler_cache() if the compiler cache is enabled.
+compiler_cache_enabled = False
+
+def set_up_compiler_cache():
+    global compiler_cache_enabled
+    if BBSvars.ccache_dir == None or sys.platform == 'win32':
+        return
+    print('BBS> Setting up compiler cache %s ...' % BBSvars.ccache_dir, end=' ')
+    sys.stdout.flush()
+    Makevars_path = os.path.join(BBSvars.work_topdir, 'ccache-Makevars')
+    compiler_cache_enabled = bbs.ccache.set_up(BBSvars.ccache_dir,
+                                               BBSvars.ccache_max_size,
+                                               Makevars_path,
+                                               BBSvars.ccache_cmd)
+    if compiler_cache_enabled:
+        print('OK')
+    else:
+        print('FAILED (cannot run %s) => no compiler cache' % \
+              BBSvars.ccache_cmd)
+    return
+
+# Give each job in the queue its own ccache stats log.
+def add_compiler_cache_statslogs(job_queue):
+    if not compiler_cache_enabled:
+        return
+    statslogs_dir = os.path.join(BBSvars.work_topdir, 'ccache-statslogs',
+                                 job_queue._name)
+    bbs.fileutils.remake_dir(statslogs_dir)
+    for job in job_queue._jobs:
+        if job._cmd == None:
+            continue
+        job.ccache_statslog = os.path.join(statslogs_dir, job._name + '.log')
+        job._cmd = bbs.ccache.add_statslog_to_cmd(job._cmd,
+                                                  job.ccache_statslog)
+    return
+
+# Print the hit rate of the compiler cache for the jobs in the queue,
+# enforce the size limit of the cache, and record the stats in
+# NodeInfo/ccache-<stage>.txt.
+def report_compiler_cache_stats(job_queue):
+    if not compiler_cache_enabled:
+        return
+    stage = job_queue._name
+    nb_hits = nb_misses = 0
+    for job in job_queue._jobs:
+        if job.ccache_statslog == None:
+            continue
+        job_nb_hits, job_nb_misses = \
+            bbs.ccache.read_statslog(job.ccache_statslog)
+        nb_hits += job_nb_hits
+        nb_misses += job_nb_misses
+    hit_rate = bbs.ccache.format_hit_rate(nb_hits, nb_misses)
+    print('BBS> Compiler cache hits for %s: %s' % (stage, hit_rate))
+    stats = bbs.ccache.cleanup_and_get_stats(BBSvars.ccache_cmd)
+    NodeInfo_subdir = 'NodeInfo'
+    NodeInfo_path = os.path.join(BBSvars.work_topdir, NodeInfo_subdir)
+    os.makedirs(NodeInfo_path, exist_ok=True)
+    path = os.path.join(NodeInfo_path, 'ccache-%s.txt' % stage)
+    f = open(path, 'w')
+    f.write('Stage: %s\n' % stage)
+    f.write('CompilerCacheHits: %s\n' % hit_rate)
+    f.write('\n')
+    f.write(stats)
+    f.close()
+    BBSvars.Node_rdir.subdir(NodeInfo_subdir).Put(path, True, True)
+    return
+
+
+##############################################################################
+## CPU broker (see bbs/cpubroker.py)
+##############################################################################
+
+# Set by set_up_cpu_broker() if BBS_CPU_BROKER_DIR is set.
+cpu_broker = None
+
+def set_up_cpu_broker():
+    global cpu_broker
+    if BBSvars.cpu_broker_dir == None:
+        return
+    label = '%s %s' % (BBSvars.buildtype, BBSvars.bioc_version)
+    cpu_broker = bbs.cpubroker.CPUBroker(BBSvars.cpu_broker_dir,
+                                         BBSvars.cpu_broker_nb_cpu,
+                                         BBSvars.cpu_broker_weight,
+                                         label)
+    print('BBS> Using CPU broker %s (%d CPUs, weight %s)' % \
+          (BBSvars.cpu_broker_dir, cpu_broker.nb_cpu, cpu_broker.weight))
+    return
+
+def close_cpu_broker():
+    if cpu_broker != None:
+        cpu_broker.close()
+    return
+
+
+##############################################################################
+## Per-job temporary dirs (see bbs.jobs.JobTmpDirs)
+##############################################################################
+
+# Set by set_up_job_tmpdirs() if BBS_JOB_TMPDIR_ROOT is set.
+job_tmpdirs = None
+
+def set_up_job_tmpdirs():
+    global job_tmpdirs
+    if BBSvars.job_tmpdir_root == None:
+        return
+    job_tmpdirs = bbs.jobs.JobTmpDirs(BBSvars.job_tmpdir_root,
+                                      BBSvars.job_tmpdir_spill_root,
+                                      BBSvars.job_tmpdir_min_free)
+    print('BBS> Each job will get its own temporary dir in %s' % \
+          BBSvars.job_tmpdir_root)
+    return
+
+
 ##############################################################################
 ## Misc utils
 ##############################################################################
 
+# Same as rdir.syncLocalDir() but the time spent is recorded with the time
+# spent in the other background tasks (see bbs.jobs.runInBackground()).
+def sync_local_dir(rdir, local_dir):
+    t1 = time.time()
+    rdir.syncLocalDir(local_dir, True)
+    bbs.jobs.recordBackgroundTask('local dir sync', time.time() - t1)
+    return
+
+def print_background_task_times():
+    bbs.jobs.waitForBackgroundTasks()
+    print('BBS> Time spent in background tasks:')
+    for line in bbs.jobs.formatBackgroundTaskTimes():
+        print('BBS>   %s' % line)
+    return
+
 def write_BBS_EndOfRun_ticket(ticket):
     print('BBS> START writing BBS_EndOfRun.txt ticket.')
     print('BBS>   cd BBS_MEAT_PATH')
     os.chdir(BBSvars.meat_path)
     file_path = 'BBS_EndOfRun.txt'
     f = open(file_path, 'w')
+    # With CPU pinning enabled, the EllapsedTime values can be compared with
+    # those of a run without it to see how much thread contention it saves.
+    cpu_pinning = 'TRUE' if BBSvars.pin_jobs_to_cpus else 'FALSE'
     for t in ticket:
-        f.write('%s | nb_cpu=%d | StartedAt: %s | EndedAt: %s | EllapsedTime: %.1f seconds\n' % t)
+        f.write('%s | nb_cpu=%d | StartedAt: %s | EndedAt: %s | EllapsedTime: %.1f seconds' % t)
+        f.write(' | CPUPinning: %s\n' % cpu_pinning)
     f.close()
     BBSvars.Node_rdir.Put(file_path, True, True)
     print('BBS> END writing BBS_EndOfRun.txt ticket.')
     return
 
+## Load the package metadata snapshot written by BBS-prerun.py so we don't
+## need to open the DESCRIPTION and .BBSoptions files of each package
+## again and again (see bbs/parse.py).
+def load_meat_snapshot():
+    Central_rdir = BBSvars.Central_rdir
+    f = Central_rdir.WOpen(BBSutils.meat_snapshot_file,
+                           return_None_on_error=True)
+    if f == None:
+        print('BBS> No %s file on central builder ==> ' % \
+              BBSutils.meat_snapshot_file + \
+              'will read package metadata from the meat')
+        return
+    loaded = bbs.parse.load_pkg_snapshot(f)
+    f.close()
+    if not loaded:
+        print('BBS> Unsupported format for %s ==> ignore it' % \
+              BBSutils.meat_snapshot_file)
+    return
+
 ## Get list of target packages from meat index file located on central
 ## builder. Memoized.
 @lru_cache  # clear cache with get_list_of_target_pkgs.cache_clear()
@@ -222,6 +526,54 @@ def waitForTargetRepoToBeReady():
 ## STAGE2: Update ALL packages and re-install target packages + dependencies.
 ##############################################################################
 
+# Same as .get_all_repos() in utils/build_pkg_dep_graph.R
+def get_all_repos():
+    target_repo = BBSutils.getenv('BBS_CENTRAL_BASEURL')
+    non_target_repos_file = BBSutils.getenv('BBS_NON_TARGET_REPOS_FILE')
+    bioc_version = BBSutils.getenv('BBS_BIOC_VERSION', False, '')
+    f = open(non_target_repos_file, 'r')
+    non_target_repos = [line.strip().replace('BBS_BIOC_VERSION', bioc_version)
+                        for line in f if line.strip() != '']
+    f.close()
+    return [target_repo] + non_target_repos
+
+# Try to generate file 'pkg_dep_graph.txt' from the cache of the previous
+# run (see "Cross-run cache" in bbs/depgraph.py). Return the data needed to
+# update the cache and a boolean indicating whether the file was generated.
+# The versions of the available packages are stored in 'available_versions'.
+def build_pkg_dep_graph_from_cache(target_pkgs, cache_path,
+                                   available_versions):
+    print('BBS> [build_pkg_dep_graph]', end=' ')
+    print('Reading PACKAGES files of all repos ...', end=' ')
+    sys.stdout.flush()
+    try:
+        R_version, R_built = bbs.depgraph.get_R_signature(BBSvars.r_home)
+        available_pkgs = bbs.depgraph.read_available_pkgs(get_all_repos(),
+                                                          R_version,
+                                                          available_versions)
+    except (OSError, KeyError, bbs.parse.DcfParsingError) as e:
+        print('FAILED (%s)' % e)
+        return (None, None, None, False)
+    print('OK (%d available pkgs)' % len(available_pkgs))
+    lib_paths = bbs.rlib.get_lib_paths(BBSvars.r_home)
+    installed_pkgs = bbs.rlib.get_installed_pkgs(lib_paths)
+    cache = bbs.depgraph.load_pkg_dep_graph_cache(cache_path)
+    pkg_dep_graph, nb_recomputed = \
+        bbs.depgraph.update_pkg_dep_graph_from_cache(cache, target_pkgs,
+                                                     available_pkgs, R_built,
+                                                     installed_pkgs)
+    print('BBS> [build_pkg_dep_graph]', end=' ')
+    if pkg_dep_graph == None:
+        print('Cannot use cache %s' % cache_path)
+        return (available_pkgs, R_built, installed_pkgs, False)
+    print('Using cache %s (%d entries recomputed) to generate file %s' % \
+          (cache_path, nb_recomputed, BBSutils.pkg_dep_graph_file))
+    bbs.depgraph.write_pkg_dep_graph(pkg_dep_graph,
+                                     BBSutils.pkg_dep_graph_file)
+    return (available_pkgs, R_built, installed_pkgs, True)
+
+# Return the graph and a dict mapping each available package to its version
+# (as a tuple), or None if the PACKAGES files of the repos could not be read.
 def build_pkg_dep_graph(target_pkgs):
     # Generate file 'target_pkgs.txt'.
     target_pkgs_file = 'target_pkgs.txt'
@@ -232,7 +584,39 @@ def build_pkg_dep_graph(target_pkgs):
     print('BBS> [build_pkg_dep_graph]', end=' ')
     print('%s pkgs written to %s' % (len(target_pkgs), target_pkgs_file))
 
-    # Generate file 'pkg_dep_graph.txt'.
+    cache_path = os.path.join(BBSvars.work_topdir,
+                              BBSutils.pkg_dep_graph_cache_file)
+    available_versions = {}
+    available_pkgs, R_built, installed_pkgs, from_cache = \
+        build_pkg_dep_graph_from_cache(target_pkgs, cache_path,
+                                       available_versions)
+    if available_pkgs == None:
+        available_versions = None
+    if not from_cache:
+        call_build_pkg_dep_graph_R(target_pkgs_file)
+
+    # Send files 'target_pkgs.txt' and 'pkg_dep_graph.txt' to central
+    # build node.
+    BBSvars.Node_rdir.Put(BBSutils.pkg_dep_graph_file, True, True)
+
+    # Load file 'pkg_dep_graph.txt'.
+    print('BBS> [build_pkg_dep_graph] Loading %s file ...' % \
+          BBSutils.pkg_dep_graph_file, end=' ')
+    pkg_dep_graph = bbs.depgraph.load_pkg_dep_graph(
+                        BBSutils.pkg_dep_graph_file)
+    print('OK (%s pkgs and their deps loaded)' % len(pkg_dep_graph))
+
+    # Update the cache for the next run.
+    if available_pkgs != None:
+        bbs.depgraph.save_pkg_dep_graph_cache(cache_path, pkg_dep_graph,
+                                              target_pkgs, available_pkgs,
+                                              R_built, installed_pkgs)
+
+    print('BBS> [build_pkg_dep_graph] DONE.')
+    return (pkg_dep_graph, available_versions)
+
+# Generate file 'pkg_dep_graph.txt'.
+def call_build_pkg_dep_graph_R(target_pkgs_file):
     Rfunction = 'build_pkg_dep_graph'
     script_path = os.path.join(BBSvars.BBS_home,
                                'utils',
@@ -260,36 +644,30 @@ def build_pkg_dep_graph(target_pkgs):
     if retcode != 0:
         print('ERROR!')
         print('BBS> [build_pkg_dep_graph] Command %s' % cmd, end=' ')
-        print('returned an error (%d)' % retcode, end=' ')
+        # runJob() returns None if the command timed out.
+        if retcode == None:
+            print('timed out', end=' ')
+        else:
+            print('returned an error (%d)' % retcode, end=' ')
         sys.stdout.flush()
         sys.exit('=> EXIT.')
     print('OK')
+    return
 
-    # Send files 'target_pkgs.txt' and 'pkg_dep_graph.txt' to central
-    # build node.
-    BBSvars.Node_rdir.Put(BBSutils.pkg_dep_graph_file, True, True)
-
-    # Load file 'pkg_dep_graph.txt'.
-    print('BBS> [build_pkg_dep_graph] Loading %s file ...' % \
-          BBSutils.pkg_dep_graph_file, end=' ')
-    pkg_dep_graph = bbs.parse.load_pkg_dep_graph(BBSutils.pkg_dep_graph_file)
-    print('OK (%s pkgs and their deps loaded)' % len(pkg_dep_graph))
-
-    print('BBS> [build_pkg_dep_graph] DONE.')
-    return pkg_dep_graph
-
+# Return a dict mapping each installed package to a dict with its Package,
+# Version, Built, and LibPath fields (see bbs.rlib.get_installed_pkgs()).
+# We scan the R library directories instead of starting R to call
+# installed.packages().
 def get_installed_pkgs():
     installed_pkgs_path = 'installed_pkgs.txt'
-    Rexpr = "writeLines(rownames(installed.packages()),'%s')" % \
-            installed_pkgs_path
-    out_file = 'get_installed_pkgs.Rout'
-    bbs.jobs.runJob(BBSbase.Rexpr2syscmd(Rexpr), out_file) # ignore retcode
-    installed_pkgs = []
-    f = open(installed_pkgs_path, 'r')
-    for line in f:
-        installed_pkgs.append(line.strip())
+    lib_paths = bbs.rlib.get_lib_paths(BBSvars.r_home)
+    installed_pkgs = bbs.rlib.get_installed_pkgs(lib_paths)
+    f = open(installed_pkgs_path, 'w')
+    for pkg, desc in installed_pkgs.items():
+        f.write('%s\t%s\t%s\n' % (pkg, desc['Version'], desc['LibPath']))
     f.close()
-    print('BBS> [get_installed_pkgs] %s installed pkgs' % len(installed_pkgs))
+    print('BBS> [get_installed_pkgs] %s installed pkgs found in %s' % \
+          (len(installed_pkgs), ' '.join(lib_paths)))
     return installed_pkgs
 
 #def CreateREnvironFiles():
@@ -311,28 +689,143 @@ def get_installed_pkgs():
 #        f.write('GRAPHVIZ_INSTALL_SUBMINOR=%s\n' % graphviz_install_subminor)
 #        f.close()
 
+# The STAGE2 install state records, for each target package successfully
+# installed by STAGE2, the Version and git_last_commit of the package and
+# the versions of its deps at the time of the installation. It allows the
+# next run to skip the re-installation of the packages that didn't change.
+def load_STAGE2_install_state(R_built):
+    path = os.path.join(BBSvars.work_topdir,
+                        BBSutils.STAGE2_install_state_file)
+    try:
+        f = open(path, 'r')
+        state = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return {}
+    # A new R install invalidates the state.
+    if state.get('R_built') != R_built:
+        return {}
+    return state.get('pkgs', {})
+
+def save_STAGE2_install_state(job_queue, pkg_dep_graph, install_state,
+                              R_built):
+    installed_pkgs = bbs.rlib.get_installed_pkgs(
+                         bbs.rlib.get_lib_paths(BBSvars.r_home))
+    for job in job_queue._jobs:
+        if job.version == None or (job._cmd == None and not job.from_store):
+            continue  # non-target pkg or cached target pkg
+        pkg = job.pkg
+        install_state.pop(pkg, None)
+        if getattr(job.summary, 'status', None) != 'OK':
+            continue
+        installed = installed_pkgs.get(pkg)
+        if installed == None or installed['Version'] != job.version:
+            continue
+        install_state[pkg] = {
+            'Version': job.version,
+            'git_last_commit': installed.get('git_last_commit'),
+            'deps': _get_installed_dep_versions(pkg, pkg_dep_graph,
+                                                installed_pkgs)
+        }
+    path = os.path.join(BBSvars.work_topdir,
+                        BBSutils.STAGE2_install_state_file)
+    f = open(path, 'w')
+    json.dump({'R_built': R_built, 'pkgs': install_state}, f)
+    f.close()
+    return
+
+def _get_installed_dep_versions(pkg, pkg_dep_graph, installed_pkgs):
+    dep_versions = {}
+    for dep in pkg_dep_graph[pkg]:
+        installed = installed_pkgs.get(dep)
+        if installed != None:
+            dep_versions[dep] = installed['Version']
+    return dep_versions
+
+# Return True if the currently installed target package 'pkg' is the same
+# as the package in the meat dir, was installed by STAGE2, and none of its
+# deps changed since then or will be (re-)installed by this run.
+def _target_pkg_is_unchanged(pkg, version, git_last_commit, pkg_dep_graph,
+                             installed_pkgs, install_state, to_install):
+    state = install_state.get(pkg)
+    installed = installed_pkgs.get(pkg)
+    if git_last_commit == None or state == None or installed == None:
+        return False
+    if installed['Version'] != version or state['Version'] != version:
+        return False
+    if installed.get('git_last_commit') != git_last_commit or \
+       state['git_last_commit'] != git_last_commit:
+        return False
+    for dep in pkg_dep_graph[pkg]:
+        if dep in to_install:
+            return False
+    return state['deps'] == _get_installed_dep_versions(pkg, pkg_dep_graph,
+                                                        installed_pkgs)
+
+def _get_git_last_commit(pkg):
+    desc_file = bbs.parse.get_DESCRIPTION_path(pkg)
+    return bbs.parse.parse_DCF(desc_file, merge_records=True,
+                               fields=('git_last_commit', )
+                              ).get('git_last_commit')
+
+# 'outdated_pkgs' is the set of installed non-target packages for which a
+# higher version is available in the non-target repos. Like the non-target
+# packages that are not installed, they get (re-)installed by the queue, in
+# parallel and after their deps.
 def prepare_STAGE2_job_queue(target_pkgs, pkg_dep_graph,
-                             installed_pkgs, out_dir):
+                             installed_pkgs, out_dir, install_state=None,
+                             outdated_pkgs=None):
     print('BBS> Preparing STAGE2 job queue ...', end=' ')
     sys.stdout.flush()
     stage = 'install'
+    if install_state == None:
+        install_state = {}
+    if outdated_pkgs == None:
+        outdated_pkgs = set()
     jobs = []
-    nb_target_pkgs_in_queue = nb_skipped_pkgs = 0
-    for pkg in pkg_dep_graph.keys():
+    nb_target_pkgs_in_queue = nb_skipped_pkgs = nb_cached_pkgs = 0
+    nb_outdated_pkgs = 0
+    # Pkgs that will be (re-)installed by this run.
+    to_install = set()
+    # Queue the jobs in topological order so bbs.jobs._getNextJobToProcess()
+    # finds a job whose deps are all processed near the head of the queue.
+    # This also guarantees that we know whether the deps of a package will
+    # be (re-)installed when we decide whether the package itself needs to
+    # be re-installed. The packages involved in circular deps are queued
+    # last and their deps that come after them are considered to be
+    # (re-)installed.
+    pkgs = pkg_dep_graph.topological_order()
+    to_install.update(pkg for pkg in pkgs if pkg_dep_graph.level(pkg) == None)
+    for pkg in pkgs:
         version = None
         pkgdumps_prefix = pkg + '.' + stage
         pkgdumps = BBSbase.PkgDumps(None, pkgdumps_prefix)
+        git_last_commit = None
         if pkg in target_pkgs:
             version = bbs.parse.get_Version_from_pkgsrctree(pkg)
             cmd = BBSbase.getSTAGE2cmd(pkg, version)
             nb_target_pkgs_in_queue += 1
+            if BBSvars.STAGE2_skip_unchanged:
+                git_last_commit = _get_git_last_commit(pkg)
+                if _target_pkg_is_unchanged(pkg, version, git_last_commit,
+                                            pkg_dep_graph, installed_pkgs,
+                                            install_state, to_install):
+                    cmd = None
+                    nb_cached_pkgs += 1
         else:
-            if pkg in installed_pkgs:
+            if pkg in installed_pkgs and pkg not in outdated_pkgs:
                 cmd = pkgdumps = None
                 nb_skipped_pkgs += 1
             else:
                 cmd = BBSbase.get_install_cmd_for_non_target_pkg(pkg)
+                if pkg in outdated_pkgs:
+                    nb_outdated_pkgs += 1
+        if cmd != None:
+            to_install.add(pkg)
         job = BBSbase.InstallPkg_Job(pkg, version, cmd, pkgdumps, out_dir)
+        if version != None and cmd == None:
+            job.MakeCachedSummary(installed_pkgs[pkg]['Version'],
+                                  git_last_commit)
         jobs.append(job)
     nb_jobs = len(jobs)
     print('OK')
@@ -340,8 +833,8 @@ def prepare_STAGE2_job_queue(target_pkgs, pkg_dep_graph,
     nb_not_needed = len(target_pkgs) - nb_target_pkgs_in_queue
     nb_non_target_pkgs_in_queue = nb_jobs - nb_target_pkgs_in_queue
     nb_non_target_pkgs_to_install = nb_non_target_pkgs_in_queue - \
-                                    nb_skipped_pkgs
-    nb_pkgs_to_install = nb_jobs - nb_skipped_pkgs
+                                    nb_skipped_pkgs - nb_outdated_pkgs
+    nb_pkgs_to_install = nb_jobs - nb_skipped_pkgs - nb_cached_pkgs
     print('BBS> Job summary:')
     print('BBS> | %d (out of %d) target pkgs are not supporting pkgs' % \
           (nb_not_needed, len(target_pkgs)))
@@ -349,14 +842,22 @@ def prepare_STAGE2_job_queue(target_pkgs, pkg_dep_graph,
     print('BBS> |   => they\'re not going in the installation queue')
     print('BBS> | %d pkgs in the installation queue (all supporting pkgs):' % \
           nb_jobs)
-    print('BBS> |   o %d are target pkgs' % nb_target_pkgs_in_queue)
-    print('BBS> |       => will (re-)install them with \'R CMD INSTALL\'')
+    print('BBS> |   o %d are target pkgs:' % nb_target_pkgs_in_queue)
+    print('BBS> |     - %d did not change since their last installation' % \
+          nb_cached_pkgs)
+    print('BBS> |         => won\'t re-install them (job will be skipped and')
+    print('BBS> |            marked as cached in the summary)')
+    print('BBS> |     - %d are new or changed' % \
+          (nb_target_pkgs_in_queue - nb_cached_pkgs))
+    print('BBS> |         => will (re-)install them with \'R CMD INSTALL\'')
     print('BBS> |   o %d are non-target pkgs:' % nb_non_target_pkgs_in_queue)
-    print('BBS> |     - %d are already installed' % nb_skipped_pkgs)
+    print('BBS> |     - %d are already installed and up-to-date' % \
+          nb_skipped_pkgs)
     print('BBS> |         => won\'t re-install them (job will be skipped)')
     print('BBS> |     - %d are not already installed' % \
           nb_non_target_pkgs_to_install)
-    print('BBS> |         => will install them with')
+    print('BBS> |     - %d are installed but outdated' % nb_outdated_pkgs)
+    print('BBS> |         => will (re-)install them with')
     print('BBS> |              install.packages(pkg, repos=non_target_repos,')
     print('BBS> |                               dep=FALSE, ...)')
     print('BBS> | Total nb of packages to install: %d' % nb_pkgs_to_install)
@@ -365,6 +866,78 @@ def prepare_STAGE2_job_queue(target_pkgs, pkg_dep_graph,
     job_queue._nb_pkgs_to_install = nb_pkgs_to_install
     return job_queue
 
+# Install the packages in the STAGE2 job queue that are in the package store
+# (see bbs/pkgstore.py) from the store instead of compiling them. The jobs
+# are in topological order so we know the version that each dep will have
+# after STAGE2 when we compute the key of a package.
+def install_STAGE2_pkgs_from_store(job_queue, pkg_dep_graph, installed_pkgs,
+                                   available_versions, pkg_store,
+                                   R_signature):
+    print('BBS> Installing pkgs from package store %s ...' % pkg_store.path,
+          end=' ')
+    sys.stdout.flush()
+    lib_path = bbs.rlib.get_lib_paths(BBSvars.r_home)[0]
+    versions = {pkg: desc['Version'] for pkg, desc in installed_pkgs.items()}
+    nb_from_store = 0
+    for job in job_queue._jobs:
+        if job._cmd == None:
+            continue
+        pkg = job.pkg
+        git_last_commit = None
+        if job.version != None:
+            version = job.version
+            git_last_commit = _get_git_last_commit(pkg)
+        elif available_versions != None and pkg in available_versions:
+            version = '.'.join(str(x) for x in available_versions[pkg])
+        else:
+            version = None
+        versions[pkg] = version
+        if version == None:
+            continue
+        dep_versions = {dep: versions.get(dep) for dep in pkg_dep_graph[pkg]}
+        key = bbs.pkgstore.make_key(pkg, version, R_signature, dep_versions,
+                                    git_last_commit)
+        if not pkg_store.materialize(key, pkg, lib_path):
+            continue
+        job._cmd = None
+        job.MakeFromStoreSummary(version, pkg_store.path)
+        nb_from_store += 1
+    job_queue._nb_pkgs_to_install -= nb_from_store
+    print('OK (%d pkgs installed)' % nb_from_store)
+    sys.stdout.flush()
+    return
+
+# Add the packages compiled by STAGE2 to the package store.
+def add_STAGE2_pkgs_to_store(job_queue, pkg_dep_graph, pkg_store,
+                             R_signature):
+    print('BBS> Adding pkgs to package store %s ...' % pkg_store.path, end=' ')
+    sys.stdout.flush()
+    installed_pkgs = bbs.rlib.get_installed_pkgs(
+                         bbs.rlib.get_lib_paths(BBSvars.r_home))
+    nb_added = 0
+    for job in job_queue._jobs:
+        if job._cmd == None or getattr(job.summary, 'status', None) != 'OK':
+            continue
+        pkg = job.pkg
+        installed = installed_pkgs.get(pkg)
+        if installed == None or installed['Version'] == None:
+            continue
+        git_last_commit = None
+        if job.version != None:
+            git_last_commit = installed.get('git_last_commit')
+        dep_versions = {dep: installed_pkgs[dep]['Version']
+                             if dep in installed_pkgs else None
+                        for dep in pkg_dep_graph[pkg]}
+        key = bbs.pkgstore.make_key(pkg, installed['Version'], R_signature,
+                                    dep_versions, git_last_commit)
+        pkg_path = os.path.join(installed['LibPath'], pkg)
+        if pkg_store.add(key, pkg, pkg_path):
+            nb_added += 1
+    nb_evicted = pkg_store.evict()
+    print('OK (%d pkgs added, %d evicted)' % (nb_added, nb_evicted))
+    sys.stdout.flush()
+    return
+
 def STAGE2_loop(job_queue, nb_cpu, out_dir):
     print('BBS> BEGIN STAGE2 loop.')
     t1 = time.time()
@@ -372,13 +945,21 @@ def STAGE2_loop(job_queue, nb_cpu, out_dir):
         rdir = BBSvars.install_rdir
         products_push_cmd = make_products_push_cmd(out_dir, rdir)
         products_push_log = os.path.join(products_out_buf, 'install-push.log')
+        push_batch_size = bbs.rdir.push_batch_size(rdir.transfer_rate_key())
     else:
         products_push_cmd = products_push_log = None
+        push_batch_size = None
     nb_installed = bbs.jobs.processJobQueue(job_queue, nb_cpu,
                                             BBSvars.INSTALL_timeout,
                                             products_push_cmd,
                                             products_push_log,
-                                            verbose=True)
+                                            verbose=True,
+                                            products_push_batch_size=push_batch_size,
+                                            cpu_broker=cpu_broker,
+                                           cpu_pinning=BBSvars.pin_jobs_to_cpus,
+                                           job_tmpdirs=job_tmpdirs)
+    ## Wait for the products sent thru the ingest channel (if any).
+    bbs.rdir.flush_ingest_channels(True)
     dt = time.time() - t1
     print('BBS> END STAGE2 loop.')
     nb_jobs = len(job_queue._jobs)
@@ -408,7 +989,7 @@ def STAGE2():
         out_dir = BBSvars.install_rdir
 
     meat_path = BBSvars.meat_path
-    BBSvars.MEAT0_rdir.syncLocalDir(meat_path, True)
+    sync_local_dir(BBSvars.MEAT0_rdir, meat_path)
     if BBSvars.MEAT0_type == 2:
         srcpkg_files = bbs.fileutils.listSrcPkgFiles(meat_path)
         for srcpkg_file in srcpkg_files:
@@ -418,7 +999,7 @@ def STAGE2():
 
     print('BBS> [STAGE2] cd BBS_WORK_TOPDIR/gitlog')
     gitlog_path = BBSutils.getenv('BBS_GITLOG_PATH')
-    BBSvars.GITLOG_rdir.syncLocalDir(gitlog_path, True)
+    sync_local_dir(BBSvars.GITLOG_rdir, gitlog_path)
 
     print('BBS> [STAGE2] cd BBS_WORK_TOPDIR/STAGE2_tmp')
     STAGE2_tmp = os.path.join(BBSvars.work_topdir, 'STAGE2_tmp')
@@ -432,21 +1013,30 @@ def STAGE2():
     #  BBSvars.buildtype == 'bioc'):
     #    CreateREnvironFiles()
 
-    if BBSvars.buildtype in ['bioc', 'bioc-testing']:
-        # Update non-target packages.
+    # Extract list of target packages.
+    target_pkgs = get_list_of_target_pkgs()
+
+    # Get 'pkg_dep_graph' and 'installed_pkgs'.
+    pkg_dep_graph, available_versions = build_pkg_dep_graph(target_pkgs)
+    update_non_target_pkgs = BBSvars.buildtype in ['bioc', 'bioc-testing']
+    if update_non_target_pkgs and available_versions == None:
+        # We don't know which non-target packages are outdated so we
+        # update all of them before we install the target packages.
         print('BBS> [STAGE2] Update non-target packages (1st run) ...', end=' ')
         sys.stdout.flush()
         cmd = BBSbase.get_update_cmd_for_non_target_pkgs()
         bbs.jobs.runJob(cmd, 'updateNonTargetPkgs1.Rout', 3600.0)
         print('OK')
         sys.stdout.flush()
-
-    # Extract list of target packages.
-    target_pkgs = get_list_of_target_pkgs()
-
-    # Get 'pkg_dep_graph' and 'installed_pkgs'.
-    pkg_dep_graph = build_pkg_dep_graph(target_pkgs)
     installed_pkgs = get_installed_pkgs()
+    outdated_pkgs = None
+    if update_non_target_pkgs and available_versions != None:
+        # The outdated non-target packages in the graph will be updated by
+        # the STAGE2 job queue.
+        non_target_pkgs = set(pkg_dep_graph.keys()) - set(target_pkgs)
+        outdated_pkgs = bbs.depgraph.get_outdated_pkgs(non_target_pkgs,
+                                                       installed_pkgs,
+                                                       available_versions)
 
     # Inject additional fields into DESCRIPTION.
     print('BBS> [STAGE2] cd BBS_MEAT_PATH')
@@ -469,17 +1059,42 @@ def STAGE2():
     # Then re-install the supporting packages.
     print('BBS> [STAGE2] Re-install supporting packages')
     os.chdir(meat_path)
+    R_built = bbs.depgraph.get_R_signature(BBSvars.r_home)[1]
+    install_state = load_STAGE2_install_state(R_built)
     job_queue = prepare_STAGE2_job_queue(target_pkgs, pkg_dep_graph,
-                                         installed_pkgs, out_dir)
+                                         installed_pkgs, out_dir,
+                                         install_state, outdated_pkgs)
+    pkg_store = None
+    if BBSvars.pkg_store_path != None and R_built != None:
+        pkg_store = bbs.pkgstore.PkgStore(BBSvars.pkg_store_path,
+                                          BBSvars.pkg_store_max_size)
+        makefiles = [get_Makeconf_path(), bbs.ccache.get_user_Makevars()]
+        R_signature = bbs.pkgstore.get_R_signature(BBSvars.r_home, R_built,
+                                                   makefiles)
+        install_STAGE2_pkgs_from_store(job_queue, pkg_dep_graph,
+                                       installed_pkgs, available_versions,
+                                       pkg_store, R_signature)
+    add_compiler_cache_statslogs(job_queue)
     STAGE2_loop(job_queue, BBSvars.install_nb_cpu, out_dir)
+    save_STAGE2_install_state(job_queue, pkg_dep_graph, install_state,
+                              R_built)
+    if pkg_store != None:
+        add_STAGE2_pkgs_to_store(job_queue, pkg_dep_graph, pkg_store,
+                                 R_signature)
 
     print('BBS> [STAGE2] cd BBS_WORK_TOPDIR/STAGE2_tmp')
     os.chdir(STAGE2_tmp)
 
-    if BBSvars.buildtype in ['bioc', 'bioc-testing']:
-        # Try again to update non-target packages (some updates could have
-        # failed in the previous attempt because of dependency issues).
-        print('BBS> [STAGE2] Update non-target packages (2nd run) ...', end=' ')
+    if update_non_target_pkgs:
+        # If the outdated non-target packages in the graph were updated by
+        # the STAGE2 job queue, this only updates the non-target packages
+        # that are not in the graph. Otherwise, this is a 2nd attempt for
+        # the updates that failed in the 1st run because of dependency
+        # issues.
+        if outdated_pkgs == None:
+            print('BBS> [STAGE2] Update non-target packages (2nd run) ...', end=' ')
+        else:
+            print('BBS> [STAGE2] Update remaining non-target packages ...', end=' ')
         sys.stdout.flush()
         cmd = BBSbase.get_update_cmd_for_non_target_pkgs()
         bbs.jobs.runJob(cmd, 'updateNonTargetPkgs2.Rout', 3600.0)
@@ -487,6 +1102,7 @@ def STAGE2():
         sys.stdout.flush()
 
     makeNodeInfo()
+    report_compiler_cache_stats(job_queue)
 
     print('BBS> [STAGE2] DONE at %s.' % time.asctime())
     return
@@ -513,6 +1129,7 @@ def prepare_STAGE3_job_queue(pkgsrctrees, out_dir):
             pkgdumps_prefix = pkg + '.' + stage
             pkgdumps = BBSbase.PkgDumps(srcpkg_file, pkgdumps_prefix)
             job = BBSbase.BuildPkg_Job(pkg, version, cmd, pkgdumps, out_dir)
+            job.nb_cores = bbs.parse.get_BBSoption_int(pkgsrctree, 'NbCores', 1)
             jobs.append(job)
     print("OK")
     sys.stdout.flush()
@@ -527,13 +1144,21 @@ def STAGE3_loop(job_queue, nb_cpu, out_dir):
         rdir = BBSvars.buildsrc_rdir
         products_push_cmd = make_products_push_cmd(out_dir, rdir)
         products_push_log = os.path.join(products_out_buf, 'buildsrc-push.log')
+        push_batch_size = bbs.rdir.push_batch_size(rdir.transfer_rate_key())
     else:
         products_push_cmd = products_push_log = None
+        push_batch_size = None
     nb_products = bbs.jobs.processJobQueue(job_queue, nb_cpu,
                                            BBSvars.BUILD_timeout,
                                            products_push_cmd,
                                            products_push_log,
-                                           verbose=True)
+                                           verbose=True,
+                                           products_push_batch_size=push_batch_size,
+                                           cpu_broker=cpu_broker,
+                                           cpu_pinning=BBSvars.pin_jobs_to_cpus,
+                                           job_tmpdirs=job_tmpdirs)
+    ## Wait for the products sent thru the ingest channel (if any).
+    bbs.rdir.flush_ingest_channels(True)
     dt = time.time() - t1
     print("BBS> END STAGE3 loop.")
     nb_jobs = len(job_queue._jobs)
@@ -570,11 +1195,13 @@ def STAGE3():
         for pkg in target_pkgs:
             rdir = BBSvars.MEAT0_rdir.subdir(pkg)
             local_dir = os.path.join(meat_path, pkg)
-            rdir.syncLocalDir(local_dir, True)
+            sync_local_dir(rdir, local_dir)
     else:
         os.chdir(meat_path)
     job_queue = prepare_STAGE3_job_queue(target_pkgs, out_dir)
+    add_compiler_cache_statslogs(job_queue)
     STAGE3_loop(job_queue, BBSvars.buildsrc_nb_cpu, out_dir)
+    report_compiler_cache_stats(job_queue)
     print("BBS> [STAGE3] DONE at %s." % time.asctime())
     return
 
@@ -596,6 +1223,7 @@ def prepare_STAGE4_job_queue(srcpkg_paths, out_dir):
         pkgdumps_prefix = pkg + '.' + stage
         pkgdumps = BBSbase.PkgDumps(Rcheck_dir, pkgdumps_prefix)
         job = BBSbase.CheckSrc_Job(pkg, version, cmd, pkgdumps, out_dir)
+        job.nb_cores = bbs.parse.get_BBSoption_int(pkg, 'NbCores', 1)
         jobs.append(job)
     print("OK")
     sys.stdout.flush()
@@ -610,13 +1238,21 @@ def STAGE4_loop(job_queue, nb_cpu, out_dir):
         rdir = BBSvars.checksrc_rdir
         products_push_cmd = make_products_push_cmd(out_dir, rdir)
         products_push_log = os.path.join(products_out_buf, 'checksrc-push.log')
+        push_batch_size = bbs.rdir.push_batch_size(rdir.transfer_rate_key())
     else:
         products_push_cmd = products_push_log = None
+        push_batch_size = None
     bbs.jobs.processJobQueue(job_queue, nb_cpu,
                              BBSvars.CHECK_timeout,
                              products_push_cmd,
                              products_push_log,
-                             verbose=True)
+                             verbose=True,
+                             products_push_batch_size=push_batch_size,
+                             cpu_broker=cpu_broker,
+                             cpu_pinning=BBSvars.pin_jobs_to_cpus,
+                             job_tmpdirs=job_tmpdirs)
+    ## Wait for the products sent thru the ingest channel (if any).
+    bbs.rdir.flush_ingest_channels(True)
     dt = time.time() - t1
     print("BBS> END STAGE4 loop.")
     nb_jobs = len(job_queue._jobs)
@@ -642,7 +1278,9 @@ def STAGE4():
     os.chdir(BBSvars.meat_path)
     srcpkg_paths = getSrcPkgFilesFromSuccessfulSTAGE3("CHECK")
     job_queue = prepare_STAGE4_job_queue(srcpkg_paths, out_dir)
+    add_compiler_cache_statslogs(job_queue)
     STAGE4_loop(job_queue, BBSvars.checksrc_nb_cpu, out_dir)
+    report_compiler_cache_stats(job_queue)
     print("BBS> [STAGE4] DONE at %s." % time.asctime())
     return
 
@@ -679,13 +1317,21 @@ def STAGE5_loop(job_queue, nb_cpu, out_dir):
         rdir = BBSvars.buildbin_rdir
         products_push_cmd = make_products_push_cmd(out_dir, rdir)
         products_push_log = os.path.join(products_out_buf, 'buildbin-push.log')
+        push_batch_size = bbs.rdir.push_batch_size(rdir.transfer_rate_key())
     else:
         products_push_cmd = products_push_log = None
+        push_batch_size = None
     nb_products = bbs.jobs.processJobQueue(job_queue, nb_cpu,
                                            BBSvars.BUILDBIN_timeout,
                                            products_push_cmd,
                                            products_push_log,
-                                           verbose=True)
+                                           verbose=True,
+                                           products_push_batch_size=push_batch_size,
+                                           cpu_broker=cpu_broker,
+                                           cpu_pinning=BBSvars.pin_jobs_to_cpus,
+                                           job_tmpdirs=job_tmpdirs)
+    ## Wait for the products sent thru the ingest channel (if any).
+    bbs.rdir.flush_ingest_channels(True)
     dt = time.time() - t1
     print("BBS> END STAGE5 loop.")
     nb_jobs = len(job_queue._jobs)
@@ -753,10 +1399,15 @@ if __name__ == "__main__":
     stages = stages_to_run(sys.argv)
     print()
     print("BBS> ==============================================================")
+    bbs.fileutils.reap_trash()
     if stages in ["all", "all-no-bin"]:
         BBSvars.Node_rdir.RemakeMe(True)
         if asynchronous_mode:
             bbs.fileutils.remake_dir(products_out_buf, ignore_errors=True)
+    load_meat_snapshot()
+    set_up_compiler_cache()
+    set_up_cpu_broker()
+    set_up_job_tmpdirs()
     ticket = []
     ## STAGE2: preinstall dependencies
     if stages in ["all", "all-no-bin"] or "STAGE2" in stages:
@@ -790,4 +1441,6 @@ if __name__ == "__main__":
         dt = time.time() - t1
         ended_at = bbs.jobs.currentDateString()
         ticket.append(('STAGE5', BBSvars.nb_cpu, started_at, ended_at, dt))
+    close_cpu_broker()
+    print_background_task_times()
     write_BBS_EndOfRun_ticket(ticket)
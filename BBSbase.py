@@ -15,6 +15,7 @@ import bbs.fileutils
 import bbs.parse
 import bbs.jobs
 import bbs.rdir
+import bbs.ccache
 import BBSutils
 import BBSvars
 
@@ -131,19 +132,7 @@ def _clean_Rcheck_dir(Rcheck_dir, pkg):
 ##############################################################################
 
 def _get_prepend_from_BBSoptions(pkgsrctree, key_prefix):
-    key = key_prefix + 'prepend'
-    prepend = bbs.parse.get_BBSoption_from_pkgsrctree(pkgsrctree, key)
-    if sys.platform == 'win32':
-        key2 = key + '.win'
-        prepend_win = bbs.parse.get_BBSoption_from_pkgsrctree(pkgsrctree, key2)
-        if prepend_win != None:
-            prepend = prepend_win
-    elif sys.platform == 'darwin':
-        key2 = key + '.mac'
-        prepend_mac = bbs.parse.get_BBSoption_from_pkgsrctree(pkgsrctree, key2)
-        if prepend_mac != None:
-            prepend = prepend_mac
-    return prepend
+    return bbs.parse.get_BBSoption_prepend(pkgsrctree, key_prefix)
 
 def _BiocGreaterThanOrEqualTo(x, y):
     # If 'BBSvars.bioc_version' is not defined, then we assume it's the
@@ -157,16 +146,10 @@ def _BiocGreaterThanOrEqualTo(x, y):
 
 def _noExampleArchs(pkgsrctree):
     archs = []
-    no_examples = bbs.parse.get_BBSoption_from_pkgsrctree(
-                                pkgsrctree,
-                                'NoExamplesOnPlatforms')
-    if no_examples == None:
+    no_examples = bbs.parse.get_BBSoption_platforms(pkgsrctree,
+                                                    'NoExamplesOnPlatforms')
+    if len(no_examples) == 0:
         return archs
-    no_examples = no_examples.replace(" ", "").split(",")
-    clean = []
-    for item in no_examples:
-        clean.append(item.strip())
-    no_examples = clean
     if 'mac' in no_examples:
         archs.append('darwin')
     if 'win' in no_examples:
@@ -185,13 +168,8 @@ def _noExampleArchs(pkgsrctree):
 
 def _supportedWinArchs(pkgsrctree):
     archs = []
-    unsupported = bbs.parse.get_BBSoption_from_pkgsrctree(
-                                pkgsrctree,
-                                'UnsupportedPlatforms')
-    if unsupported == None:
-        unsupported = []
-    else:
-        unsupported = unsupported.replace(" ", "").split(",")
+    unsupported = bbs.parse.get_BBSoption_platforms(pkgsrctree,
+                                                    'UnsupportedPlatforms')
     if "win" in unsupported:
         return archs
     if 'win32' not in unsupported:
@@ -511,6 +489,9 @@ def getSTAGE5cmd(srcpkg_path):
 ## there!
 ## The magic bullet is to use rsync to copy stuff locally. Sounds overkill
 ## but it seems to work no matter what.
+## On other platforms, we use bbs.fileutils.clone_file() which only copies
+## the metadata when the filesystem supports reflinks (or copy_file_range),
+## and falls back to a regular copy otherwise.
 def copy_the_damned_thing_no_matter_what(src, destdir):
     bbs.rdir.set_readable_flag(src)
     if sys.platform == 'win32':
@@ -530,9 +511,9 @@ def copy_the_damned_thing_no_matter_what(src, destdir):
         sys.stdout.flush()
         if os.path.isdir(src):
             dst = os.path.join(destdir, os.path.basename(src))
-            shutil.copytree(src, dst)
+            bbs.fileutils.clone_tree(src, dst)
         else:
-            shutil.copy2(src, destdir)
+            bbs.fileutils.clone_file(src, destdir)
         print("OK")
         sys.stdout.flush()
     return
@@ -599,6 +580,29 @@ class Summary:
         return
 
 
+### Append the hit rate of the compiler cache to the summary of a job that
+### was run with a ccache stats log (see bbs/ccache.py). Nothing is appended
+### if the job didn't compile anything.
+def _appendCompilerCacheStats(job):
+    if job.ccache_statslog == None:
+        return
+    nb_hits, nb_misses = bbs.ccache.read_statslog(job.ccache_statslog)
+    if nb_hits + nb_misses == 0:
+        return
+    job.summary.Append('CompilerCacheHits',
+                       bbs.ccache.format_hit_rate(nb_hits, nb_misses))
+    return
+
+### Record how much space the job used in its private temporary dir (see
+### bbs.jobs.JobTmpDirs).
+def _appendTmpDirUsage(job):
+    if job._tmpdir_peak_size == None:
+        return
+    job.summary.Append('TmpDirPeakSize',
+                       bbs.fileutils.human_readable_size(job._tmpdir_peak_size))
+    return
+
+
 ##############################################################################
 ### CORE FUNCTIONS: Called by the STAGE<N>_loop() functions (N=2,3,4,5).
 ##############################################################################
@@ -618,8 +622,17 @@ class InstallPkg_Job(bbs.jobs.QueuedJob):
         self.pkgdumps = pkgdumps
         self.out_dir = out_dir
         self.summary = Summary(pkg, version, cmd)
+        self.ccache_statslog = None
+        self._output_analysis = None
+        self.from_store = False
+    def _analyzeOutput(self):
+        ## processJobQueue() calls RerunMe() right before AfterRun() so
+        ## RerunMe() does the analysis and AfterRun() reuses it.
+        self._output_analysis = bbs.parse.analyzeInstallOutput(
+                                    self._output_file, self.pkg)
+        return self._output_analysis
     def RerunMe(self):
-        locking_pkg = bbs.parse.extractLockingPackage(self._output_file)
+        locking_pkg = self._analyzeOutput()['locking_pkg']
         ## We re-run only if the lock was on one of the deps, but not on the
         ## package itself.
         rerun_me = locking_pkg != None and locking_pkg != self.pkg
@@ -628,12 +641,16 @@ class InstallPkg_Job(bbs.jobs.QueuedJob):
         self.summary.started_at = self._started_at
         self.summary.ended_at = self._ended_at
         self.summary.dt = self._t2 - self._t1
+        _appendCompilerCacheStats(self)
+        _appendTmpDirUsage(self)
         self.summary.Write(self.pkgdumps.summary_file)
         self.pkgdumps.Push(self.out_dir)
     def AfterRun(self):
         self.summary.retcode = self._retcode
-        if self._retcode == 0 and \
-           bbs.parse.installPkgWasOK(self._output_file, self.pkg):
+        analysis = self._output_analysis
+        if analysis == None:
+            analysis = self._analyzeOutput()
+        if self._retcode == 0 and analysis['ok']:
             self.summary.status = 'OK'
             cumul_inc = 1
         else:
@@ -645,6 +662,37 @@ class InstallPkg_Job(bbs.jobs.QueuedJob):
         self.summary.retcode = None
         self.summary.status = 'TIMEOUT'
         self._MakeSummary()
+    ## For a target package that is not re-installed because it didn't
+    ## change since its last installation (the job must have no command).
+    ## We still produce the output and summary files so the package gets
+    ## an INSTALL status in the report.
+    def MakeCachedSummary(self, installed_version, git_last_commit):
+        self._MakeSkippedSummary(
+            'Package %s (version %s, git_last_commit %s) and its deps '
+            'did not change since its last installation\n'
+            '=> re-installation skipped\n' % \
+            (self.pkg, installed_version, git_last_commit))
+    ## For a package that was installed from the shared package store (see
+    ## bbs/pkgstore.py) instead of being compiled (the job must have no
+    ## command).
+    def MakeFromStoreSummary(self, version, store_path):
+        self.from_store = True
+        self._MakeSkippedSummary(
+            'Package %s (version %s) was built by a previous run\n'
+            '=> installed from package store %s\n' % \
+            (self.pkg, version, store_path))
+    def _MakeSkippedSummary(self, msg):
+        out = open(self._output_file, 'w')
+        out.write(msg)
+        out.close()
+        self.summary.started_at = self.summary.ended_at = \
+            bbs.jobs.currentDateString()
+        self.summary.dt = 0.0
+        self.summary.retcode = 0
+        self.summary.status = 'OK'
+        self.summary.Append('Cached', 'TRUE')
+        self.summary.Write(self.pkgdumps.summary_file)
+        self.pkgdumps.Push(self.out_dir)
 
 class BuildPkg_Job(bbs.jobs.QueuedJob):
     def __init__(self, pkg, version, cmd, pkgdumps, out_dir):
@@ -658,10 +706,13 @@ class BuildPkg_Job(bbs.jobs.QueuedJob):
         self.pkgdumps = pkgdumps
         self.out_dir = out_dir
         self.summary = Summary(pkg, version, cmd)
+        self.ccache_statslog = None
     def _MakeSummary(self):
         self.summary.started_at = self._started_at
         self.summary.ended_at = self._ended_at
         self.summary.dt = self._t2 - self._t1
+        _appendCompilerCacheStats(self)
+        _appendTmpDirUsage(self)
         pkg_file = self.pkgdumps.product_path
         if os.path.exists(pkg_file):
             pkg_file_size = bbs.fileutils.human_readable_size(bbs.fileutils.total_size(pkg_file), True)
@@ -710,6 +761,7 @@ class CheckSrc_Job(bbs.jobs.QueuedJob):
         self.pkgdumps = pkgdumps
         self.out_dir = out_dir
         self.summary = Summary(pkg, version, cmd)
+        self.ccache_statslog = None
         self.warnings = 'NA'
         #NOT NEEDED. '00install.out' is under the '<pkg>.Rcheck' dir
         #and we already push this dir to self.out_dir as part of self.pkgdumps
@@ -718,9 +770,12 @@ class CheckSrc_Job(bbs.jobs.QueuedJob):
         self.summary.started_at = self._started_at
         self.summary.ended_at = self._ended_at
         self.summary.dt = self._t2 - self._t1
+        _appendCompilerCacheStats(self)
+        _appendTmpDirUsage(self)
         Rcheck_dir = self.pkgdumps.product_path
         if os.path.exists(Rcheck_dir):
-            _clean_Rcheck_dir(Rcheck_dir, self.pkg)
+            bbs.jobs.runInBackground('Rcheck dir cleanup', _clean_Rcheck_dir,
+                                     Rcheck_dir, self.pkg)
         else:
             Rcheck_dir = 'None'
         self.summary.Append('CheckDir', Rcheck_dir)
@@ -12,6 +12,9 @@ import string
 import urllib.request
 
 import bbs.parse
+import bbs.dcfstore
+import bbs.statusdb
+import bbs.depgraph
 import BBSutils
 import BBSvars
 
@@ -188,6 +191,13 @@ def ncol_to_display(buildtype):
 BUILD_STATUS_DB_file = 'BUILD_STATUS_DB.txt'
 PROPAGATION_STATUS_DB_file = 'PROPAGATION_STATUS_DB.txt'
 
+### The history of the statuses (see bbs/statusdb.py). Must be outside
+### BBS_CENTRAL_RDIR because the latter is remade at the beginning of each run.
+BUILD_STATUS_HISTORY_DB_file = BBSutils.getenv('BBS_BUILD_STATUS_HISTORY_DB',
+                                   False,
+                                   os.path.join(BBSvars.work_topdir,
+                                                'BUILD_STATUS_HISTORY.sqlite'))
+
 
 ##############################################################################
 
@@ -213,20 +223,22 @@ def map_outgoing_node_to_package_type(node):
         return None
     return map[node]
 
+### 'dcf' can be a file-like object or a bbs.dcfstore.IndexedDCF object.
 def get_status(dcf, pkg, node_id, stage):
     key = '%s#%s#%s' % (pkg, node_id, stage)
+    if isinstance(dcf, bbs.dcfstore.IndexedDCF):
+        return dcf.get(key)
     status = bbs.parse.get_next_DCF_val(dcf, key, full_line=True)
     return status
 
 def get_propagation_status_from_db(pkg, node_id):
     try:
-        dcf = open(PROPAGATION_STATUS_DB_file, 'rb')
+        db = bbs.dcfstore.open_indexed_DCF(PROPAGATION_STATUS_DB_file)
     except FileNotFoundError:
         return None
-    status = get_status(dcf, pkg,
+    status = get_status(db, pkg,
                         map_outgoing_node_to_package_type(node_id),
                         'propagate')
-    dcf.close()
     return status
 
 def WReadDcfVal(rdir, file, field, full_line=False):
@@ -237,11 +249,22 @@ def WReadDcfVal(rdir, file, field, full_line=False):
 
 ### Get vcs metadata for Rpacks/ or Rpacks/pkg/
 def get_vcs_meta(pkg, key):
+    ## Try the package metadata snapshot first (if loaded).
+    vcs = bbs.parse.get_vcs_meta_from_pkg_snapshot(pkg)
+    if vcs != None and key in vcs:
+        return vcs[key]
     Central_rdir = BBSvars.Central_rdir
     file = BBSvars.vcsmeta_file
     if pkg != None:
         file = "-%s.".join(file.rsplit(".", 1)) % pkg
-    val = WReadDcfVal(Central_rdir, file, key, True)
+    if Central_rdir.path != None and \
+       (Central_rdir.host == None or Central_rdir.host == 'localhost'):
+        ## The report is generated on the central node so we can access the
+        ## file directly (this is what Central_rdir.WOpen() would do anyway).
+        path = os.path.join(Central_rdir.path, file)
+        val = bbs.dcfstore.open_indexed_DCF(path).get(key)
+    else:
+        val = WReadDcfVal(Central_rdir, file, key, True)
     if val == None:
         raise bbs.parse.DcfFieldNotFoundError(file, key)
     return val
@@ -265,6 +288,7 @@ def _get_pkg_status_from_BUILD_STATUS_DB(BUILD_STATUS_DB, pkg, node_id, stage):
     return BUILD_STATUS_DB[key]
 
 _build_status_db = {}
+_build_status_history_db = None
 
 def _set_pkg_status(pkg, node_id, stage, status):
     if pkg not in _build_status_db:
@@ -352,6 +376,19 @@ def import_BUILD_STATUS_DB(allpkgs):
                                    node.node_id, stage, status)
     return allpkgs_quickstats
 
+### Number of consecutive runs (including the current one) for which the
+### package failed at the specified stage on the node. Return None if the
+### history DB is not available.
+def get_nb_consecutive_failures(pkg, node_id, stage):
+    if not os.path.exists(BUILD_STATUS_HISTORY_DB_file):
+        return None
+    global _build_status_history_db
+    if _build_status_history_db == None:
+        _build_status_history_db = bbs.statusdb.BuildStatusDB(
+                                       BUILD_STATUS_HISTORY_DB_file)
+    return _build_status_history_db.nb_consecutive_failures(pkg, node_id,
+                                                            stage)
+
 def get_pkg_status(pkg, node_id, stage):
     if len(_build_status_db) == 0:
         sys.exit("You must import package statuses with " + \
@@ -381,22 +418,12 @@ def get_distinct_pkg_statuses(pkg, nodes=None):
 ##############################################################################
 
 ### Only report reverse deps that are **within** 'pkgs'.
+### 'pkg_dep_graph' can be a bbs.depgraph.PkgDepGraph object or a dict as
+### returned by bbs.parse.load_pkg_dep_graph().
 def get_inner_reverse_deps(pkgs, pkg_dep_graph):
-    inner_rev_deps = {}
-    for pkg in pkgs:
-        inner_rev_deps[pkg] = []
-    for pkg in pkg_dep_graph.keys():
-        if pkg not in pkgs:
-            continue
-        pkg_direct_deps = pkg_dep_graph[pkg]
-        for pkg_direct_dep in pkg_direct_deps:
-            if pkg_direct_dep not in pkgs or \
-               pkg in inner_rev_deps[pkg_direct_dep]:
-                continue
-            inner_rev_deps[pkg_direct_dep].append(pkg)
-    for pkg in pkgs:
-        inner_rev_deps[pkg].sort(key=str.lower)
-    return inner_rev_deps
+    if not isinstance(pkg_dep_graph, bbs.depgraph.PkgDepGraph):
+        pkg_dep_graph = bbs.depgraph.PkgDepGraph(pkg_dep_graph)
+    return pkg_dep_graph.inner_reverse_deps(pkgs)
 
 def compute_quickstats(pkgs):
     quickstats = _zero_quickstats()
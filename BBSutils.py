@@ -76,8 +76,11 @@ debug.is_on = int(getenv('BBS_DEBUG', False, "0")) != 0
 ##############################################################################
 
 meat_index_file = 'meat-index.dcf'
+meat_snapshot_file = 'meat-snapshot.json'
 skipped_index_file = 'skipped-index.dcf'
 pkg_dep_graph_file = 'pkg_dep_graph.txt'
+pkg_dep_graph_cache_file = 'pkg_dep_graph-cache.json'
+STAGE2_install_state_file = 'STAGE2-install-state.json'
 
 #sys.path.append(os.path.join(BBS_home, "nodes"))
 import nodes.nodespecs
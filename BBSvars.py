@@ -10,6 +10,7 @@ import sys
 import os
 
 import bbs.rdir
+import bbs.ingest
 import bbs.jobs
 import BBSutils
 
@@ -102,6 +103,8 @@ MEAT0_rdir = bbs.rdir.RemoteDir('BBS_MEAT0_RDIR',
 meat_path = BBSutils.getenv('BBS_MEAT_PATH')
 
 work_topdir = BBSutils.getenv('BBS_WORK_TOPDIR')
+### Rolling estimates of the throughput to each remote (persisted across runs).
+bbs.rdir.transfer_rates_file = os.path.join(work_topdir, 'transfer-rates.dcf')
 transmission_mode = BBSutils.getenv('BBS_PRODUCT_TRANSMISSION_MODE', False)
 
 r_home = BBSutils.getenv('BBS_R_HOME')
@@ -139,6 +142,14 @@ if node_hostname.lower() != hostname0.lower():
     sys.exit("==> EXIT")
 
 node_id = BBSutils.getenv('BBS_NODE_ID', False, node_hostname)
+### With BBS_PRODUCT_TRANSMISSION_MODE set to "ingest", the products are
+### sent to the central node thru the ingest server (see bbs/ingest.py)
+### instead of rsync+ssh. The server must be serving BBS_CENTRAL_RDIR.
+if transmission_mode == 'ingest':
+    ingest_port = int(BBSutils.getenv('BBS_INGEST_PORT', False,
+                                      str(bbs.ingest.default_port)))
+    products_in_rdir = bbs.rdir.IngestRemoteDir.from_RemoteDir(
+                           products_in_rdir, central_rdir_path, ingest_port)
 Node_rdir = products_in_rdir.subdir(node_id)
 install_rdir = Node_rdir.subdir('install')
 buildsrc_rdir = Node_rdir.subdir('buildsrc')
@@ -160,6 +171,70 @@ checksrc_nb_cpu = int(checksrc_nb_cpu)
 
 dont_push_srcpkgs = int(BBSutils.getenv('DONT_PUSH_SRCPKGS', False, "0")) != 0
 
+## Set to 0 to re-install all the target packages in STAGE2, even those that
+## didn't change since their last installation.
+STAGE2_skip_unchanged = int(BBSutils.getenv('BBS_STAGE2_SKIP_UNCHANGED_PKGS',
+                                            False, "1")) != 0
+
+## Path to a store of installed packages shared by the builds running on
+## this node (see bbs/pkgstore.py). STAGE2 adds the packages it installs to
+## the store and installs the packages found in the store instead of
+## compiling them. Not set by default (i.e. no store).
+pkg_store_path = BBSutils.getenv('BBS_PKG_STORE_PATH', False)
+pkg_store_max_size = float(BBSutils.getenv('BBS_PKG_STORE_MAX_SIZE_GB',
+                                           False, "50")) * 1024**3
+
+## Path to the compiler cache (ccache) used by STAGE2, STAGE3, and STAGE4
+## (see bbs/ccache.py). Not set by default (i.e. no compiler cache).
+ccache_dir = BBSutils.getenv('BBS_CCACHE_DIR', False)
+ccache_cmd = BBSutils.getenv('BBS_CCACHE_CMD', False, 'ccache')
+ccache_max_size = BBSutils.getenv('BBS_CCACHE_MAXSIZE', False, '20G')
+
+## Path to a CPU broker shared by the builds running on this node (see
+## bbs/cpubroker.py). When set, the jobs started by BBS-run.py take a CPU
+## token from the broker, so the builds running concurrently on the node
+## don't use more than BBS_CPU_BROKER_NB_CPU cores in total (all the builds
+## must use the same value). Each build gets a share of the tokens that is
+## proportional to its BBS_CPU_BROKER_WEIGHT, and can use more when the
+## other builds are idle (but never more than its BBS_NB_CPU, so set
+## BBS_NB_CPU to at least BBS_CPU_BROKER_NB_CPU to let it use all the cores).
+## Not set by default (i.e. no broker).
+cpu_broker_dir = BBSutils.getenv('BBS_CPU_BROKER_DIR', False)
+cpu_broker_nb_cpu = BBSutils.getenv('BBS_CPU_BROKER_NB_CPU', False)
+if cpu_broker_nb_cpu != None:
+    cpu_broker_nb_cpu = int(cpu_broker_nb_cpu)
+cpu_broker_weight = float(BBSutils.getenv('BBS_CPU_BROKER_WEIGHT',
+                                          False, "1"))
+
+## Set to 1 to pin the jobs run by BBS-run.py to the CPU set of their slot
+## and limit the nb of threads they can start accordingly (see
+## bbs.jobs.processJobQueue()). Linux only. The NbCores option in
+## .BBSoptions can be used to give more CPUs to some packages.
+pin_jobs_to_cpus = int(BBSutils.getenv('BBS_PIN_JOBS_TO_CPUS',
+                                       False, "0")) != 0
+
+## Path to the dir where the jobs run by BBS-run.py get their private
+## temporary dir (TMPDIR), which is deleted as soon as the job is over (see
+## bbs.jobs.JobTmpDirs). Must not be shared with other builds. Not set by
+## default (i.e. the jobs use the shared temporary dir). If
+## BBS_JOB_TMPDIR_ROOT is on a size-limited tmpfs, set
+## BBS_JOB_TMPDIR_SPILL_ROOT to a dir on disk to use when the tmpfs has less
+## than BBS_JOB_TMPDIR_MIN_FREE_GB available (must not be shared with other
+## builds either).
+job_tmpdir_root = BBSutils.getenv('BBS_JOB_TMPDIR_ROOT', False)
+job_tmpdir_spill_root = BBSutils.getenv('BBS_JOB_TMPDIR_SPILL_ROOT', False)
+job_tmpdir_min_free = float(BBSutils.getenv('BBS_JOB_TMPDIR_MIN_FREE_GB',
+                                            False, "2")) * 1024**3
+
+## BBS_BACKGROUND_NICE, BBS_BACKGROUND_IONICE_CLASS, and
+## BBS_BACKGROUND_IONICE_LEVEL: CPU priority (niceness increment) and I/O
+## priority (ionice class and level, Linux only) of the background work done
+## while the jobs are running (products pushes, cleanup of the Rcheck dirs,
+## etc...). These settings are read directly from the environment by
+## bbs.fileutils.get_background_priorities(), not from here. Not set by
+## default (i.e. the background work runs with the same priorities as the
+## jobs).
+
 GITLOG_rdir = bbs.rdir.RemoteDir('BBS_GITLOG_RDIR',
                 None,
                 BBSutils.getenv('BBS_GITLOG_RDIR'),
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.ccache module
+###
+### Management of the compiler cache (ccache) used by BBS-run.py. The
+### compilers used by R CMD INSTALL (which is also what R CMD build and
+### R CMD check use to install the package) are taken from R's Makeconf
+### file, so we cannot just put ccache in front of them in the PATH. Instead
+### we generate a Makevars file that prefixes them with ccache, and point
+### R_MAKEVARS_USER to it. The Makevars file that R would use otherwise (if
+### any) is included first so its settings are preserved.
+###
+### ccache can write the result of each compilation to a "stats log" file
+### (ccache >= 4.0, see the stats_log setting). We give each job its own
+### stats log so we can report per-package hit rates even though the jobs
+### run in parallel and share the same cache.
+###
+
+import sys
+import os
+import shlex
+import subprocess
+
+### ccache only supports C, C++ and Objective-C/C++ (and runs the compiler
+### directly for the other languages), but we also prefix the Fortran
+### compilers so we get their compilations in the stats logs.
+compiler_vars = ('CC', 'CXX', 'CXX11', 'CXX14', 'CXX17', 'CXX20',
+                 'F77', 'FC')
+
+### Map the Makevars files generated by set_up() to the user Makevars file
+### that they include (or None).
+_generated_Makevars = {}
+
+### The "user Makevars" file that R would use if R_MAKEVARS_USER was not set
+### by us. See ?Rconfig and tools:::makevars_user().
+def get_user_Makevars():
+    path = os.environ.get('R_MAKEVARS_USER')
+    if path in _generated_Makevars:
+        return _generated_Makevars[path]
+    if path != None and path != '':
+        return path
+    path = os.path.join(os.path.expanduser('~'), '.R', 'Makevars')
+    if os.path.isfile(path):
+        return path
+    return None
+
+def write_Makevars(path, ccache_cmd='ccache', user_Makevars=None):
+    with open(path, 'w') as f:
+        f.write('## Generated by BBS-run.py (see bbs/ccache.py)\n')
+        if user_Makevars != None:
+            f.write('-include %s\n' % user_Makevars)
+        for var in compiler_vars:
+            ## Don't prefix twice, or prefix an undefined or empty compiler.
+            f.write('ifneq ($(strip $(%s)),)\n' % var)
+            f.write('ifeq ($(filter ccache,$(notdir $(firstword $(%s)))),)\n' % \
+                    var)
+            f.write('%s := %s $(%s)\n' % (var, ccache_cmd, var))
+            f.write('endif\n')
+            f.write('endif\n')
+    return
+
+### Return the environment variables to set to enable the cache.
+### CCACHE_NOHASHDIR is needed because R CMD INSTALL compiles the packages
+### in temporary dirs with random names. Without it, these names would be
+### part of the hash (because of -g), and we would never get a cache hit.
+def get_environ(cache_dir, max_size, Makevars_path):
+    return {'CCACHE_DIR': cache_dir,
+            'CCACHE_MAXSIZE': max_size,
+            'CCACHE_NOHASHDIR': '1',
+            'R_MAKEVARS_USER': Makevars_path}
+
+### Return False if ccache cannot be found.
+def set_up(cache_dir, max_size, Makevars_path, ccache_cmd='ccache'):
+    try:
+        subprocess.run([ccache_cmd, '--version'], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    os.makedirs(cache_dir, exist_ok=True)
+    user_Makevars = get_user_Makevars()
+    write_Makevars(Makevars_path, ccache_cmd, user_Makevars)
+    _generated_Makevars[Makevars_path] = user_Makevars
+    os.environ.update(get_environ(cache_dir, max_size, Makevars_path))
+    return True
+
+### Return 'cmd' modified so it writes the stats of its compilations to
+### 'statslog'. Unix only.
+def add_statslog_to_cmd(cmd, statslog):
+    return 'CCACHE_STATSLOG=%s; export CCACHE_STATSLOG; %s' % \
+           (shlex.quote(statslog), cmd)
+
+### Return a (nb_hits, nb_misses) tuple. The stats log contains one
+### "# <source file>" line followed by one line per counter that the
+### compilation incremented.
+def read_statslog(statslog):
+    nb_hits = nb_misses = 0
+    try:
+        f = open(statslog, 'r')
+    except OSError:
+        return (0, 0)
+    for line in f:
+        line = line.strip()
+        if line in ('direct_cache_hit', 'preprocessed_cache_hit'):
+            nb_hits += 1
+        elif line == 'cache_miss':
+            nb_misses += 1
+    f.close()
+    return (nb_hits, nb_misses)
+
+def format_hit_rate(nb_hits, nb_misses):
+    nb_compilations = nb_hits + nb_misses
+    if nb_compilations == 0:
+        return '0/0'
+    return '%d/%d (%.1f%%)' % (nb_hits, nb_compilations,
+                               100.0 * nb_hits / nb_compilations)
+
+### Run the cleanup (this enforces CCACHE_MAXSIZE) and return the output of
+### 'ccache --show-stats'.
+def cleanup_and_get_stats(ccache_cmd='ccache'):
+    subprocess.run([ccache_cmd, '--cleanup'], stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    p = subprocess.run([ccache_cmd, '--show-stats'], stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT, universal_newlines=True)
+    return p.stdout
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s <statslog> [<statslog> ...]' % sys.argv[0])
+    for statslog in sys.argv[1:]:
+        print('%s: %s' % (statslog, format_hit_rate(*read_statslog(statslog))))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.cpubroker module
+###
+### A machine-wide pool of CPU tokens shared by the BBS instances running on
+### the same node (e.g. the bioc and data-experiment builds, or the builds
+### of 2 Bioconductor versions). bbs.jobs.processJobQueue() acquires a token
+### before it starts a job and releases it when the job is over, so the
+### total nb of jobs running on the node never exceeds the nb of tokens, no
+### matter what the BBS_NB_CPU setting of each instance is. A job that
+### needs several cores (NbCores option in .BBSoptions) takes as many tokens.
+###
+### The tokens are numbered from 0 to nb_cpu - 1, and an instance knows which
+### ones it holds. When the jobs are pinned to CPUs, each job is pinned to
+### the CPUs that correspond to its tokens (see
+### bbs.jobs.getTokenCPUSet()), so the jobs of 2 instances never share a CPU.
+###
+### The broker has no server: each instance writes its state to a "lease"
+### file in the broker dir, and the decisions are made by the instance that
+### asks for a token, while holding the lock on the broker dir:
+###   - An instance always gets the tokens it asks for if they are free and
+###     it holds less than its fair share of the tokens (nb_cpu * weight /
+###     sum of the weights of the active instances). The weight is used to
+###     prioritize instances.
+###   - An instance that already holds its fair share can still borrow free
+###     tokens, but only if no other active instance is waiting for a token
+###     while holding less than its fair share. So an instance can use all
+###     the cores while the others are idle, and gives back the borrowed
+###     tokens (as its jobs complete) when they need them again.
+### An instance is active if it holds tokens or asked for one recently (see
+### WAITING_TTL). The leases of the instances that died are ignored and
+### removed. A lease records the start time of the process (and the boot ID
+### on Linux), so the lease of a dead instance doesn't keep its tokens when
+### its PID gets reused by another process. On platforms other than Linux
+### this requires the psutil module, otherwise we only check the PID.
+###
+### Note that processJobQueue() never runs more jobs than its 'nb_slots'
+### argument (i.e. BBS_NB_CPU) so an instance can only use the tokens that
+### the other instances don't use if its BBS_NB_CPU is at least
+### BBS_CPU_BROKER_NB_CPU.
+###
+### Layout of the broker dir:
+###   <broker_dir>/broker.lock     lock file
+###   <broker_dir>/<pid>.lease     state of instance <pid> (JSON)
+###
+### Run 'python3 bbs/cpubroker.py <broker_dir>' to see the current state of
+### the broker.
+###
+
+import sys
+import os
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+import fileutils
+
+### An instance that was refused a token more than WAITING_TTL seconds ago
+### is not considered waiting anymore (bbs.jobs.processJobQueue() asks again
+### every second or so while it has jobs waiting for a token).
+WAITING_TTL = 10.0
+
+### Return a string that identifies the process with the given PID among all
+### the processes that ever had this PID, or None if we can't tell.
+def _get_proc_start_time(pid):
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+                boot_id = f.read().strip()
+            with open('/proc/%d/stat' % pid, 'r') as f:
+                stat = f.read()
+        except OSError:
+            return None
+        ## The 2nd field (the command name) can contain spaces and
+        ## parentheses. The start time is the 22nd field.
+        fields = stat[stat.rfind(')')+2:].split()
+        return '%s:%s' % (boot_id, fields[19])
+    try:
+        import psutil
+        return str(psutil.Process(pid).create_time())
+    except Exception:
+        return None
+
+def _pid_is_alive(pid):
+    if sys.platform == 'win32':
+        import psutil
+        return psutil.pid_exists(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        ## The process exists but belongs to another user.
+        pass
+    return True
+
+def _lease_is_alive(lease):
+    if not _pid_is_alive(lease['pid']):
+        return False
+    start_time = lease['start_time']
+    return start_time == None or \
+           _get_proc_start_time(lease['pid']) == start_time
+
+def _is_waiting(lease, now):
+    waiting_at = lease['waiting_at']
+    return waiting_at != None and now - waiting_at < WAITING_TTL
+
+class CPUBroker:
+
+    ## 'nb_cpu' is the total nb of tokens on the node. All the instances
+    ## sharing the broker dir should use the same value.
+    def __init__(self, broker_dir, nb_cpu=None, weight=1.0, label=None):
+        if nb_cpu == None:
+            nb_cpu = os.cpu_count()
+        self.broker_dir = broker_dir
+        self.nb_cpu = nb_cpu
+        self.weight = weight
+        self.label = label
+        self.tokens = []
+        os.makedirs(broker_dir, exist_ok=True)
+        self._lock_path = os.path.join(broker_dir, 'broker.lock')
+        self._lease_path = os.path.join(broker_dir, '%d.lease' % os.getpid())
+        self._waiting_at = None
+        self._start_time = _get_proc_start_time(os.getpid())
+        with fileutils.FileLock(self._lock_path):
+            self._write_lease()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_lease(self):
+        lease = {'pid': os.getpid(),
+                 'start_time': self._start_time,
+                 'label': self.label,
+                 'weight': self.weight,
+                 'tokens': self.tokens,
+                 'waiting_at': self._waiting_at}
+        tmp_path = self._lease_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(lease, f)
+        os.replace(tmp_path, self._lease_path)
+
+    ## Return the leases of the other live instances. Must be called while
+    ## holding the lock.
+    def _read_other_leases(self):
+        leases = []
+        for filename in os.listdir(self.broker_dir):
+            if not filename.endswith('.lease'):
+                continue
+            path = os.path.join(self.broker_dir, filename)
+            if path == self._lease_path:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    lease = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _lease_is_alive(lease):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            leases.append(lease)
+        return leases
+
+    ## Try to acquire 'nb_tokens' tokens (at most nb_cpu). Return the list of
+    ## acquired tokens, or None if they were not granted. Never blocks.
+    def try_acquire(self, nb_tokens=1):
+        nb_tokens = min(nb_tokens, self.nb_cpu)
+        now = time.time()
+        with fileutils.FileLock(self._lock_path):
+            others = self._read_other_leases()
+            used = set(self.tokens)
+            for lease in others:
+                used.update(lease['tokens'])
+            granted = len(used) + nb_tokens <= self.nb_cpu
+            if granted:
+                active = [lease for lease in others
+                          if len(lease['tokens']) > 0 or \
+                             _is_waiting(lease, now)]
+                total_weight = self.weight + \
+                               sum(lease['weight'] for lease in active)
+                def share(lease_weight):
+                    return self.nb_cpu * lease_weight / total_weight
+                if len(self.tokens) + nb_tokens > share(self.weight):
+                    ## Borrowing. Not allowed if that would delay an instance
+                    ## that is waiting while below its fair share.
+                    for lease in active:
+                        if _is_waiting(lease, now) and \
+                           len(lease['tokens']) < share(lease['weight']):
+                            granted = False
+                            break
+            tokens = None
+            if granted:
+                tokens = [token for token in range(self.nb_cpu)
+                          if token not in used][0:nb_tokens]
+                self.tokens += tokens
+                self._waiting_at = None
+            else:
+                self._waiting_at = now
+            self._write_lease()
+        return tokens
+
+    ## Release tokens returned by try_acquire().
+    def release(self, tokens):
+        with fileutils.FileLock(self._lock_path):
+            for token in tokens:
+                self.tokens.remove(token)
+            self._write_lease()
+
+    def close(self):
+        with fileutils.FileLock(self._lock_path):
+            self.tokens = []
+            try:
+                os.remove(self._lease_path)
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit('Usage: %s <broker_dir>' % sys.argv[0])
+    broker_dir = sys.argv[1]
+    now = time.time()
+    for filename in sorted(os.listdir(broker_dir)):
+        if not filename.endswith('.lease'):
+            continue
+        with open(os.path.join(broker_dir, filename), 'r') as f:
+            lease = json.load(f)
+        waiting = 'yes' if _is_waiting(lease, now) else 'no'
+        tokens = ','.join(str(token) for token in lease['tokens'])
+        print('pid %d (%s): weight=%s held=%d (%s) waiting=%s' % \
+              (lease['pid'], lease['label'], lease['weight'],
+               len(lease['tokens']), tokens, waiting))
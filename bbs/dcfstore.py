@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.dcfstore module
+###
+### Random access to the content of a DCF file. An IndexedDCF object maps
+### keys to byte offsets in the file so a lookup is a pread() + the parsing of
+### a single line or record, instead of a linear scan of the file.
+###
+### There are 2 kinds of indexes:
+###   - "flat" index (key_field=None): for files like BUILD_STATUS_DB.txt,
+###     PROPAGATION_STATUS_DB.txt, or the vcs-meta files, which are made of
+###     "key: value" lines. The keys are the field names and a lookup
+###     returns the value of the field as bbs.parse.parse_DCF() would (i.e.
+###     stripped, with the continuation lines if any, and '' for an empty
+###     value).
+###   - "record" index (e.g. key_field='Package'): for files like
+###     meat-index.dcf, which are made of records. The keys are the values
+###     of the key field and a lookup returns the record (as a dict).
+### Like with bbs.parse.get_next_DCF_val(), if a key appears more than
+### once, the first occurrence wins.
+###
+### The index of a big file is cached in BBS_WORK_TOPDIR/dcf-indexes/ so
+### other processes (or the next call to the same script) don't have to
+### rebuild it. The cache is invalidated when the mtime or size of the file
+### change. No file descriptor is kept open between lookups.
+###
+
+import sys
+import os
+import io
+import json
+import hashlib
+
+sys.path.insert(0, os.path.dirname(__file__))
+import parse
+
+## Indexes of files smaller than this are not worth writing to disk.
+min_size_to_cache_index = 64 * 1024
+
+## Bump this when the content of the index changes.
+_index_format = 2
+
+### Like bbs.fileutils.get_background_priorities(), read from the environment
+### because this module can be loaded twice (as bbs.dcfstore and dcfstore).
+def _get_index_cache_dir():
+    work_topdir = os.environ.get('BBS_WORK_TOPDIR', '')
+    if work_topdir == '':
+        return None
+    return os.path.join(work_topdir, 'dcf-indexes')
+
+class IndexedDCF:
+
+    def __init__(self, path, key_field=None):
+        self.path = path
+        self.key_field = key_field
+        st = os.stat(path)
+        self._signature = [st.st_mtime_ns, st.st_size, key_field,
+                           os.path.abspath(path), _index_format]
+        self._index = self._load_index()
+        if self._index == None:
+            self._index = self._build_index()
+            if st.st_size >= min_size_to_cache_index:
+                self._save_index()
+        self._records = {}
+
+    def _index_path(self):
+        cache_dir = _get_index_cache_dir()
+        if cache_dir == None:
+            return None
+        key = '%s#%s' % (os.path.abspath(self.path), self.key_field)
+        filename = hashlib.sha1(key.encode()).hexdigest() + '.json'
+        return os.path.join(cache_dir, filename)
+
+    def _load_index(self):
+        if self._index_path() == None:
+            return None
+        try:
+            with open(self._index_path(), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('signature') != self._signature:
+            return None
+        return cached.get('index')
+
+    def _save_index(self):
+        if self._index_path() == None:
+            return
+        cached = {'signature': self._signature, 'index': self._index}
+        tmp = '%s.%d.tmp' % (self._index_path(), os.getpid())
+        try:
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp, self._index_path())
+        except OSError:
+            ## Not a big deal (e.g. we don't have write permission to the
+            ## cache dir). We'll just use the in-memory index.
+            pass
+        return
+
+    ## The index maps each key to a [offset, length] pair that describes
+    ## the field (flat index) or record (record index) in the file. A field
+    ## is the "key: value" line followed by its continuation lines (and the
+    ## comment lines in between, which parse_DCF() skips).
+    def _build_index(self):
+        index = {}
+        rec = None
+        field = None
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line_offset = offset
+                offset += len(line)
+                if line.strip() == b'':
+                    if rec != None:
+                        rec[1] = line_offset - rec[0]
+                        rec = None
+                    field = None
+                    continue
+                if line.startswith(b'#') or line.startswith(b' ') or \
+                   line.startswith(b'\t'):
+                    if field != None:
+                        field[1] += len(line)
+                    continue
+                field = None
+                if rec == None:
+                    rec = [line_offset, None]
+                pos = line.find(b':')
+                if pos == -1:
+                    continue
+                key = parse.bytes2str(line[:pos])
+                if self.key_field == None:
+                    if key not in index:
+                        field = index[key] = [line_offset, len(line)]
+                elif key == self.key_field:
+                    val = parse.bytes2str(line[pos+1:]).strip()
+                    index.setdefault(val, rec)
+        if rec != None:
+            rec[1] = offset - rec[0]
+        return index
+
+    def _read(self, key):
+        offset, length = self._index[key]
+        with open(self.path, 'rb') as f:
+            if hasattr(os, 'pread'):
+                return os.pread(f.fileno(), length, offset)
+            f.seek(offset)  # Windows
+            return f.read(length)
+
+    def __getitem__(self, key):
+        if self.key_field == None:
+            field = parse.parse_DCF(io.BytesIO(self._read(key)),
+                                    merge_records=True)
+            return field[key]
+        rec = self._records.get(key)
+        if rec == None:
+            data = io.BytesIO(self._read(key))
+            rec = self._records[key] = parse.parse_DCF(data,
+                                                       merge_records=True)
+        return rec
+
+    def get(self, key, default=None):
+        if key not in self._index:
+            return default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def is_stale(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return [st.st_mtime_ns, st.st_size] != self._signature[0:2]
+
+_stores = {}
+
+### Return an IndexedDCF object for 'path'. The object is memoized and only
+### recreated if the file changed since the last call. Raise FileNotFoundError
+### if the file doesn't exist.
+def open_indexed_DCF(path, key_field=None):
+    key = (os.path.abspath(path), key_field)
+    store = _stores.get(key)
+    if store != None and not store.is_stale():
+        return store
+    store = _stores[key] = IndexedDCF(path, key_field)
+    return store
+
+if __name__ == "__main__":
+    sys.exit("ERROR: this Python module can't be used as a standalone script yet")
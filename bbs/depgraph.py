@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.depgraph module
+###
+### A compact representation of the package dependency graph (the graph
+### stored in pkg_dep_graph.txt). Package names are interned as integer ids
+### and the forward and reverse adjacencies are stored as flat arrays of ids
+### (CSR layout) so the graph of a full Bioconductor + CRAN run (~25k nodes)
+### is cheap to build and to traverse.
+###
+### A PkgDepGraph object can be used where a dict mapping each package to the
+### list of its direct deps is expected (e.g. as the 'job_deps' argument of
+### bbs.jobs.JobQueue), and also supports reverse, transitive, and
+### topological queries.
+###
+### The module also implements the cross-run cache used by BBS-run.py to
+### avoid calling utils/build_pkg_dep_graph.R when the dependencies of the
+### packages in the repos didn't change since the previous run (see the
+### "Cross-run cache" section below).
+###
+
+import sys
+import os
+import io
+import re
+import gzip
+import json
+import urllib.request
+from array import array
+
+sys.path.insert(0, os.path.dirname(__file__))
+import parse
+
+class PkgDepGraph:
+
+    ## 'pkg_dep_graph' must be a dict mapping each package to the list of
+    ## its direct deps (what bbs.parse.load_pkg_dep_graph() returns).
+    ## The deps are not required to be keys of the dict (e.g. deps on
+    ## unknown packages) but they are interned too.
+    def __init__(self, pkg_dep_graph):
+        self._names = []
+        self._ids = {}
+        for pkg in pkg_dep_graph.keys():
+            self._intern(pkg)
+        self._nb_pkgs = len(self._names)
+        fwd_offsets = array('i', [0])
+        fwd = array('i')
+        for pkg, deps in pkg_dep_graph.items():
+            seen = set()
+            for dep in deps:
+                dep_id = self._intern(dep)
+                if dep_id in seen:
+                    continue
+                seen.add(dep_id)
+                fwd.append(dep_id)
+            fwd_offsets.append(len(fwd))
+        ## Unknown deps have no deps.
+        for i in range(self._nb_pkgs, len(self._names)):
+            fwd_offsets.append(len(fwd))
+        self._fwd_offsets = fwd_offsets
+        self._fwd = fwd
+        self._rev_offsets, self._rev = self._reverse()
+        self._levels = None
+        self._deps_closures = {}
+        self._rev_deps_closures = {}
+
+    def _intern(self, pkg):
+        pkg_id = self._ids.get(pkg)
+        if pkg_id == None:
+            pkg_id = self._ids[pkg] = len(self._names)
+            self._names.append(pkg)
+        return pkg_id
+
+    ## Build the reverse adjacency (counting sort of the edges by target).
+    def _reverse(self):
+        n = len(self._names)
+        counts = [0] * (n + 1)
+        for dep_id in self._fwd:
+            counts[dep_id + 1] += 1
+        for i in range(n):
+            counts[i + 1] += counts[i]
+        rev_offsets = array('i', counts)
+        rev = array('i', bytes(len(self._fwd) * rev_offsets.itemsize))
+        fill = counts[0:n]
+        for pkg_id in range(n):
+            for k in range(self._fwd_offsets[pkg_id],
+                           self._fwd_offsets[pkg_id + 1]):
+                dep_id = self._fwd[k]
+                rev[fill[dep_id]] = pkg_id
+                fill[dep_id] += 1
+        return rev_offsets, rev
+
+    def _dep_ids(self, pkg_id):
+        return self._fwd[self._fwd_offsets[pkg_id]:
+                         self._fwd_offsets[pkg_id + 1]]
+
+    def _rev_dep_ids(self, pkg_id):
+        return self._rev[self._rev_offsets[pkg_id]:
+                         self._rev_offsets[pkg_id + 1]]
+
+    ## Dict-like interface (keys are the packages of the original dict, in
+    ## the same order).
+
+    def __len__(self):
+        return self._nb_pkgs
+
+    def __iter__(self):
+        return iter(self._names[0:self._nb_pkgs])
+
+    def keys(self):
+        return self._names[0:self._nb_pkgs]
+
+    def __contains__(self, pkg):
+        pkg_id = self._ids.get(pkg)
+        return pkg_id != None and pkg_id < self._nb_pkgs
+
+    def __getitem__(self, pkg):
+        if pkg not in self:
+            raise KeyError(pkg)
+        return self.deps(pkg)
+
+    def items(self):
+        return [(pkg, self.deps(pkg)) for pkg in self.keys()]
+
+    ## Queries. 'pkg' can be any package known to the graph (i.e. a key or
+    ## a dep).
+
+    def deps(self, pkg):
+        names = self._names
+        return [names[i] for i in self._dep_ids(self._ids[pkg])]
+
+    def reverse_deps(self, pkg):
+        names = self._names
+        return [names[i] for i in self._rev_dep_ids(self._ids[pkg])]
+
+    def _closure(self, pkg, get_ids, cache):
+        pkg_id = self._ids[pkg]
+        closure = cache.get(pkg_id)
+        if closure != None:
+            return closure
+        seen = set()
+        stack = list(get_ids(pkg_id))
+        while stack:
+            i = stack.pop()
+            if i in seen:
+                continue
+            seen.add(i)
+            cached = cache.get(i)
+            if cached != None:
+                seen.update(self._ids[name] for name in cached)
+                continue
+            stack.extend(get_ids(i))
+        seen.discard(pkg_id)
+        names = self._names
+        closure = cache[pkg_id] = frozenset(names[i] for i in seen)
+        return closure
+
+    ## All the packages that 'pkg' depends on, directly or indirectly.
+    ## Results are cached.
+    def all_deps(self, pkg):
+        return self._closure(pkg, self._dep_ids, self._deps_closures)
+
+    ## All the packages that depend on 'pkg', directly or indirectly.
+    ## Results are cached.
+    def all_reverse_deps(self, pkg):
+        return self._closure(pkg, self._rev_dep_ids, self._rev_deps_closures)
+
+    ## Topological levels: a package with no deps is at level 0, and a
+    ## package is one level above its highest dep. Packages involved in (or
+    ## depending on) a circular dependency get level None.
+    def levels(self):
+        if self._levels != None:
+            return self._levels
+        n = len(self._names)
+        nb_deps = [self._fwd_offsets[i + 1] - self._fwd_offsets[i]
+                   for i in range(n)]
+        levels = [None] * n
+        current = [i for i in range(n) if nb_deps[i] == 0]
+        level = 0
+        while current:
+            next_level = []
+            for i in current:
+                levels[i] = level
+                for j in self._rev_dep_ids(i):
+                    nb_deps[j] -= 1
+                    if nb_deps[j] == 0:
+                        next_level.append(j)
+            current = next_level
+            level += 1
+        self._levels = dict(zip(self._names, levels))
+        return self._levels
+
+    def level(self, pkg):
+        return self.levels()[pkg]
+
+    ## Return the keys of the graph sorted by topological level (stable
+    ## sort, i.e. packages at the same level stay in their original order).
+    ## Packages with level None go last.
+    def topological_order(self):
+        levels = self.levels()
+        nb_levels = max([l for l in levels.values() if l != None],
+                        default=-1) + 1
+        return sorted(self.keys(),
+                      key=lambda pkg: nb_levels if levels[pkg] == None
+                                                else levels[pkg])
+
+    ## Only report reverse deps that are **within** 'pkgs'. Return a dict
+    ## with 1 entry per package in 'pkgs'. Each entry is the sorted list of
+    ## direct reverse deps of the package that are in 'pkgs' and in the
+    ## graph.
+    def inner_reverse_deps(self, pkgs):
+        pkgs_set = set(pkgs)
+        inner_rev_deps = {}
+        for pkg in pkgs:
+            if pkg in self._ids:
+                rev_deps = [rev_dep for rev_dep in self.reverse_deps(pkg)
+                            if rev_dep in pkgs_set and rev_dep in self]
+                rev_deps.sort(key=str.lower)
+            else:
+                rev_deps = []
+            inner_rev_deps[pkg] = rev_deps
+        return inner_rev_deps
+
+### Load a pkg_dep_graph.txt file as a PkgDepGraph object.
+def load_pkg_dep_graph(filepath):
+    return PkgDepGraph(parse.load_pkg_dep_graph(filepath))
+
+
+
+##############################################################################
+### Cross-run cache
+###
+### utils/build_pkg_dep_graph.R computes the graph from the PACKAGES files of
+### all the repos (target repo + non-target repos), so the graph only changes
+### when the dependency fields of the packages in these files change, or
+### when the list of target packages changes. The cache stores the graph of
+### the previous run together with the dependency fields of all the
+### available packages (as extracted from the PACKAGES files). On the next
+### run we compare the dependency fields with the current ones and only
+### recompute the entries of the graph for the packages that changed. The
+### entries of the packages that are not available (i.e. that R got from
+### installed.packages()) are only reused if the package is still installed
+### with the same LibPath, Version, and Built fields, and the "unknown"
+### packages (not available and not installed) only if they're still not
+### installed. If the graph can't be completed this way (e.g. a new dep is
+### not available), or if R was reinstalled, we give up and the caller must
+### call the R script.
+###
+
+pkg_dep_graph_cache_format = 2
+
+## Timeout (in seconds) for the download of a PACKAGES file.
+fetch_timeout = 60.0
+
+_hard_dep_fields = ('Depends', 'Imports', 'LinkingTo')
+
+### Same as .extractDirectPkgDeps() in utils/build_pkg_dep_graph.R.
+def _extract_direct_deps(rec, fields=_hard_dep_fields):
+    deps = []
+    for field in fields:
+        val = rec.get(field)
+        if val == None:
+            continue
+        for dep in val.split(','):
+            dep = dep.split('(', 1)[0].strip()
+            if dep != '' and dep != 'R' and dep not in deps:
+                deps.append(dep)
+    return deps
+
+def _version_as_tuple(version):
+    try:
+        return tuple(int(x) for x in re.split('[.-]', version.strip()))
+    except ValueError:
+        return (-1, )
+
+_R_constraint_regex = re.compile(r'(^|,)\s*R\s*\(\s*([<>=!]+)\s*([^)\s]+)\s*\)')
+
+_ops = {
+    '>=': lambda x, y: x >= y,
+    '>':  lambda x, y: x > y,
+    '<=': lambda x, y: x <= y,
+    '<':  lambda x, y: x < y,
+    '==': lambda x, y: x == y,
+    '!=': lambda x, y: x != y
+}
+
+### Emulate the "R_version" and "OS_type" filters of available.packages().
+def _is_installable(rec, R_version):
+    OS_type = rec.get('OS_type')
+    if OS_type != None:
+        if OS_type != ('windows' if sys.platform == 'win32' else 'unix'):
+            return False
+    depends = rec.get('Depends')
+    if depends != None:
+        for m in _R_constraint_regex.finditer(depends):
+            op = _ops.get(m.group(2))
+            if op == None or not op(R_version, _version_as_tuple(m.group(3))):
+                return False
+    return True
+
+def _fetch_PACKAGES(repo):
+    contrib_url = repo.rstrip('/') + '/src/contrib'
+    try:
+        f = urllib.request.urlopen(contrib_url + '/PACKAGES.gz',
+                                   timeout=fetch_timeout)
+        data = gzip.decompress(f.read())
+    except (OSError, EOFError):
+        f = urllib.request.urlopen(contrib_url + '/PACKAGES',
+                                   timeout=fetch_timeout)
+        data = f.read()
+    f.close()
+    return data
+
+### Return the R version (as a tuple) and the "Built" field of the base
+### package of the R installation located at 'r_home'. The latter changes
+### every time R is reinstalled.
+def get_R_signature(r_home):
+    desc_path = os.path.join(r_home, 'library', 'base', 'DESCRIPTION')
+    desc = parse.parse_DCF(desc_path, merge_records=True,
+                           fields=('Version', 'Built'))
+    return (_version_as_tuple(desc['Version']), desc.get('Built'))
+
+### Return a dict with 1 entry per package available in 'repos' (list of
+### repo URLs). Each entry is a [hard_deps, suggests] pair (2 lists of
+### package names). Like available.packages(), when a package is available
+### in more than one repo, the highest version wins (and the first one in
+### case of a tie), and both lists come from the record that wins.
+### If 'versions' is a dict, the version of each available package (as a
+### tuple) is stored in it.
+### Raise an OSError if the PACKAGES file of a repo cannot be downloaded.
+def read_available_pkgs(repos, R_version, versions=None):
+    fields = ('Package', 'Version', 'OS_type', 'Suggests') + _hard_dep_fields
+    available_pkgs = {}
+    if versions == None:
+        versions = {}
+    for repo in repos:
+        data = _fetch_PACKAGES(repo)
+        for rec in parse.iter_DCF(io.BytesIO(data), fields):
+            pkg = rec.get('Package')
+            if pkg == None or not _is_installable(rec, R_version):
+                continue
+            version = _version_as_tuple(rec.get('Version', ''))
+            if pkg in versions and versions[pkg] >= version:
+                continue
+            versions[pkg] = version
+            suggests = _extract_direct_deps(rec, ('Suggests', ))
+            available_pkgs[pkg] = [_extract_direct_deps(rec), suggests]
+    return available_pkgs
+
+### Return the subset of 'pkgs' (as a set) made of the packages that are
+### installed and for which a higher version is available. 'installed_pkgs'
+### must be a dict like the one returned by bbs.rlib.get_installed_pkgs(),
+### and 'available_versions' a dict like the one filled by
+### read_available_pkgs(). Same criterion as R's old.packages().
+def get_outdated_pkgs(pkgs, installed_pkgs, available_versions):
+    outdated_pkgs = set()
+    for pkg in pkgs:
+        installed = installed_pkgs.get(pkg)
+        available_version = available_versions.get(pkg)
+        if installed == None or installed['Version'] == None or \
+           available_version == None:
+            continue
+        if _version_as_tuple(installed['Version']) < available_version:
+            outdated_pkgs.add(pkg)
+    return outdated_pkgs
+
+def load_pkg_dep_graph_cache(path):
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('format') != pkg_dep_graph_cache_format:
+        return None
+    return cache
+
+### Same as in .build_pkg_dep_graph(): the graph is built starting from the
+### target packages and their Suggests.
+def _get_roots(target_pkgs, available_pkgs):
+    roots = list(target_pkgs)
+    roots_set = set(roots)
+    for pkg in target_pkgs:
+        for dep in available_pkgs.get(pkg, [[], []])[1]:
+            if dep not in roots_set:
+                roots_set.add(dep)
+                roots.append(dep)
+    return roots
+
+### What identifies the installed package 'pkg' ('installed_pkgs' must be a
+### dict like the one returned by bbs.rlib.get_installed_pkgs()). None if
+### 'pkg' is not installed.
+def _installed_pkg_signature(pkg, installed_pkgs):
+    desc = installed_pkgs.get(pkg)
+    if desc == None:
+        return None
+    return [desc['LibPath'], desc['Version'], desc['Built']]
+
+### The "unknown" packages (i.e. not available *and* not installed) are the
+### packages that don't have an entry in the graph. The "installed-only"
+### packages are the packages in the graph that are not available.
+def save_pkg_dep_graph_cache(path, pkg_dep_graph, target_pkgs,
+                             available_pkgs, R_built, installed_pkgs):
+    unknown_pkgs = set(_get_roots(target_pkgs, available_pkgs))
+    for pkg, deps in pkg_dep_graph.items():
+        unknown_pkgs.update(deps)
+    unknown_pkgs = [pkg for pkg in unknown_pkgs if pkg not in pkg_dep_graph]
+    installed_only_pkgs = {}
+    for pkg in pkg_dep_graph:
+        if pkg not in available_pkgs:
+            installed_only_pkgs[pkg] = _installed_pkg_signature(pkg,
+                                                                installed_pkgs)
+    cache = {'format': pkg_dep_graph_cache_format,
+             'R_built': R_built,
+             'available_pkgs': available_pkgs,
+             'pkg_dep_graph': [[pkg, deps] for pkg, deps in pkg_dep_graph.items()],
+             'unknown_pkgs': sorted(unknown_pkgs),
+             'installed_only_pkgs': installed_only_pkgs}
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+    return
+
+### Compute the graph of the current run from the cache of the previous run.
+### Return a (pkg_dep_graph, nb_recomputed) tuple where 'pkg_dep_graph' is a
+### dict mapping each package to the list of its direct deps (like what
+### bbs.parse.load_pkg_dep_graph() returns) and 'nb_recomputed' the nb of
+### entries that differ from the cached graph. Return (None, None) if the
+### graph cannot be computed from the cache. 'installed_pkgs' must be a dict
+### like the one returned by bbs.rlib.get_installed_pkgs().
+def update_pkg_dep_graph_from_cache(cache, target_pkgs, available_pkgs,
+                                    R_built, installed_pkgs):
+    if cache == None or cache.get('R_built') != R_built:
+        return (None, None)
+    old_available_pkgs = cache['available_pkgs']
+    old_graph = dict((pkg, deps) for pkg, deps in cache['pkg_dep_graph'])
+    old_unknown_pkgs = set(cache['unknown_pkgs'])
+    old_installed_only_pkgs = cache['installed_only_pkgs']
+    roots = _get_roots(target_pkgs, available_pkgs)
+    ## Same as .buildPkgDepsList().
+    pkg_dep_graph = {}
+    nb_recomputed = 0
+    seen = set(roots)
+    queue = roots
+    while queue:
+        new_queue = []
+        for pkg in queue:
+            entry = available_pkgs.get(pkg)
+            if entry != None:
+                if pkg in old_graph and old_available_pkgs.get(pkg) == entry:
+                    deps = old_graph[pkg]
+                else:
+                    deps = entry[0]
+            elif pkg in old_graph:
+                ## 'pkg' is not available but was installed. Its deps come
+                ## from its installed DESCRIPTION file so we can only reuse
+                ## them if it wasn't reinstalled or removed since then.
+                signature = _installed_pkg_signature(pkg, installed_pkgs)
+                if signature == None or \
+                   signature != old_installed_only_pkgs.get(pkg):
+                    return (None, None)
+                deps = old_graph[pkg]
+            elif pkg in old_unknown_pkgs:
+                if pkg in installed_pkgs:
+                    return (None, None)  # R would find it now
+                continue  # still an unknown package
+            else:
+                ## Only R knows (e.g. 'pkg' might be installed).
+                return (None, None)
+            if deps != old_graph.get(pkg):
+                nb_recomputed += 1
+            pkg_dep_graph[pkg] = deps
+            for dep in deps:
+                if dep not in seen:
+                    seen.add(dep)
+                    new_queue.append(dep)
+        queue = new_queue
+    return (pkg_dep_graph, nb_recomputed)
+
+### Write 'pkg_dep_graph' to a file in the pkg_dep_graph.txt format.
+def write_pkg_dep_graph(pkg_dep_graph, filepath):
+    with open(filepath, 'w') as f:
+        for pkg, deps in pkg_dep_graph.items():
+            f.write('%s: %s\n' % (pkg, ' '.join(deps)))
+    return
+
+if __name__ == "__main__":
+    sys.exit("ERROR: this Python module can't be used as a standalone script yet")
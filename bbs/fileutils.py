@@ -4,7 +4,7 @@
 ### This file is part of the BBS software (Bioconductor Build System).
 ###
 ### Author: Hervé Pagès <hpages.on.github@gmail.com>
-### Last modification: Sep 17, 2019
+### Last modification: Oct 19, 2026
 ###
 ### bbs.fileutils module
 ###
@@ -14,6 +14,15 @@ import sys
 import re
 import shutil
 import string
+import time
+import tempfile
+import subprocess
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+    import msvcrt
 
 # Equivalent to 'du -sb <path>'
 # WARNING: Result will not be accurate on Windows when <path> is (or contains)
@@ -69,13 +78,232 @@ def nuke_tree(dir, ignore_errors=False):
     shutil.rmtree(dir, ignore_errors=ignore_errors)
     return
 
+## Deleting big trees (meat dir, products-out, report dir, etc...) can take
+## minutes. Instead of waiting for that, remake_dir() renames the tree into
+## the trash dir (so the renaming is atomic and almost instantaneous), and
+## deletes the content of the trash dir from a low-priority background
+## process. The trash dir is BBS_WORK_TOPDIR/.bbs-trash so it's never inside
+## a tree that gets published or scanned. Only the trees on the same
+## filesystem as BBS_WORK_TOPDIR can be renamed into it: the others are
+## deleted synchronously. Each tree goes to its own 'mktemp -d' subdir of
+## the trash dir so trees with the same name never collide. Only one
+## deletion process runs at a time: what's trashed while it runs is deleted
+## by the next one, or by reap_trash() at the beginning of the next run.
+trash_dirname = '.bbs-trash'
+
+### Return the trash dir for 'path', or None if 'path' can't be moved there.
+def get_trash_dir(path):
+    work_topdir = os.environ.get('BBS_WORK_TOPDIR', '')
+    if work_topdir == '':
+        return None
+    trash_dir = os.path.join(os.path.abspath(work_topdir), trash_dirname)
+    path = os.path.abspath(path)
+    if trash_dir == path or trash_dir.startswith(path + os.sep):
+        return None
+    try:
+        os.makedirs(trash_dir, exist_ok=True)
+    except OSError:
+        return None
+    if not same_filesystem(trash_dir, path):
+        return None
+    return trash_dir
+
+### Return the new path of the tree or None if it could not be moved.
+def move_to_trash(path):
+    trash_dir = get_trash_dir(path)
+    if trash_dir == None:
+        return None
+    basename = os.path.basename(os.path.abspath(path))
+    try:
+        trashed_path = tempfile.mkdtemp(prefix=basename + '.', dir=trash_dir)
+        trashed_path = os.path.join(trashed_path, basename)
+        os.rename(path, trashed_path)
+    except OSError:
+        return None
+    return trashed_path
+
+### CPU priority (niceness increment) and I/O priority (ionice class and
+### level) of the background work (see bbs.jobs.runInBackground()). Return a
+### (nice, ionice_class, ionice_level) tuple, with None for the settings
+### that are not set. The settings are read from the environment (see
+### BBSvars.py) rather than stored in module variables because this module
+### and bbs.jobs can be loaded twice (e.g. as bbs.jobs and as jobs).
+def get_background_priorities():
+    priorities = []
+    for name in ['BBS_BACKGROUND_NICE',
+                 'BBS_BACKGROUND_IONICE_CLASS',
+                 'BBS_BACKGROUND_IONICE_LEVEL']:
+        val = os.environ.get(name, '')
+        priorities.append(int(val) if val != '' else None)
+    return tuple(priorities)
+
+### Return the ionice arguments (a list) for the specified class and level.
+### Empty if 'ionice_class' is None or ionice is not available.
+def get_ionice_args(ionice_class, ionice_level=None):
+    if ionice_class == None or shutil.which('ionice') == None:
+        return []
+    args = ['-c', str(ionice_class)]
+    if ionice_level != None and ionice_class in (1, 2):
+        args += ['-n', str(ionice_level)]
+    return args
+
+### Return the command prefix (a list) that runs a command with the
+### specified priorities. Empty on Windows.
+def get_low_priority_cmd_prefix(nice, ionice_class, ionice_level=None):
+    if sys.platform == "win32":
+        return []
+    prefix = []
+    if nice != None:
+        prefix += ['nice', '-n', str(nice)]
+    ionice_args = get_ionice_args(ionice_class, ionice_level)
+    if len(ionice_args) != 0:
+        prefix += ['ionice'] + ionice_args
+    return prefix
+
+_trash_reaper = None
+
+### Start a low-priority background process that deletes everything in
+### 'trash_dir', unless the one started by a previous call is still running.
+### Don't wait for it.
+def empty_trash(trash_dir):
+    global _trash_reaper
+    if _trash_reaper != None and _trash_reaper.poll() == None:
+        return None
+    if not os.path.isdir(trash_dir):
+        return None
+    paths = [os.path.join(trash_dir, name) for name in os.listdir(trash_dir)]
+    if len(paths) == 0:
+        return None
+    nice, ionice_class, ionice_level = get_background_priorities()
+    if nice == None and ionice_class == None:
+        nice, ionice_class = 19, 3
+    cmd = get_low_priority_cmd_prefix(nice, ionice_class, ionice_level)
+    cmd += ['rm', '-rf', '--'] + paths
+    _trash_reaper = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL,
+                                          start_new_session=True)
+    return _trash_reaper
+
+### Delete what previous runs left in the trash dir. Called once at startup.
+def reap_trash():
+    if sys.platform == "win32":
+        return None
+    work_topdir = os.environ.get('BBS_WORK_TOPDIR', '')
+    if work_topdir == '':
+        return None
+    return empty_trash(os.path.join(work_topdir, trash_dirname))
+
 def remake_dir(path, ignore_errors=False):
     if os.path.exists(path):
-        nuke_tree(path, ignore_errors=ignore_errors)
-    if not os.path.exists(path):
-        os.mkdir(path)
+        ## On Windows, renaming a dir fails if a process is holding on a
+        ## file inside it, and 'rm' and 'nice' are not available anyway, so
+        ## we keep deleting synchronously there.
+        trashed_path = None
+        if sys.platform != "win32":
+            trashed_path = move_to_trash(path)
+        if trashed_path != None:
+            ## <trash_dir>/<mktemp -d dir>/<basename>
+            empty_trash(os.path.dirname(os.path.dirname(trashed_path)))
+        else:
+            nuke_tree(path, ignore_errors=ignore_errors)
+    os.makedirs(path, exist_ok=True)
     return
 
+## FICLONE ioctl request (from <linux/fs.h>). Asks the filesystem to share
+## the data blocks of the source file with the destination file
+## (copy-on-write). Supported by Btrfs, XFS (with reflink=1), and a few
+## others.
+_FICLONE = 0x40049409
+
+def same_filesystem(path1, path2):
+    try:
+        return os.stat(path1).st_dev == os.stat(path2).st_dev
+    except OSError:
+        return False
+
+def _reflink(src_fd, dst_fd):
+    if fcntl == None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+## Let the kernel do the copy. Depending on the filesystem, this can be a
+## reflink, a server-side copy (NFS 4.2), or at least a copy that doesn't
+## go thru user space.
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    offset = 0
+    try:
+        while offset < size:
+            n = os.copy_file_range(src_fd, dst_fd, size - offset,
+                                   offset, offset)
+            if n == 0:
+                break
+            offset += n
+    except OSError:
+        if offset != 0:
+            os.ftruncate(dst_fd, 0)
+        return False
+    return offset == size
+
+## Same as shutil.copy2(src, dst) but try to avoid copying the data first.
+## Meant to be passed as the 'copy_function' argument to shutil.copytree().
+def clone_file(src, dst):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.islink(src) or not os.path.isfile(src):
+        return shutil.copy2(src, dst)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        if not _reflink(src_fd, dst_fd) and \
+           not _copy_file_range(src_fd, dst_fd, os.fstat(src_fd).st_size):
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return dst
+
+def clone_tree(src, dst):
+    return shutil.copytree(src, dst, copy_function=clone_file)
+
+## Lock on file 'path' (created if needed), to be used in a 'with' statement.
+## Shared locks are only supported on Unix (they're exclusive on Windows).
+class FileLock:
+
+    def __init__(self, path, exclusive=True):
+        self._path = path
+        self._exclusive = exclusive
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self._path, 'a+')
+        if fcntl != None:
+            op = fcntl.LOCK_EX if self._exclusive else fcntl.LOCK_SH
+            fcntl.flock(self._f.fileno(), op)
+            return self
+        ## No shared locks on Windows. msvcrt.locking() locks from the
+        ## current position and gives up after 10 attempts (1 per second).
+        self._f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+                return self
+            except OSError:
+                pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl != None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        else:
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        self._f.close()
+        self._f = None
+
 ## rsync will interprets a path that starts with a drive letter followed by a
 ## colon (e.g. E:\biocbuild\bbs-3.15-bioc\products-out\install) as a remote
 ## location. So in order for Cygwin rsync to interpret the path correctly,
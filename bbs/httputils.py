@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.httputils module
+###
+### A tiny HTTP client used by RemoteDir.WOpen() and RemoteDir.Get() to fetch
+### files from the central build node. Compared to urllib.request.urlopen()
+### it provides:
+###   - connection reuse (HTTP/1.1 keep-alive) i.e. we open one connection
+###     per host and reuse it for all subsequent requests to that host;
+###   - an on-disk cache validated with ETag and Last-Modified (conditional
+###     GET), so small files that we fetch again and again (meat-index.dcf,
+###     NodeInfo files, gitlog DCFs, ...) only cost a 304 response when they
+###     didn't change;
+###   - streaming, chunked, resumable downloads of big files.
+###
+### The cache is only used if the BBS_HTTP_CACHE_DIR environment variable is
+### set (or if 'cache_dir' is set programmatically).
+###
+
+import sys
+import os
+import io
+import hashlib
+import json
+import http.client
+import urllib.parse
+import urllib.error
+
+try:
+    cache_dir = os.environ['BBS_HTTP_CACHE_DIR']
+except KeyError:
+    cache_dir = None
+
+timeout = 60.0
+chunk_size = 1024 * 1024  # 1 MiB
+max_redirects = 5
+
+class HTTPResponseFile(io.BytesIO):
+    ## Mimics the object returned by urllib.request.urlopen(). In particular
+    ## it has an 'url' attribute (used by bbs.parse.DcfParsingError) and is
+    ## iterable line by line in binary mode.
+    def __init__(self, content, url, status=200, from_cache=False):
+        io.BytesIO.__init__(self, content)
+        self.url = url
+        self.status = status
+        self.from_cache = from_cache
+    def geturl(self):
+        return self.url
+    def getcode(self):
+        return self.status
+
+
+##############################################################################
+### Connection pool
+###
+
+_connections = {}
+
+def _split_url(url):
+    u = urllib.parse.urlsplit(url)
+    if u.scheme not in ['http', 'https']:
+        raise ValueError("unsupported URL scheme: %s" % url)
+    selector = u.path or '/'
+    if u.query:
+        selector += '?' + u.query
+    return (u.scheme, u.hostname, u.port, selector)
+
+def _get_connection(scheme, host, port):
+    key = (scheme, host, port)
+    conn = _connections.get(key)
+    if conn == None:
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        _connections[key] = conn
+    return conn
+
+def _drop_connection(scheme, host, port):
+    conn = _connections.pop((scheme, host, port), None)
+    if conn != None:
+        conn.close()
+    return
+
+def close_all_connections():
+    for key in list(_connections.keys()):
+        _drop_connection(*key)
+    return
+
+### Send a GET request and return the (unread) http.client.HTTPResponse.
+### Follows redirections. The connection to the server is reused if it's
+### still alive, otherwise it's transparently re-opened (once).
+def _request(url, headers=None):
+    if headers == None:
+        headers = {}
+    for i in range(max_redirects + 1):
+        scheme, host, port, selector = _split_url(url)
+        for attempt in range(2):
+            conn = _get_connection(scheme, host, port)
+            try:
+                conn.request('GET', selector, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected,
+                    http.client.CannotSendRequest,
+                    http.client.BadStatusLine,
+                    ConnectionError):
+                ## The server closed the kept-alive connection. Try again
+                ## with a fresh one.
+                _drop_connection(scheme, host, port)
+                if attempt == 1:
+                    raise
+                continue
+            break
+        if resp.status in [301, 302, 303, 307, 308]:
+            location = resp.getheader('Location')
+            resp.read()
+            if resp.will_close:
+                _drop_connection(scheme, host, port)
+            if location == None:
+                break
+            url = urllib.parse.urljoin(url, location)
+            continue
+        resp.url = url
+        return resp
+    raise urllib.error.HTTPError(url, resp.status, 'too many redirections',
+                                 resp.headers, None)
+
+def _finish(resp):
+    if resp.will_close:
+        scheme, host, port, selector = _split_url(resp.url)
+        _drop_connection(scheme, host, port)
+    return
+
+def _raise_HTTPError(resp, body):
+    raise urllib.error.HTTPError(resp.url, resp.status, resp.reason,
+                                 resp.headers, io.BytesIO(body))
+
+
+##############################################################################
+### On-disk cache
+###
+
+def _cache_paths(url):
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    base = os.path.join(cache_dir, key[:2], key)
+    return (base + '.body', base + '.meta')
+
+def _read_cache_meta(url):
+    if cache_dir == None:
+        return None
+    body_path, meta_path = _cache_paths(url)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('url') != url or not os.path.exists(body_path):
+        return None
+    return meta
+
+def _write_cache(url, resp, content):
+    if cache_dir == None:
+        return
+    etag = resp.getheader('ETag')
+    last_modified = resp.getheader('Last-Modified')
+    if etag == None and last_modified == None:
+        return  # can't be validated later so not worth caching
+    body_path, meta_path = _cache_paths(url)
+    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+    ## Write to temporary files and rename them so a crash or a concurrent
+    ## process never sees a half-written cache entry.
+    tmp = '%s.%d.tmp' % (body_path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, body_path)
+    meta = {'url': url, 'ETag': etag, 'Last-Modified': last_modified}
+    tmp = '%s.%d.tmp' % (meta_path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+    return
+
+def _read_cached_body(url):
+    body_path, meta_path = _cache_paths(url)
+    with open(body_path, 'rb') as f:
+        return f.read()
+
+def clear_cache():
+    if cache_dir == None or not os.path.isdir(cache_dir):
+        return
+    for path, subdirs, files in os.walk(cache_dir):
+        for file in files:
+            if file.endswith('.body') or file.endswith('.meta'):
+                os.remove(os.path.join(path, file))
+    return
+
+
+##############################################################################
+### Public API
+###
+
+### Fetch the file at 'url' and return it as an HTTPResponseFile object
+### (in-memory, binary). Raise urllib.error.HTTPError on HTTP errors.
+### Only meant to be used on small files! Use download() for big files.
+def urlopen(url):
+    headers = {}
+    meta = _read_cache_meta(url)
+    if meta != None:
+        if meta.get('ETag') != None:
+            headers['If-None-Match'] = meta['ETag']
+        if meta.get('Last-Modified') != None:
+            headers['If-Modified-Since'] = meta['Last-Modified']
+    resp = _request(url, headers)
+    content = resp.read()
+    _finish(resp)
+    if resp.status == 304 and meta != None:
+        return HTTPResponseFile(_read_cached_body(url), resp.url,
+                                200, from_cache=True)
+    if resp.status != 200:
+        _raise_HTTPError(resp, content)
+    _write_cache(url, resp, content)
+    return HTTPResponseFile(content, resp.url, resp.status)
+
+### The validator (ETag or Last-Modified) of the file being downloaded is
+### stored next to the .part file so we can send it in the If-Range header
+### when we resume the download. This way the server sends the whole file
+### again (200) instead of the rest of it (206) if it changed in the
+### meantime. Weak ETags cannot be used in If-Range.
+def _get_validator(resp):
+    etag = resp.getheader('ETag')
+    if etag != None and not etag.startswith('W/'):
+        return etag
+    return resp.getheader('Last-Modified')
+
+def _read_validator(validator_path):
+    try:
+        with open(validator_path, 'r') as f:
+            return json.load(f)['validator']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _write_validator(validator_path, validator):
+    if validator == None:
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        return
+    with open(validator_path, 'w') as f:
+        json.dump({'validator': validator}, f)
+    return
+
+### Return the first byte position of a "Content-Range: bytes a-b/n" header
+### or None if it cannot be parsed.
+def _get_range_start(resp):
+    content_range = resp.getheader('Content-Range')
+    if content_range == None:
+        return None
+    try:
+        unit, spec = content_range.strip().split(' ', 1)
+        if unit != 'bytes':
+            return None
+        return int(spec.split('-', 1)[0])
+    except ValueError:
+        return None
+
+def _remove_part(part_path, validator_path):
+    for path in [part_path, validator_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    return
+
+### Download the file at 'url' to local file 'dest_path' (replacing any
+### existing file). The data is streamed to disk in chunks of 'chunk_size'
+### bytes. If a previous download of the same file was interrupted, we
+### resume it from where it stopped, but only if the server supports Range
+### requests and the file did not change on the server (see
+### _get_validator() above). Otherwise we start again from scratch.
+### Return the number of bytes received over the network.
+def download(url, dest_path, verbose=False):
+    part_path = dest_path + '.part'
+    validator_path = part_path + '.validator'
+    headers = {}
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        validator = _read_validator(validator_path)
+        if offset != 0 and validator != None:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+        else:
+            ## Can't tell whether the .part file is from the current
+            ## version of the file.
+            _remove_part(part_path, validator_path)
+            offset = 0
+    resp = _request(url, headers)
+    if offset != 0 and (resp.status == 416 or
+                        (resp.status == 206 and
+                         _get_range_start(resp) != offset)):
+        ## Requested range not satisfiable (e.g. the file got smaller), or
+        ## the server sent something else than the rest of the file: the
+        ## .part file cannot be used.
+        resp.read()
+        _finish(resp)
+        _remove_part(part_path, validator_path)
+        return download(url, dest_path, verbose)
+    if resp.status == 206 and offset != 0:
+        mode = 'ab'
+    elif resp.status == 200:
+        mode = 'wb'
+        offset = 0
+        _write_validator(validator_path, _get_validator(resp))
+    else:
+        _raise_HTTPError(resp, resp.read())
+    if verbose:
+        if mode == 'ab':
+            print("BBS>   Resuming download of %s at byte %d" % (url, offset))
+        else:
+            print("BBS>   Downloading %s" % url)
+    nbytes = 0
+    try:
+        with open(part_path, mode) as f:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                nbytes += len(chunk)
+    except:
+        ## Keep the .part file so the next call can resume the download,
+        ## but don't try to reuse the connection.
+        scheme, host, port, selector = _split_url(resp.url)
+        _drop_connection(scheme, host, port)
+        raise
+    _finish(resp)
+    os.replace(part_path, dest_path)
+    _remove_part(part_path, validator_path)
+    return nbytes
+
+if __name__ == "__main__":
+    sys.exit("ERROR: this Python module can't be used as a standalone script yet")
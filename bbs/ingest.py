@@ -0,0 +1,707 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.ingest module
+###
+### A native Python channel for delivering build products to the central
+### build node. It's an alternative to starting one rsync+ssh process per
+### Put()/Mput() call, which means thousands of processes per night on each
+### build node.
+###
+### The receiver is a small asyncio server running on the central node. It
+### listens on localhost only and is reached through an ssh tunnel by the
+### build nodes (or directly when the build node is the central node).
+### Clients send "bundles": a bundle is a tarball of the files/dirs passed to
+### a single Mput() call, plus the path (relative to the server root) of the
+### directory where to unpack it. The tarball is gzip-compressed, except for
+### the files that are already compressed (e.g. .tar.gz or .zip packages):
+### those go to a separate, uncompressed tarball. The tarball is written to a
+### spooled temporary file (i.e. in memory only if it's small), never as a
+### whole in memory. Bundles are sent in chunks, each chunk being a frame:
+###
+###   magic (4 bytes) | frame type (1 byte) | header length (4 bytes)
+###   | JSON header | payload (header['len'] bytes)
+###
+### The bundle id is the SHA-256 checksum of the compressed tarball. The
+### server writes incoming chunks to <root>/.ingest-tmp/<id>.part and only
+### unpacks the bundle after the checksum of the complete .part file has
+### been verified. Because the .part file survives a dropped connection, a
+### client can ask the server how many bytes it already has for a bundle
+### (QUERY frame) and resume from there.
+### Clients don't wait for the acknowledgment of a bundle before sending the
+### next one (pipelining), up to 'window' unacknowledged bundles. This is
+### true across Mput() calls: the bundles that failed are reported by the
+### next call to the client (see IngestClient.take_failed()).
+###
+### Start the server on the central node with:
+###
+###   python3 bbs/ingest.py <root> [<port>]
+###
+### The products buffer used in asynchronous mode is pushed with:
+###
+###   python3 bbs/ingest.py push [--host <host>] [--user <user>]
+###                              [--rsh <rsh_cmd>] [--port <port>]
+###                              <src_dir> <dest>
+###
+### Only the top-level entries of <src_dir> that changed since the previous
+### push are sent (see push_dir()).
+###
+
+import sys
+import os
+import json
+import struct
+import socket
+import hashlib
+import tempfile
+import tarfile
+import shutil
+import subprocess
+import threading
+import asyncio
+import atexit
+import time
+import argparse
+import collections
+
+sys.path.insert(0, os.path.dirname(__file__))
+import fileutils
+
+default_port = 8733
+chunk_size = 4 * 1024 * 1024  # 4 MiB
+window = 8
+
+_MAGIC = b'BBSI'
+_FRAME_HEADER = struct.Struct('!4sBI')
+
+## Frame types
+CHUNK = 1   # client -> server: a chunk of a bundle
+QUERY = 2   # client -> server: how many bytes of bundle <id> do you have?
+STATUS = 3  # server -> client: reply to QUERY
+ACK = 4     # server -> client: bundle <id> was unpacked successfully
+ERR = 5     # server -> client: bundle <id> could not be unpacked
+
+_TMP_SUBDIR = '.ingest-tmp'
+
+### Files with these extensions are not compressed again.
+compressed_exts = ('.gz', '.tgz', '.bz2', '.xz', '.zip', '.zst')
+
+### Where push_dir() keeps track of what it sent.
+push_manifest_file = '.ingest-manifest'
+
+class IngestError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+
+##############################################################################
+### Frames
+###
+
+def _pack_frame(frame_type, header, payload=b''):
+    header = dict(header)
+    header['len'] = len(payload)
+    header = json.dumps(header).encode('utf-8')
+    return _FRAME_HEADER.pack(_MAGIC, frame_type, len(header)) + \
+           header + payload
+
+def _unpack_frame_header(data):
+    magic, frame_type, header_len = _FRAME_HEADER.unpack(data)
+    if magic != _MAGIC:
+        raise IngestError('invalid frame (bad magic number)')
+    return (frame_type, header_len)
+
+### Reject anything that could escape the server root.
+def _check_dest(dest):
+    if os.path.isabs(dest) or dest.startswith('\\'):
+        raise IngestError('invalid destination: %s' % dest)
+    dest = os.path.normpath(dest)
+    if dest == '..' or dest.startswith('..' + os.sep) or \
+       dest.startswith(_TMP_SUBDIR):
+        raise IngestError('invalid destination: %s' % dest)
+    return dest
+
+
+##############################################################################
+### Bundles
+###
+
+### File-like object that computes the size and SHA-256 checksum of what is
+### written to it.
+class _HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+    def tell(self):
+        return self.size
+    def flush(self):
+        return
+
+### A bundle for 'paths', to be unpacked in 'dest' on the server. As with
+### rsync, a directory is stored under its basename (like 'rsync src dest',
+### not like 'rsync src/ dest'). 'context' is for the caller (e.g. to know
+### what to do with the bundle if it can't be delivered).
+class Bundle:
+
+    def __init__(self, paths, dest, compress=True, compresslevel=6):
+        self.paths = list(paths)
+        self.dest = dest
+        self.context = None
+        self._file = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+        writer = _HashingWriter(self._file)
+        if compress:
+            tar = tarfile.open(fileobj=writer, mode='w:gz',
+                               compresslevel=compresslevel)
+        else:
+            tar = tarfile.open(fileobj=writer, mode='w')
+        try:
+            for path in self.paths:
+                tar.add(path,
+                        arcname=os.path.basename(os.path.normpath(path)))
+        finally:
+            tar.close()
+        self.id = writer.sha256.hexdigest()
+        self.size = writer.size
+
+    def read(self, offset, size):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+def _is_compressed(path):
+    return os.path.isfile(path) and path.lower().endswith(compressed_exts)
+
+### Return the bundles for 'paths': the already compressed files go to an
+### uncompressed bundle, everything else to a gzip-compressed bundle.
+def make_bundles(paths, dest):
+    compressed = [path for path in paths if _is_compressed(path)]
+    others = [path for path in paths if not _is_compressed(path)]
+    bundles = []
+    if len(others) != 0:
+        bundles.append(Bundle(others, dest))
+    if len(compressed) != 0:
+        bundles.append(Bundle(compressed, dest, compress=False))
+    return bundles
+
+### The name of a symlink target is relative to the directory of the link,
+### but the name of a hard link target is relative to the root of the
+### archive.
+def _safe_members(tar, dest_dir):
+    dest_dir = os.path.realpath(dest_dir)
+    for member in tar.getmembers():
+        member_path = os.path.join(dest_dir, member.name)
+        path = os.path.realpath(member_path)
+        if path != dest_dir and not path.startswith(dest_dir + os.sep):
+            raise IngestError('unsafe path in bundle: %s' % member.name)
+        if member.issym() or member.islnk():
+            if member.issym():
+                target = os.path.join(os.path.dirname(member_path),
+                                      member.linkname)
+            else:
+                target = os.path.join(dest_dir, member.linkname)
+            target = os.path.realpath(target)
+            if not target.startswith(dest_dir + os.sep):
+                raise IngestError('unsafe link in bundle: %s' % member.name)
+        elif not (member.isfile() or member.isdir()):
+            raise IngestError('unsupported member in bundle: %s' % member.name)
+        yield member
+
+def unpack_bundle(bundle_path, dest_dir):
+    os.makedirs(dest_dir, exist_ok=True)
+    tar = tarfile.open(bundle_path, mode='r:*')
+    try:
+        members = list(_safe_members(tar, dest_dir))
+        ## Like 'rsync --delete', a directory sent in a bundle replaces the
+        ## directory of the same name in the destination.
+        top_dirs = set(m.name for m in members
+                       if m.isdir() and '/' not in m.name)
+        for name in top_dirs:
+            path = os.path.join(dest_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                fileutils.nuke_tree(path)
+        for member in members:
+            tar.extract(member, dest_dir, set_attrs=not member.isdir())
+    finally:
+        tar.close()
+    return
+
+
+##############################################################################
+### Server
+###
+
+class IngestServer:
+
+    def __init__(self, root, host='127.0.0.1', port=default_port,
+                 verbose=False):
+        self.root = os.path.abspath(root)
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.tmp_dir = os.path.join(self.root, _TMP_SUBDIR)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.nb_bundles = 0
+        self._server = None
+
+    def _log(self, msg):
+        if self.verbose:
+            print('bbs.ingest> %s' % msg)
+            sys.stdout.flush()
+        return
+
+    def _part_path(self, bundle_id):
+        if len(bundle_id) != 64 or \
+           not all(c in '0123456789abcdef' for c in bundle_id):
+            raise IngestError('invalid bundle id: %s' % bundle_id)
+        return os.path.join(self.tmp_dir, bundle_id + '.part')
+
+    def _received_size(self, bundle_id):
+        part_path = self._part_path(bundle_id)
+        if os.path.exists(part_path):
+            return os.path.getsize(part_path)
+        return 0
+
+    def _write_chunk(self, header, data):
+        part_path = self._part_path(header['id'])
+        offset = header['offset']
+        if offset == 0:
+            mode = 'wb'
+        elif offset == self._received_size(header['id']):
+            mode = 'ab'
+        else:
+            raise IngestError('unexpected offset %d for bundle %s' % \
+                              (offset, header['id']))
+        with open(part_path, mode) as f:
+            f.write(data)
+        return offset + len(data) == header['size']
+
+    def _finish_bundle(self, header):
+        bundle_id = header['id']
+        part_path = self._part_path(bundle_id)
+        try:
+            dest = _check_dest(header['dest'])
+            h = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    h.update(block)
+            if h.hexdigest() != bundle_id:
+                raise IngestError('checksum mismatch for bundle %s' % \
+                                  bundle_id)
+            unpack_bundle(part_path, os.path.join(self.root, dest))
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        self.nb_bundles += 1
+        return dest
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self._log('connection from %s' % (peer,))
+        try:
+            while True:
+                try:
+                    data = await reader.readexactly(_FRAME_HEADER.size)
+                except asyncio.IncompleteReadError as e:
+                    if len(e.partial) == 0:
+                        break  # client closed the connection
+                    raise
+                frame_type, header_len = _unpack_frame_header(data)
+                header = json.loads(await reader.readexactly(header_len))
+                payload = await reader.readexactly(header['len'])
+                if frame_type == QUERY:
+                    offset = self._received_size(header['id'])
+                    reply = _pack_frame(STATUS, {'id': header['id'],
+                                                 'offset': offset})
+                elif frame_type == CHUNK:
+                    try:
+                        complete = self._write_chunk(header, payload)
+                        if not complete:
+                            continue
+                        ## Unpacking can take a while: don't block the
+                        ## other connections.
+                        dest = await asyncio.get_running_loop().\
+                            run_in_executor(None, self._finish_bundle, header)
+                        self._log('bundle %s unpacked to %s' % \
+                                  (header['id'][:12], dest))
+                        reply = _pack_frame(ACK, {'id': header['id']})
+                    except (IngestError, OSError, tarfile.TarError) as e:
+                        self._log('ERROR: %s' % e)
+                        reply = _pack_frame(ERR, {'id': header['id'],
+                                                  'msg': str(e)})
+                else:
+                    raise IngestError('unexpected frame type %d' % frame_type)
+                writer.write(reply)
+                await writer.drain()
+        except asyncio.IncompleteReadError as e:
+            ## The connection dropped in the middle of a frame. The partial
+            ## chunk was not written so the client can resume the bundle.
+            self._log('connection from %s lost in the middle of a ' % (peer,) +
+                      'frame: %s' % e)
+        except (IngestError, ConnectionError, ValueError, KeyError) as e:
+            self._log('dropping connection from %s: %s' % (peer, e))
+        finally:
+            writer.close()
+        return
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle,
+                                                  self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._log('serving %s on %s:%d' % (self.root, self.host, self.port))
+        return
+
+    def serve_forever(self):
+        async def main():
+            await self.start()
+            async with self._server:
+                await self._server.serve_forever()
+        asyncio.run(main())
+        return
+
+### Start a server in a background thread of the current process and return
+### it. Useful for running the central node and a build node on the same
+### machine, or as a localhost stand-in for the real server when testing.
+### Use port=0 to let the OS pick a free port (available in 'server.port').
+def start_local_server(root, port=0, verbose=False):
+    server = IngestServer(root, '127.0.0.1', port, verbose)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+    server.thread = threading.Thread(target=run, daemon=True)
+    server.thread.start()
+    started.wait()
+    def stop():
+        async def shutdown():
+            server._server.close()
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        server.thread.join()
+        loop.close()
+    server.stop = stop
+    return server
+
+
+##############################################################################
+### Client
+###
+
+class IngestClient:
+
+    def __init__(self, host='127.0.0.1', port=default_port, timeout=300.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        ## Bundles sent but not acknowledged yet (bundle id -> bundle), in
+        ## sending order.
+        self.pending = collections.OrderedDict()
+        ## (bundle, error message) tuples.
+        self.failed = []
+
+    def connect(self):
+        if self.sock == None:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 timeout=self.timeout)
+        return
+
+    def close(self):
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+        return
+
+    def _recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('connection closed by ingest server')
+            data += chunk
+        return data
+
+    def _recv_frame(self):
+        frame_type, header_len = _unpack_frame_header(
+                                     self._recv_exactly(_FRAME_HEADER.size))
+        header = json.loads(self._recv_exactly(header_len))
+        self._recv_exactly(header['len'])
+        return (frame_type, header)
+
+    def _query_offset(self, bundle_id):
+        self.sock.sendall(_pack_frame(QUERY, {'id': bundle_id}))
+        frame_type, header = self._recv_frame()
+        if frame_type != STATUS or header['id'] != bundle_id:
+            raise IngestError('unexpected reply to QUERY')
+        return header['offset']
+
+    def _send_bundle(self, bundle, offset=0):
+        while True:
+            data = bundle.read(offset, chunk_size)
+            header = {'id': bundle.id, 'dest': bundle.dest,
+                      'size': bundle.size, 'offset': offset}
+            self.sock.sendall(_pack_frame(CHUNK, header, data))
+            offset += len(data)
+            if offset >= bundle.size:
+                break
+        return
+
+    def _wait_for_ack(self):
+        frame_type, header = self._recv_frame()
+        bundle = self.pending.pop(header['id'], None)
+        if bundle == None:
+            raise IngestError('unexpected acknowledgment for bundle %s' % \
+                              header['id'])
+        if frame_type == ERR:
+            self.failed.append((bundle, header['msg']))
+        elif frame_type == ACK:
+            bundle.close()
+        else:
+            raise IngestError('unexpected frame type %d' % frame_type)
+        return
+
+    ## Resume the bundles that were not acknowledged before the connection
+    ## dropped, from where the server stopped receiving them.
+    def _resume(self):
+        nbytes = 0
+        for bundle in list(self.pending.values()):
+            offset = self._query_offset(bundle.id)
+            if offset >= bundle.size:
+                offset = 0
+            self._send_bundle(bundle, offset)
+            nbytes += bundle.size - offset
+        return nbytes
+
+    ### Send 'bundles' with pipelining. Return as soon as there are less than
+    ### 'window' unacknowledged bundles, or, if 'wait' is True, when all the
+    ### bundles (including the ones sent by previous calls) are acknowledged.
+    ### If the connection drops, reconnect and resume the unacknowledged
+    ### bundles. The bundles that could not be delivered are added to
+    ### 'self.failed' (see take_failed()). Return the nb of bytes sent.
+    def send_bundles(self, bundles, wait=True, nb_attempts=3, sleeptime=10.0):
+        todo = list(bundles)
+        nbytes = 0
+        for attempt in range(nb_attempts):
+            try:
+                if self.sock == None:
+                    self.connect()
+                    nbytes += self._resume()
+                while len(todo) != 0:
+                    bundle = todo[0]
+                    ## Identical bundles have the same id.
+                    while bundle.id in self.pending:
+                        self._wait_for_ack()
+                    self._send_bundle(bundle)
+                    nbytes += bundle.size
+                    self.pending[bundle.id] = todo.pop(0)
+                    while len(self.pending) >= window:
+                        self._wait_for_ack()
+                while wait and len(self.pending) != 0:
+                    self._wait_for_ack()
+                return nbytes
+            except (OSError, ValueError, KeyError, IngestError) as e:
+                self.close()
+                if attempt == nb_attempts - 1:
+                    msg = 'failed to send bundle to %s:%d: %s' % \
+                          (self.host, self.port, e)
+                    for bundle in list(self.pending.values()) + todo:
+                        self.failed.append((bundle, msg))
+                    self.pending.clear()
+                    return nbytes
+                print('BBS>   Connection to ingest server lost (%s). ' % e + \
+                      'Will resume in %d sec.' % sleeptime)
+                time.sleep(sleeptime)
+        return nbytes
+
+    ### Wait for the acknowledgment of all the bundles sent so far.
+    def flush(self):
+        return self.send_bundles([], wait=True)
+
+    ### Return the (bundle, error message) tuples for the bundles that could
+    ### not be delivered since the last call to take_failed().
+    def take_failed(self):
+        failed = self.failed
+        self.failed = []
+        return failed
+
+    def put(self, paths, dest):
+        nbytes = self.send_bundles(make_bundles(paths, dest))
+        failed = self.take_failed()
+        for bundle, msg in failed:
+            bundle.close()
+        if len(failed) != 0:
+            raise IngestError(failed[0][1])
+        return nbytes
+
+
+##############################################################################
+### ssh tunnel and client registry
+###
+
+_clients = {}
+_tunnels = []
+
+def _free_local_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def _close_tunnels():
+    for proc in _tunnels:
+        proc.terminate()
+    return
+
+### Open an ssh tunnel from a free local port to 'port' on the central node.
+def open_tunnel(rsh_cmd, host, user, port, timeout=30.0):
+    local_port = _free_local_port()
+    if user != None:
+        host = '%s@%s' % (user, host)
+    cmd = '%s -N -o ExitOnForwardFailure=yes -L %d:127.0.0.1:%d %s' % \
+          (rsh_cmd, local_port, port, host)
+    proc = subprocess.Popen(cmd, shell=True)
+    if len(_tunnels) == 0:
+        atexit.register(_close_tunnels)
+    _tunnels.append(proc)
+    t1 = time.time()
+    while time.time() - t1 < timeout:
+        if proc.poll() != None:
+            raise IngestError('ssh tunnel command failed: %s' % cmd)
+        try:
+            socket.create_connection(('127.0.0.1', local_port), 1.0).close()
+        except OSError:
+            time.sleep(0.5)
+            continue
+        return local_port
+    proc.terminate()
+    raise IngestError('timeout while opening ssh tunnel: %s' % cmd)
+
+### Return the (shared) client for the ingest server on 'host'. A tunnel is
+### opened the first time we need to talk to a remote host.
+def get_client(host, port, rsh_cmd=None, user=None):
+    key = (host, port)
+    client = _clients.get(key)
+    if client == None:
+        if host == None or host == 'localhost':
+            client = IngestClient('127.0.0.1', port)
+        else:
+            local_port = open_tunnel(rsh_cmd, host, user, port)
+            client = IngestClient('127.0.0.1', local_port)
+        _clients[key] = client
+    return client
+
+def get_clients():
+    return list(_clients.values())
+
+
+##############################################################################
+### Pushing a directory
+###
+
+### The signature of a file or dir: nb of files, total size, and most recent
+### modification time.
+def _entry_signature(path):
+    st = os.lstat(path)
+    nb_files, size, mtime_ns = 1, st.st_size, st.st_mtime_ns
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                nb_files += 1
+                size += st.st_size
+                mtime_ns = max(mtime_ns, st.st_mtime_ns)
+    return [nb_files, size, mtime_ns]
+
+### Send the top-level entries of 'src_dir' that are new or changed since
+### the previous call (like 'rsync src_dir/ dest' would) and return the nb
+### of bytes sent. What was sent is recorded in the 'push_manifest_file' file
+### in 'src_dir' so the manifest goes away with the dir.
+def push_dir(client, src_dir, dest):
+    manifest_path = os.path.join(src_dir, push_manifest_file)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    signatures = {}
+    paths = []
+    for name in sorted(os.listdir(src_dir)):
+        if name == push_manifest_file:
+            continue
+        signature = _entry_signature(os.path.join(src_dir, name))
+        if manifest.get(name) != signature:
+            signatures[name] = signature
+            paths.append(os.path.join(src_dir, name))
+    if len(paths) == 0:
+        return 0
+    bundles = make_bundles(paths, dest)
+    nbytes = client.send_bundles(bundles)
+    failed = client.take_failed()
+    failed_bundles = [bundle for bundle, msg in failed]
+    for bundle in bundles:
+        if bundle in failed_bundles:
+            continue
+        for path in bundle.paths:
+            name = os.path.basename(path)
+            manifest[name] = signatures[name]
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    for bundle in failed_bundles:
+        bundle.close()
+    if len(failed) != 0:
+        raise IngestError(failed[0][1])
+    return nbytes
+
+def _push_main(argv):
+    parser = argparse.ArgumentParser(prog='python3 bbs/ingest.py push')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--rsh', default=None)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('src_dir')
+    parser.add_argument('dest')
+    args = parser.parse_args(argv)
+    t1 = time.time()
+    try:
+        client = get_client(args.host, args.port, args.rsh, args.user)
+        nbytes = push_dir(client, args.src_dir, args.dest)
+    except (IngestError, OSError) as e:
+        sys.exit('ERROR: %s' % e)
+    print('%d bytes sent in %.2f seconds' % (nbytes, time.time() - t1))
+    return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'push':
+        _push_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) not in [2, 3]:
+        sys.exit('Usage: python3 bbs/ingest.py <root> [<port>]\n' + \
+                 '   or: python3 bbs/ingest.py push [options] <src_dir> <dest>')
+    root = sys.argv[1]
+    if len(sys.argv) == 3:
+        port = int(sys.argv[2])
+    else:
+        port = default_port
+    IngestServer(root, port=port, verbose=True).serve_forever()
@@ -4,7 +4,7 @@
 ## This file is part of the BBS software (Bioconductor Build System).
 ##
 ## Author: Hervé Pagès <hpages.on.github@gmail.com>
-## Last modification: Dec 6, 2021
+## Last modification: Oct 19, 2026
 ##
 ## bbs.jobs module
 ##
@@ -12,11 +12,15 @@
 import sys
 import os
 import errno
+import shutil
+import shlex
 import subprocess
 import signal
 import datetime
 import time
 import socket
+import threading
+import concurrent.futures
 if sys.platform == "win32":
     import psutil
     #import win32api
@@ -35,6 +39,7 @@ if sys.platform == "win32":
 
 sys.path.insert(0, os.path.dirname(__file__))
 import parse
+import fileutils
 
 
 ##############################################################################
@@ -254,14 +259,28 @@ def killProc(pid):
         except psutil.AccessDenied:
             print("BBS>       Access denied (pid=%s)."  % child.pid)
 
+## Copy the output of 'proc' to sys.stdout as it comes, and append it to
+## list 'capture'. Runs in its own thread (see runJob()).
+def _teeOutput(proc, capture):
+    for line in proc.stdout:
+        capture.append(line)
+        sys.stdout.write(line.decode(errors='replace'))
+        sys.stdout.flush()
+    return
+
 ## What if cmd is not found, can't be started, or crashes?
-def runJob(cmd, stdout=None, maxtime=2400.0, verbose=False):
+## If 'capture' is a list (and 'stdout' is None), the output of the command
+## is still displayed as it comes, and is also appended to the list (as
+## bytes objects, one per line).
+def runJob(cmd, stdout=None, maxtime=2400.0, verbose=False, capture=None):
     if verbose:
         print("BBS>   runJob(): " + cmd)
-    if stdout == None:
-        out = None
-    else:
+    if stdout != None:
         out = open(stdout, 'w')
+    elif capture != None:
+        out = subprocess.PIPE
+    else:
+        out = None
     t1 = time.time()
     ## IMPORTANT: Because of shell=True, Popen() starts (at least) 2
     ## subprocesses:
@@ -270,6 +289,10 @@ def runJob(cmd, stdout=None, maxtime=2400.0, verbose=False):
     ## The command passed in cmd is started as a child of the shell
     ## (or "cmd.exe").
     proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, shell=True)
+    if out == subprocess.PIPE:
+        tee_thread = threading.Thread(target=_teeOutput, args=(proc, capture),
+                                      daemon=True)
+        tee_thread.start()
     if verbose:
         ## IMPORTANT: Which PID is returned by proc.pid?
         ##   - on Linux: it's the PID of the command passed in cmd,
@@ -312,14 +335,20 @@ def runJob(cmd, stdout=None, maxtime=2400.0, verbose=False):
                 print("ERROR!")
             else:
                 print("OK")
+    if out == subprocess.PIPE:
+        ## A process started by the command (and not killed) can keep the
+        ## pipe open.
+        tee_thread.join(timeout=10.0)
+        proc.stdout.close()
     sys.stdout.flush()
     if stdout != None:
         out.close()
     return retcode
 
-def tryHardToRunJob(cmd, nb_attempts=1, stdout=None, maxtime=60.0, sleeptime=20.0, failure_is_fatal=True, verbose=False):
+## See runJob() for 'capture'. The output of all the attempts is captured.
+def tryHardToRunJob(cmd, nb_attempts=1, stdout=None, maxtime=60.0, sleeptime=20.0, failure_is_fatal=True, verbose=False, capture=None):
     for i in range(nb_attempts):
-        retcode = runJob(cmd, stdout, maxtime, verbose)
+        retcode = runJob(cmd, stdout, maxtime, verbose, capture)
         if retcode == 0:
             return 0
         sleep(sleeptime)
@@ -330,14 +359,146 @@ def tryHardToRunJob(cmd, nb_attempts=1, stdout=None, maxtime=60.0, sleeptime=20.
     return retcode
 
 
+##############################################################################
+## Background tasks
+##
+## The background work (asynchronous products pushes, syncing of local dirs,
+## deletion of trees, cleanup of the Rcheck dirs) competes with the jobs
+## (e.g. R CMD check) for the CPU and the disk. It's run with the CPU
+## priority (nice) and I/O priority (ionice, Linux only) returned by
+## fileutils.get_background_priorities(), and the time spent in each type of
+## task is recorded (see getBackgroundTaskTimes()).
+## The external commands are prefixed with nice/ionice (see
+## makeBackgroundCmd()). The Python code is run by runInBackground() in
+## dedicated threads whose priorities were lowered.
+##
+
+## Return the command prefix (a list) that sets the background priorities.
+## Empty on Windows or if no background priorities were set.
+def getBackgroundCmdPrefix():
+    return fileutils.get_low_priority_cmd_prefix(
+               *fileutils.get_background_priorities())
+
+## 'cmd' is a shell command.
+def makeBackgroundCmd(cmd):
+    prefix = getBackgroundCmdPrefix()
+    if len(prefix) == 0:
+        return cmd
+    return '%s sh -c %s' % (' '.join(prefix), shlex.quote(cmd))
+
+_background_task_times = {}  # task type -> [nb of tasks, total time in sec]
+_background_task_times_lock = threading.Lock()
+
+## Record that a task of type 'task_type' took 'dt' seconds.
+def recordBackgroundTask(task_type, dt):
+    with _background_task_times_lock:
+        times = _background_task_times.setdefault(task_type, [0, 0.0])
+        times[0] += 1
+        times[1] += dt
+    return
+
+## Return a dict that maps each task type to a (nb_tasks, total_time) tuple.
+def getBackgroundTaskTimes():
+    with _background_task_times_lock:
+        return {task_type: tuple(times)
+                for task_type, times in _background_task_times.items()}
+
+## Runs in the background thread when it starts. On Linux, the nice value
+## and the I/O priority are per-thread attributes.
+def _lowerThreadPriority():
+    if not sys.platform.startswith('linux'):
+        return
+    tid = threading.get_native_id()
+    nice, ionice_class, ionice_level = fileutils.get_background_priorities()
+    if nice != None:
+        try:
+            nice += os.getpriority(os.PRIO_PROCESS, tid)
+            os.setpriority(os.PRIO_PROCESS, tid, min(nice, 19))
+        except OSError:
+            pass
+    ionice_args = fileutils.get_ionice_args(ionice_class, ionice_level)
+    if len(ionice_args) != 0:
+        subprocess.run(['ionice'] + ionice_args + ['-p', str(tid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return
+
+_background_executor = None       # for the tasks submitted with 'wait=False'
+_background_sync_executor = None  # for the tasks submitted with 'wait=True'
+
+def _makeBackgroundExecutor(thread_name_prefix):
+    return concurrent.futures.ThreadPoolExecutor(
+               max_workers=1,
+               thread_name_prefix=thread_name_prefix,
+               initializer=_lowerThreadPriority)
+
+## Call 'func(*args)' in a background thread. If 'wait' is False, return a
+## concurrent.futures.Future object. These tasks are run one at a time, in
+## the order they were submitted. Note that the current working directory
+## can change while such a task is running, so it should only use absolute
+## paths.
+## If 'wait' is True, wait for the call to complete and return its result
+## (or raise its exception). These tasks run in another thread, so the
+## caller doesn't wait for the 'wait=False' tasks submitted before (e.g. the
+## removal of a big tree) on top of its own task.
+def runInBackground(task_type, func, *args, wait=True):
+    global _background_executor, _background_sync_executor
+    def task():
+        t1 = time.time()
+        try:
+            return func(*args)
+        finally:
+            recordBackgroundTask(task_type, time.time() - t1)
+    if wait:
+        if _background_sync_executor == None:
+            _background_sync_executor = \
+                _makeBackgroundExecutor('bbs-background-sync')
+        return _background_sync_executor.submit(task).result()
+    if _background_executor == None:
+        _background_executor = _makeBackgroundExecutor('bbs-background')
+    return _background_executor.submit(task)
+
+## Wait for the tasks submitted with 'wait=False' to complete.
+def waitForBackgroundTasks():
+    if _background_executor != None:
+        _background_executor.submit(lambda: None).result()
+    return
+
+## Return one line per task type with the nb of tasks and the time spent
+## since 'times0' (a dict returned by an earlier call to
+## getBackgroundTaskTimes()) or since the beginning.
+def formatBackgroundTaskTimes(times0=None):
+    if times0 == None:
+        times0 = {}
+    lines = []
+    times = getBackgroundTaskTimes()
+    for task_type in sorted(times.keys()):
+        nb_tasks, total_time = times[task_type]
+        nb_tasks0, total_time0 = times0.get(task_type, (0, 0.0))
+        if nb_tasks == nb_tasks0:
+            continue
+        lines.append("%s: %d task(s), %.1f seconds" % \
+                     (task_type, nb_tasks - nb_tasks0, total_time - total_time0))
+    return lines
+
+def _logBackgroundTaskTimes(times0):
+    print("bbs.jobs.processJobQueue> Time spent in background tasks:")
+    lines = formatBackgroundTaskTimes(times0)
+    if len(lines) == 0:
+        lines = [None]
+    for line in lines:
+        print("bbs.jobs.processJobQueue>   %s" % line)
+    return
+
+
 ##############################################################################
 ## For asynchronous transmission of build products
 ##
 
 class JobProductsPusher:
-    def __init__(self, cmd, logfile=None):
+    def __init__(self, cmd, logfile=None, batch_size=10):
         self.cmd = cmd
         self.logfile = logfile
+        self.batch_size = batch_size
         if self.logfile == None:
             self.log = None
         else:
@@ -347,7 +508,7 @@ class JobProductsPusher:
         return
     def ready_to_push(self):
         return self.proc == None and \
-               self.nb_jobs_completed_since_last_push >= 10
+               self.nb_jobs_completed_since_last_push >= self.batch_size
     def start_push(self, last=False):
         if self.log != None:
             self.log.write('-----------------------------------------------\n')
@@ -359,7 +520,8 @@ class JobProductsPusher:
             self.log.write('push command: %s\n' % self.cmd)
             self.log.write('\n')
             self.log.flush()
-        self.proc = subprocess.Popen(self.cmd,
+        self.t1 = time.time()
+        self.proc = subprocess.Popen(makeBackgroundCmd(self.cmd),
                                      stdout=self.log,
                                      stderr=self.log,
                                      shell=True)
@@ -370,6 +532,7 @@ class JobProductsPusher:
     def terminate_current_push(self):
         # we don't do anything with this retcode at the moment
         retcode = self.proc.wait()
+        recordBackgroundTask('products push', time.time() - self.t1)
         if self.log != None:
             self.log.flush()
         self.proc = None
@@ -387,6 +550,192 @@ class JobProductsPusher:
         return
 
 
+##############################################################################
+## CPU pinning
+##
+
+## Environment variables that control the nb of threads (or processes) started
+## by parallel code (OpenMP, BLAS libraries, parallel::mclapply(), data.table,
+## RcppParallel, BiocParallel). By default, a lot of this code starts as many
+## threads as the machine has cores.
+thread_count_vars = ('OMP_NUM_THREADS', 'OMP_THREAD_LIMIT',
+                     'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                     'BLIS_NUM_THREADS', 'MC_CORES',
+                     'R_DATATABLE_NUM_THREADS', 'RCPP_PARALLEL_NUM_THREADS',
+                     'BIOCPARALLEL_WORKER_NUMBER')
+
+def getThreadCountEnv(nb_threads):
+    return {var: str(nb_threads) for var in thread_count_vars}
+
+## Split the CPUs that the current process is allowed to run on into
+## 'nb_slots' CPU sets of equal size (a CPU is shared by several slots if
+## 'nb_slots' is greater than the nb of CPUs). The remaining CPUs, if any,
+## are left to the products push command and other background work. Return
+## None if CPU affinity is not supported on this platform (only Linux
+## supports it).
+def makeSlotCPUSets(nb_slots):
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    nb_cpus_per_slot = max(len(cpus) // nb_slots, 1)
+    cpusets = []
+    for slot in range(nb_slots):
+        i = slot * nb_cpus_per_slot
+        cpusets.append([cpus[(i + j) % len(cpus)]
+                        for j in range(nb_cpus_per_slot)])
+    return cpusets
+
+## The CPU set of a job that holds CPU tokens from a bbs.cpubroker.CPUBroker
+## object. Token i corresponds to the i-th CPU that the current process is
+## allowed to run on (modulo the nb of CPUs), so, as long as the instances
+## sharing the broker are allowed to run on the same CPUs, their jobs never
+## share a CPU (unless the broker has more tokens than there are CPUs).
+def getTokenCPUSet(tokens):
+    cpus = sorted(os.sched_getaffinity(0))
+    cpuset = []
+    for token in tokens:
+        cpu = cpus[token % len(cpus)]
+        if cpu not in cpuset:
+            cpuset.append(cpu)
+    return cpuset
+
+## A job that needs more CPUs than the CPU set of its slot borrows the CPU
+## sets of the next slots.
+def _getJobCPUSet(slot_cpusets, slot, nb_cores):
+    cpuset = list(slot_cpusets[slot])
+    for i in range(1, len(slot_cpusets)):
+        if len(cpuset) >= nb_cores:
+            break
+        for cpu in slot_cpusets[(slot + i) % len(slot_cpusets)]:
+            if cpu not in cpuset:
+                cpuset.append(cpu)
+    return cpuset[0:max(nb_cores, len(slot_cpusets[slot]))]
+
+def _popenQueuedJob(job):
+    env = None
+    if job._tmpdir != None:
+        env = dict(os.environ)
+        env.update(JobTmpDirs.getEnv(job._tmpdir))
+    if job._cpuset == None:
+        return subprocess.Popen(job._cmd, stdout=job._output,
+                                stderr=job._output, shell=True, env=env)
+    if env == None:
+        env = dict(os.environ)
+    env.update(getThreadCountEnv(len(job._cpuset)))
+    # On Linux the CPU affinity is a per-thread attribute that is inherited
+    # by the child processes, so we pin the current thread while we start
+    # the job. This way the job (and all the processes it starts) is pinned
+    # right from the start. Unlike Popen()'s 'preexec_fn', this is safe to
+    # use in a multi-threaded program.
+    saved_cpuset = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, job._cpuset)
+    try:
+        return subprocess.Popen(job._cmd, stdout=job._output,
+                                stderr=job._output, shell=True, env=env)
+    finally:
+        os.sched_setaffinity(0, saved_cpuset)
+
+
+##############################################################################
+## Per-job temporary directories
+##
+
+## Give each job its own temporary directory (created under 'root') so we
+## know how much temporary space each job uses, and can delete what the job
+## leaves behind as soon as it's over instead of letting it accumulate in
+## the shared /tmp.
+## 'root' can be on a size-limited tmpfs. In that case, 'spill_root' should
+## be on disk: the jobs started while 'root' has less than 'min_free_space'
+## bytes available get their temporary directory there instead.
+class JobTmpDirs:
+
+    # Sample the size of the temporary dir of a running job at most every
+    # 'sampling_interval' seconds to get an approximation of its peak size.
+    # The samples are taken in a thread of their own so walking a big dir
+    # doesn't hold up the scheduling loop in processJobQueue() (and doesn't
+    # wait behind the tasks run by runInBackground()).
+    def __init__(self, root, spill_root=None, min_free_space=0,
+                 sampling_interval=30.0):
+        # Absolute paths because the tmp dirs are removed in the background
+        # (see runInBackground()).
+        self.root = os.path.abspath(root)
+        if spill_root != None:
+            spill_root = os.path.abspath(spill_root)
+        self.spill_root = spill_root
+        self.min_free_space = min_free_space
+        self.sampling_interval = sampling_interval
+        os.makedirs(self.root, exist_ok=True)
+        if spill_root != None:
+            os.makedirs(spill_root, exist_ok=True)
+        self._sampler = None
+
+    # Environment variables that point R (and most other programs) to the
+    # temporary dir. R looks at TMPDIR, TMP, and TEMP, in that order.
+    @staticmethod
+    def getEnv(tmpdir):
+        return {'TMPDIR': tmpdir, 'TMP': tmpdir, 'TEMP': tmpdir}
+
+    def _pickRoot(self):
+        if self.spill_root == None:
+            return self.root
+        try:
+            free_space = shutil.disk_usage(self.root).free
+        except OSError:
+            return self.spill_root
+        if free_space < self.min_free_space:
+            return self.spill_root
+        return self.root
+
+    def make(self, job, queue_name):
+        tmpdir = os.path.join(self._pickRoot(),
+                              '%s-%s' % (queue_name, job._name))
+        fileutils.remake_dir(tmpdir, ignore_errors=True)
+        job._tmpdir = tmpdir
+        job._tmpdir_peak_size = 0
+        job._tmpdir_sampled_at = time.time()
+        job._tmpdir_sampling = None
+
+    def _takeSample(self, job):
+        try:
+            size = fileutils.total_size(job._tmpdir)
+        except OSError:
+            # Files can disappear while we walk the dir.
+            return
+        if size > job._tmpdir_peak_size:
+            job._tmpdir_peak_size = size
+
+    # Never blocks, unless 'force' is True. In that case the sample is
+    # taken right away (the job is over and its peak size is needed by
+    # AfterRun()), after the sample in progress, if any.
+    def sample(self, job, force=False):
+        if job._tmpdir == None:
+            return
+        if force:
+            if job._tmpdir_sampling != None:
+                job._tmpdir_sampling.result()
+                job._tmpdir_sampling = None
+            self._takeSample(job)
+            return
+        t = time.time()
+        if t - job._tmpdir_sampled_at < self.sampling_interval:
+            return
+        if job._tmpdir_sampling != None and not job._tmpdir_sampling.done():
+            return
+        job._tmpdir_sampled_at = t
+        if self._sampler == None:
+            self._sampler = concurrent.futures.ThreadPoolExecutor(
+                                max_workers=1,
+                                thread_name_prefix='bbs-tmpdir-sampler',
+                                initializer=_lowerThreadPriority)
+        job._tmpdir_sampling = self._sampler.submit(self._takeSample, job)
+
+    def remove(self, job):
+        if job._tmpdir == None:
+            return
+        runInBackground('job tmpdir removal', fileutils.nuke_tree,
+                        job._tmpdir, True, wait=False)
+
+
 ##############################################################################
 ## processJobQueue()
 ##
@@ -404,6 +753,18 @@ class JobProductsPusher:
 ## to derive the "QueuedJob" class and provide your own implementation for
 ## these methods.
 class QueuedJob:
+    # Nb of CPUs the job gets when processJobQueue() pins the jobs to CPUs,
+    # and nb of tokens it takes from the CPU broker (if any). Set it to more
+    # than 1 for jobs that benefit from running in parallel.
+    nb_cores = 1
+    # The CPU broker tokens held by the job. Set by processJobQueue().
+    _cpu_tokens = None
+    # Private temporary dir of the job (see JobTmpDirs) and the largest
+    # size it was seen to reach, in bytes. Set by processJobQueue() before
+    # it calls RerunMe() and AfterRun() (or AfterTimeout()). The dir is
+    # deleted after that.
+    _tmpdir = None
+    _tmpdir_peak_size = None
     def __init__(self, name, cmd, output_file):
         self._name = name                # Job name.
         self._cmd = cmd                  # Command to execute (or None).
@@ -518,8 +879,7 @@ def _start_QueuedJob(job, verbose, nb_jobs, nb_slots, job_deps):
     job._output = open(job._output_file, 'w')
     job._nb_runs = 1
     _writeRunHeader(job._output, job._cmd, job._nb_runs)
-    job._proc = subprocess.Popen(job._cmd, stdout=job._output,
-                                 stderr=job._output, shell=True)
+    job._proc = _popenQueuedJob(job)
     if verbose and nb_slots == 1:
         ## IMPORTANT: Which PID is stored in job._proc.pid?
         ##   - on Linux: it's the PID of the command passed in cmd,
@@ -535,8 +895,7 @@ def _restart_QueuedJob(job, verbose, nb_jobs, nb_slots):
     job._output = open(job._output_file, 'a')
     job._nb_runs += 1
     _writeRunHeader(job._output, job._cmd, job._nb_runs)
-    job._proc = subprocess.Popen(job._cmd, stdout=job._output,
-                                 stderr=job._output, shell=True)
+    job._proc = _popenQueuedJob(job)
     if verbose and nb_slots == 1:
         ## IMPORTANT: Which PID is stored in job._proc.pid?
         ##   - on Linux: it's the PID of the command passed in cmd,
@@ -589,6 +948,9 @@ def _logSlotEvent(logfile, event_type, job0, slot0, slots):
     logfile.write("  - job name: %s\n" % job0._name)
     logfile.write("  - job command: %s\n" % job0._cmd)
     logfile.write("  - job output file: %s\n" % job0._output_file)
+    if job0._cpuset != None:
+        logfile.write("  - job CPUs: %s\n" % \
+                      ','.join(str(cpu) for cpu in job0._cpuset))
     logfile.write("-------------------------------------------------------------------------------\n")
     t2 = time.time()
     for slot in range(len(slots)):
@@ -628,9 +990,24 @@ def _logSummaryOfJobsWithUnprocessedDeps(job_queue):
 ## Process 'job_queue' (a JobQueue object) in parallel.
 ## Will run at most 'nb_slots' jobs simultaneously plus the products push
 ## command if any.
+## If 'cpu_broker' is specified (a bbs.cpubroker.CPUBroker object), a job
+## is started only if the broker grants job.nb_cores CPU tokens for it. The
+## tokens are released when the job is over (a job that gets rerun keeps its
+## tokens).
+## If 'cpu_pinning' is True, the jobs are pinned to the CPUs of their tokens
+## (see getTokenCPUSet()) if 'cpu_broker' is specified. Otherwise each slot
+## gets its own CPU set (see makeSlotCPUSets()) and the jobs are pinned to
+## the CPU set of their slot (extended to job.nb_cores CPUs if needed). Note
+## that the slot CPU sets of 2 instances running concurrently overlap, so
+## these instances should share a broker. The thread-count environment
+## variables (see thread_count_vars) are set to the size of the CPU set of
+## the job. Ignored on platforms that don't support CPU affinity.
+## If 'job_tmpdirs' is specified (a JobTmpDirs object), each job gets its own
+## temporary dir, which is deleted after AfterRun() (or AfterTimeout()).
 def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
                     products_push_cmd=None, products_push_logfile=None,
-                    verbose=False):
+                    verbose=False, products_push_batch_size=10,
+                    cpu_broker=None, cpu_pinning=False, job_tmpdirs=None):
     jobs = job_queue._jobs
     job_deps = job_queue._job_deps
     nb_jobs = len(jobs)
@@ -639,8 +1016,20 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
         print("bbs.jobs.processJobQueue>", end=" ")
         print("%d jobs in the queue. Start processing them using %d slots" % \
               (nb_jobs, nb_slots))
+    background_task_times0 = getBackgroundTaskTimes()
+    slot_cpusets = None
+    if cpu_pinning:
+        slot_cpusets = makeSlotCPUSets(nb_slots)
+        if verbose and slot_cpusets != None:
+            if cpu_broker != None:
+                print("bbs.jobs.processJobQueue> Pinning jobs to the CPUs of their CPU broker tokens")
+            else:
+                print("bbs.jobs.processJobQueue> Pinning jobs to %d CPU(s) per slot" % \
+                      len(slot_cpusets[0]))
     slotevents_logfile = open('JobQueue-%s-slot-events.log' % job_queue._name, 'w')
-    processed_jobs = []
+    ## A dict rather than a list for fast membership tests in
+    ## _unprocessedDeps() (values are not used).
+    processed_jobs = {}
     nb_busy_slots = 0
     slots = [None] * nb_slots
     slot = -1
@@ -649,7 +1038,8 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
     cumul = 0
     if products_push_cmd != None:
         products_pusher = JobProductsPusher(products_push_cmd,
-                                            products_push_logfile)
+                                            products_push_logfile,
+                                            products_push_batch_size)
     while len(processed_jobs) < nb_jobs:
         slot += 1
         if slot == nb_slots:
@@ -665,6 +1055,8 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
             status = _check_QueuedJob_status(job, maxtime_per_job, verbose,
                                              nb_jobs, nb_slots)
             if status == 0: # slot is still busy
+                if job_tmpdirs != None:
+                    job_tmpdirs.sample(job)
                 nb_consecutive_loops_with_busy_slot += 1
                 if nb_consecutive_loops_with_busy_slot == nb_slots:
                     # We just visited all the slots and they are all busy.
@@ -677,6 +1069,8 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
                 continue
             nb_consecutive_loops_with_busy_slot = 0
             job._output.close()
+            if job_tmpdirs != None:
+                job_tmpdirs.sample(job, force=True)
             if status == 1: # returned in time
                 if job.RerunMe():
                     sleep(5.0)
@@ -688,13 +1082,19 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
             else: # timed out
                 job._ended_at = dateString(time.localtime(job._t2))
                 job.AfterTimeout(maxtime_per_job)
-            processed_jobs.append(job._name)
+            if job_tmpdirs != None:
+                job_tmpdirs.remove(job)
+            processed_jobs[job._name] = None
             slots[slot] = None
             nb_busy_slots -= 1
+            if job._cpu_tokens != None:
+                cpu_broker.release(job._cpu_tokens)
+                job._cpu_tokens = None
             _logSlotEvent(slotevents_logfile, 'REMOVE', job, slot, slots)
             if products_push_cmd != None:
                 products_pusher.nb_jobs_completed_since_last_push += 1
         # Slot 'slot' is available
+        waiting_for_cpu = False
         while True:
             job_rank = len(processed_jobs) + nb_busy_slots
             if job_rank == nb_jobs:
@@ -706,9 +1106,25 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
             # we should wait and try again later.
             if job == None:
                 break
+            if job._cmd != None and cpu_broker != None:
+                job._cpu_tokens = cpu_broker.try_acquire(job.nb_cores)
+                if job._cpu_tokens == None:
+                    # The job will be picked up again next time. Note that
+                    # we don't set its '_rank' attribute yet.
+                    waiting_for_cpu = True
+                    break
             job._rank = job_rank
             if job._cmd != None:
                 job._slot = slot
+                if slot_cpusets != None and job._cpu_tokens != None:
+                    job._cpuset = getTokenCPUSet(job._cpu_tokens)
+                elif slot_cpusets != None:
+                    job._cpuset = _getJobCPUSet(slot_cpusets, slot,
+                                                job.nb_cores)
+                else:
+                    job._cpuset = None
+                if job_tmpdirs != None:
+                    job_tmpdirs.make(job, job_queue._name)
                 slots[slot] = _start_QueuedJob(job, verbose, nb_jobs, nb_slots,
                                                job_deps)
                 nb_busy_slots += 1
@@ -717,7 +1133,15 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
             # SKIP the job
             if verbose:
                 _logActionOnQueuedJob("SKIP", job, nb_jobs, 1, job_deps)
-            processed_jobs.append(job._name)
+            processed_jobs[job._name] = None
+        if waiting_for_cpu:
+            # Treat the slot as busy so we take a break after visiting all
+            # the slots instead of asking the broker in a tight loop.
+            nb_consecutive_loops_with_busy_slot += 1
+            if nb_consecutive_loops_with_busy_slot >= nb_slots:
+                sleep(1)
+                nb_consecutive_loops_with_busy_slot = 0
+            continue
         nb_consecutive_loops_with_busy_slot = 0
     slotevents_logfile.close()
     if products_push_cmd != None:
@@ -727,6 +1151,8 @@ def processJobQueue(job_queue, nb_slots=1, maxtime_per_job=3600.0,
         print("bbs.jobs.processJobQueue> Finished.")
         if job_deps != None:
             _logSummaryOfJobsWithUnprocessedDeps(job_queue)
+        waitForBackgroundTasks()
+        _logBackgroundTaskTimes(background_task_times0)
         print()
     return cumul
 
@@ -4,7 +4,7 @@
 ### This file is part of the BBS software (Bioconductor Build System).
 ###
 ### Author: Hervé Pagès <hpages.on.github@gmail.com>
-### Last modification: Sep 9, 2020
+### Last modification: Oct 19, 2026
 ###
 ### bbs.parse module
 ###
@@ -17,6 +17,10 @@ import os
 import re
 import time
 import subprocess
+import tempfile
+import shutil
+import functools
+import json
 
 
 def bytes2str(line):
@@ -81,10 +85,93 @@ class DcfParsingError(Exception):
                 (self.lineno, self.msg)
         return s
 
-### Return a list of DCF records. Each record is represented as a dictionary
-### of key-value pairs where the key is a DCF field name and the value a
-### string.
-def parse_DCF(filepath, merge_records=False):
+### Return the content of a DCF file as a list of lines (str, without the
+### trailing newline). The file is read and decoded in one go. Only if it's
+### not valid UTF-8 do we decode it line by line like bytes2str() does (some
+### lines could be UTF-8 and others iso8859).
+def _read_DCF_lines(filepath):
+    if isinstance(filepath, str):
+        with open(filepath, 'rb') as f:
+            data = f.read()
+    else:
+        ## We assume 'filepath' is a file-like object that was opened
+        ## with open() or urllib.request.urlopen().
+        data = filepath.read()
+    if isinstance(data, str):
+        text = data
+    else:
+        try:
+            text = data.decode()
+        except UnicodeDecodeError:
+            text = '\n'.join(bytes2str(line) for line in data.split(b'\n'))
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+### Iterate over the records of a DCF file. Each record is represented as a
+### dictionary of key-value pairs where the key is a DCF field name and the
+### value a string. If 'fields' is specified (list, tuple or set of field
+### names), the records only contain these fields (when present).
+def iter_DCF(filepath, fields=None):
+    if fields != None and not isinstance(fields, (set, frozenset)):
+        fields = frozenset(fields)
+    rec = None
+    keep = True
+    lineno = 0
+    for line in _read_DCF_lines(filepath):
+        lineno += 1
+        ## Same logic as in _parse_DCF_linewise() below but we avoid calling
+        ## strip() on lines that obviously are not empty (most lines).
+        c = line[:1]
+        if c == '' or (c.isspace() and line.isspace()):
+            ## The current line is empty.
+            if rec != None:
+                yield rec
+                rec = None
+            continue
+        if c == '#':
+            continue  # skip comment lines
+        if c == ' ' or c == '\t':
+            if rec == None:
+                msg = 'whitespace unexpected at beginning of line'
+                raise DcfParsingError(filepath, lineno, msg)
+            ## The current line is the continuation of the latest value.
+            if keep:
+                line2 = line.strip()
+                val = rec[key]
+                rec[key] = line2 if val == '' else val + ' ' + line2
+            continue
+        pos = line.find(':')
+        if pos == -1:
+            what = '\':\'' if rec == None else 'leading whitespace'
+            msg = 'invalid line (%s missing?)' % what
+            raise DcfParsingError(filepath, lineno, msg)
+        ## The current line is a key-value pair.
+        if rec == None:
+            ## The current line is the first key-value pair in the record.
+            rec = {}
+        key = line[:pos]
+        keep = fields == None or key in fields
+        if keep:
+            rec[key] = line[pos+1:].strip()
+    if rec != None:
+        yield rec
+    return
+
+### Return a list of DCF records (see iter_DCF() above).
+def parse_DCF(filepath, merge_records=False, fields=None):
+    if not merge_records:
+        return list(iter_DCF(filepath, fields))
+    rec1 = {}
+    for rec in iter_DCF(filepath, fields):
+        rec1.update(rec)
+    return rec1
+
+### The original line-by-line implementation of parse_DCF(). Slower (it
+### decodes each line separately). Only kept as a reference for
+### test/python/benchmark_DCF_parser.py.
+def _parse_DCF_linewise(filepath, merge_records=False):
     if isinstance(filepath, str):
         f = open(filepath, 'rb')
     else:
@@ -163,13 +250,19 @@ class DcfFieldNotFoundError(Exception):
 ###   - if full_line is False: it ends at the first whitespace following
 ###     the start of the value.
 ###   - if the value is empty, return ""
-def get_next_DCF_fieldval(dcf, full_line=False):
+@functools.lru_cache(maxsize=None)
+def _DCF_val_regex(field, full_line):
     if full_line:
         val_regex = '\\S.*'
     else:
         val_regex = '\\S+'
-    regex = '([A-Za-z0-9_.-]+)\\s*:\\s*(%s)' % val_regex
-    p = re.compile(regex)
+    if field == None:
+        field = '([A-Za-z0-9_.-]+)'
+    regex = '%s\\s*:\\s*(%s)' % (field, val_regex)
+    return re.compile(regex)
+
+def get_next_DCF_fieldval(dcf, full_line=False):
+    p = _DCF_val_regex(None, full_line)
     for line in dcf:
         line = bytes2str(line)
         m = p.match(line)
@@ -181,15 +274,17 @@ def get_next_DCF_fieldval(dcf, full_line=False):
 
 ### Get the next value of the field specified by the user from a DCF file.
 def get_next_DCF_val(dcf, field, full_line=False):
-    if full_line:
-        val_regex = '\\S.*'
-    else:
-        val_regex = '\\S+'
-    regex = '%s\\s*:\\s*(%s)' % (field, val_regex)
-    p = re.compile(regex)
+    p = _DCF_val_regex(field, full_line)
+    prefix = field + ":"
+    ## Lines that obviously don't start with the field are skipped without
+    ## being decoded. Only works if the field name is pure ASCII.
+    bprefix = prefix.encode() if prefix.isascii() else None
     for line in dcf:
+        if bprefix != None and isinstance(line, bytes) and \
+           not line.startswith(bprefix):
+            continue
         line = bytes2str(line)
-        if not line.startswith(field + ":"):
+        if not line.startswith(prefix):
             continue
         m = p.match(line)
         if m:
@@ -200,6 +295,92 @@ def get_next_DCF_val(dcf, field, full_line=False):
     return None
 
 
+##############################################################################
+### Package metadata snapshot
+###
+### BBS-prerun.py writes a snapshot of the metadata of all the packages in
+### the meat index (Package, Version, PackageStatus, .BBSoptions, and vcs
+### metadata) next to meat-index.dcf. Once loaded with load_pkg_snapshot(),
+### the functions below that extract metadata from a package source tree
+### (get_Package_from_pkgsrctree(), get_Version_from_pkgsrctree(),
+### parse_BBSoptions_from_pkgsrctree(), etc...) use the snapshot instead of
+### opening the DESCRIPTION and .BBSoptions files of the package. Only the
+### basename of the source tree is used to look up the package in the
+### snapshot. Packages that are not in the snapshot are handled as usual.
+### So are packages whose DESCRIPTION or .BBSoptions file differs from the
+### one the snapshot was made from (the size and mtime of the files are
+### recorded in the snapshot, and the nodes sync the meat with 'rsync -t'
+### which preserves the mtimes). In that case the usual caches (e.g.
+### _BBSoptions_cache) take over.
+###
+
+pkg_snapshot_format = 2
+
+_pkg_snapshot = None
+
+### 'filepath' can be a path or a file-like object. Return True if the
+### snapshot was loaded, or False if it's not in a format we know about.
+def load_pkg_snapshot(filepath):
+    global _pkg_snapshot
+    if isinstance(filepath, str):
+        with open(filepath, 'rb') as f:
+            snapshot = json.loads(f.read())
+    else:
+        snapshot = json.loads(filepath.read())
+    if snapshot.get('format') != pkg_snapshot_format:
+        return False
+    _pkg_snapshot = snapshot
+    return True
+
+def unload_pkg_snapshot():
+    global _pkg_snapshot
+    _pkg_snapshot = None
+    return
+
+def get_pkg_snapshot_entry(pkg):
+    if _pkg_snapshot == None:
+        return None
+    return _pkg_snapshot['packages'].get(pkg)
+
+### Return the vcs metadata of a package (or the top-level vcs metadata if
+### 'pkg' is None) as a dict, or None if not available.
+def get_vcs_meta_from_pkg_snapshot(pkg=None):
+    if _pkg_snapshot == None:
+        return None
+    if pkg == None:
+        return _pkg_snapshot['vcs']
+    entry = _pkg_snapshot['packages'].get(pkg)
+    return None if entry == None else entry['vcs']
+
+### A (size, mtime) signature that survives a copy with 'rsync -t' (the
+### mtime is truncated to the second because not all filesystems store
+### sub-second mtimes). None if the file doesn't exist.
+def _snapshot_file_signature(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return [st.st_size, int(st.st_mtime)]
+
+### The signatures of the files that the snapshot entry of a package is made
+### from. Stored in the entry by BBS-prerun.py.
+def get_pkg_snapshot_signatures(pkgsrctree):
+    return {'DESCRIPTION': _snapshot_file_signature(
+                               get_DESCRIPTION_path(pkgsrctree)),
+            'BBSoptions': _snapshot_file_signature(
+                              get_BBSoptions_path(pkgsrctree))}
+
+def _get_pkg_snapshot_entry_from_pkgsrctree(pkgsrctree):
+    if _pkg_snapshot == None:
+        return None
+    pkg = os.path.basename(os.path.normpath(pkgsrctree))
+    entry = _pkg_snapshot['packages'].get(pkg)
+    if entry == None or \
+       entry['signatures'] != get_pkg_snapshot_signatures(pkgsrctree):
+        return None
+    return entry
+
+
 ##############################################################################
 ### Parse a DESCRIPTION file
 ###
@@ -208,6 +389,9 @@ def get_DESCRIPTION_path(pkgsrctree):
     return os.path.join(pkgsrctree, 'DESCRIPTION')
 
 def get_Package_from_pkgsrctree(pkgsrctree):
+    entry = _get_pkg_snapshot_entry_from_pkgsrctree(pkgsrctree)
+    if entry != None:
+        return entry['Package']
     desc_file = get_DESCRIPTION_path(pkgsrctree)
     dcf = open(desc_file, 'rb')
     pkg = get_next_DCF_val(dcf, 'Package')
@@ -217,6 +401,9 @@ def get_Package_from_pkgsrctree(pkgsrctree):
     return pkg
 
 def get_Version_from_pkgsrctree(pkgsrctree):
+    entry = _get_pkg_snapshot_entry_from_pkgsrctree(pkgsrctree)
+    if entry != None:
+        return entry['Version']
     desc_file = get_DESCRIPTION_path(pkgsrctree)
     dcf = open(desc_file, 'rb')
     version = get_next_DCF_val(dcf, 'Version')
@@ -234,6 +421,9 @@ def make_srcpkg_file_from_pkgsrctree(pkgsrctree):
     return srcpkg_file
 
 def get_PackageStatus_pkgsrctree(pkgsrctree):
+    entry = _get_pkg_snapshot_entry_from_pkgsrctree(pkgsrctree)
+    if entry != None:
+        return entry['PackageStatus']
     desc_file = get_DESCRIPTION_path(pkgsrctree)
     dcf = open(desc_file, 'rb')
     version = get_next_DCF_val(dcf, 'PackageStatus')
@@ -242,15 +432,115 @@ def get_PackageStatus_pkgsrctree(pkgsrctree):
         return "OK"
     return version
 
-def get_Maintainer_from_pkgsrctree(pkgsrctree):
+### Maintainers resolved by prefetch_Maintainers(), keyed by the absolute
+### path to the DESCRIPTION file. Each entry is a (mtime_ns, size, inode,
+### maintainer) tuple (see _BBSoptions_cache below).
+_Maintainer_cache = {}
+
+def _DESCRIPTION_signature(desc_file):
+    try:
+        st = os.stat(desc_file)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _cache_Maintainer(desc_file, maintainer):
+    signature = _DESCRIPTION_signature(desc_file)
+    if signature != None:
+        _Maintainer_cache[desc_file] = signature + (maintainer,)
+    return
+
+def _get_cached_Maintainer(desc_file):
+    cached = _Maintainer_cache.get(desc_file)
+    if cached == None or cached[0:3] != _DESCRIPTION_signature(desc_file):
+        return None
+    return cached[3]
+
+def _get_Rscript_cmd_and_script_path():
     r_home = os.environ['BBS_R_HOME']
     BBS_home = os.environ['BBS_HOME']
-    desc_file = get_DESCRIPTION_path(pkgsrctree)
-    FNULL = open(os.devnull, 'w')
     Rscript_cmd = os.path.join(r_home, "bin", "Rscript")
     script_path = os.path.join(BBS_home, "utils", "getMaintainer.R")
-    cmd = [Rscript_cmd, '--vanilla', script_path, desc_file]
-    maintainer = bytes2str(subprocess.check_output(cmd, stderr=FNULL))
+    return (Rscript_cmd, script_path)
+
+### What utils/getMaintainer.R returns, but without starting R, when the
+### DESCRIPTION file has a Maintainer field (i.e. the Maintainer doesn't
+### need to be extracted from the Authors@R field). Return None if we can't
+### tell without R.
+def _get_plain_Maintainer(desc_file):
+    try:
+        desc = parse_DCF(desc_file, merge_records=True,
+                         fields=('Maintainer', 'Encoding'))
+    except (OSError, DcfParsingError):
+        return None
+    maintainer = desc.get('Maintainer')
+    if maintainer == None:
+        return None
+    ## R would re-encode the fields of a DESCRIPTION file that uses an
+    ## encoding other than UTF-8.
+    encoding = desc.get('Encoding')
+    if encoding != None and encoding.upper().replace('-', '') != 'UTF8':
+        return None
+    if maintainer == '':
+        return 'NA'
+    return maintainer
+
+### Resolve the Maintainer of all the packages in 'pkgsrctrees' in a single
+### pass, so the subsequent calls to get_Maintainer_from_pkgsrctree() (and
+### to the name/email getters below) don't need to start an Rscript process
+### per call. A plain Maintainer field is resolved in-process. The packages
+### that only have an Authors@R field are resolved by a single call to
+### utils/getMaintainer.R in batch mode. Packages that can't be resolved
+### this way (e.g. if the batch call fails) will go thru the per-package
+### call later. Return the nb of packages resolved.
+def prefetch_Maintainers(pkgsrctrees):
+    nb_resolved = 0
+    to_resolve_with_R = []
+    for pkgsrctree in pkgsrctrees:
+        desc_file = os.path.abspath(get_DESCRIPTION_path(pkgsrctree))
+        maintainer = _get_plain_Maintainer(desc_file)
+        if maintainer != None:
+            _cache_Maintainer(desc_file, maintainer)
+            nb_resolved += 1
+        elif os.path.exists(desc_file):
+            to_resolve_with_R.append(desc_file)
+    if len(to_resolve_with_R) == 0:
+        return nb_resolved
+    Rscript_cmd, script_path = _get_Rscript_cmd_and_script_path()
+    tmpdir = tempfile.mkdtemp(prefix='getMaintainer')
+    try:
+        infile = os.path.join(tmpdir, 'DESCRIPTION-files.txt')
+        outfile = os.path.join(tmpdir, 'Maintainers.txt')
+        with open(infile, 'w') as f:
+            for desc_file in to_resolve_with_R:
+                f.write('%s\n' % desc_file)
+        cmd = [Rscript_cmd, '--vanilla', script_path,
+               '--batch', infile, outfile]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+            with open(outfile, 'rb') as f:
+                lines = f.read().splitlines()
+        except (OSError, subprocess.CalledProcessError):
+            return nb_resolved
+        ## One line per DESCRIPTION file, in the same order.
+        if len(lines) != len(to_resolve_with_R):
+            return nb_resolved
+        for desc_file, line in zip(to_resolve_with_R, lines):
+            _cache_Maintainer(desc_file, bytes2str(line))
+            nb_resolved += 1
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return nb_resolved
+
+def get_Maintainer_from_pkgsrctree(pkgsrctree):
+    desc_file = get_DESCRIPTION_path(pkgsrctree)
+    maintainer = _get_cached_Maintainer(os.path.abspath(desc_file))
+    if maintainer == None:
+        Rscript_cmd, script_path = _get_Rscript_cmd_and_script_path()
+        FNULL = open(os.devnull, 'w')
+        cmd = [Rscript_cmd, '--vanilla', script_path, desc_file]
+        maintainer = bytes2str(subprocess.check_output(cmd, stderr=FNULL))
     if maintainer == 'NA':
         raise DcfFieldNotFoundError(desc_file, 'Maintainer')
     return maintainer
@@ -284,22 +574,95 @@ def get_Maintainer_email_from_pkgsrctree(pkgsrctree):
 def get_BBSoptions_path(pkgsrctree):
     return os.path.join(pkgsrctree, '.BBSoptions')
 
-### Return a dictionary if the package source tree contains a .BBSoptions
-### file that is valid DCF, or None otherwise.
-def parse_BBSoptions_from_pkgsrctree(pkgsrctree):
-    filepath = get_BBSoptions_path(pkgsrctree)
+### Parsed .BBSoptions files, keyed by path. Each entry is a
+### (mtime_ns, size, inode, options) tuple so an entry is ignored as soon as
+### the file is modified or replaced (e.g. when the source tree is refreshed).
+_BBSoptions_cache = {}
+
+def _parse_BBSoptions_file(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        _BBSoptions_cache.pop(filepath, None)
+        return None
+    cached = _BBSoptions_cache.get(filepath)
+    signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if cached != None and cached[0:3] == signature:
+        return cached[3]
     try:
         options = parse_DCF(filepath, merge_records=True)
     except:
         options = None
+    _BBSoptions_cache[filepath] = signature + (options,)
     return options
 
+### Return a dictionary if the package source tree contains a .BBSoptions
+### file that is valid DCF, or None otherwise.
+def parse_BBSoptions_from_pkgsrctree(pkgsrctree):
+    entry = _get_pkg_snapshot_entry_from_pkgsrctree(pkgsrctree)
+    if entry != None:
+        options = entry['BBSoptions']
+    else:
+        filepath = os.path.abspath(get_BBSoptions_path(pkgsrctree))
+        options = _parse_BBSoptions_file(filepath)
+    ## Return a copy so the caller can't mess up the cache.
+    return None if options == None else dict(options)
+
 def get_BBSoption_from_pkgsrctree(pkgsrctree, key):
     options = parse_BBSoptions_from_pkgsrctree(pkgsrctree)
     if options == None:
         return None
     return options.get(key)
 
+### Typed accessors for the options documented in Doc/BBSoptions.md.
+
+### For the INSTALLprepend, BUILDprepend, CHECKprepend, and BUILDBINprepend
+### options. The platform-specific variant (e.g. CHECKprepend.win) wins over
+### the generic option. Return None if the option is not set.
+def get_BBSoption_prepend(pkgsrctree, key_prefix, platform=None):
+    options = parse_BBSoptions_from_pkgsrctree(pkgsrctree)
+    if options == None:
+        return None
+    if platform == None:
+        platform = sys.platform
+    key = key_prefix + 'prepend'
+    prepend = options.get(key)
+    if platform == 'win32':
+        prepend_win = options.get(key + '.win')
+        if prepend_win != None:
+            prepend = prepend_win
+    elif platform == 'darwin':
+        prepend_mac = options.get(key + '.mac')
+        if prepend_mac != None:
+            prepend = prepend_mac
+    return prepend
+
+### For the UnsupportedPlatforms and NoExamplesOnPlatforms options. Return
+### the comma-separated list of platforms as a list of strings (empty list
+### if the option is not set).
+def get_BBSoption_platforms(pkgsrctree, key):
+    val = get_BBSoption_from_pkgsrctree(pkgsrctree, key)
+    if val == None:
+        return []
+    return [item.strip() for item in val.replace(" ", "").split(",")]
+
+### For TRUE/FALSE options like RunLongTests.
+def get_BBSoption_flag(pkgsrctree, key, default=False):
+    val = get_BBSoption_from_pkgsrctree(pkgsrctree, key)
+    if val == None:
+        return default
+    return val.lower() == "true"
+
+### For integer options like NbCores.
+def get_BBSoption_int(pkgsrctree, key, default=None):
+    val = get_BBSoption_from_pkgsrctree(pkgsrctree, key)
+    if val == None:
+        return default
+    try:
+        return int(val)
+    except ValueError:
+        return default
+
 
 ##############################################################################
 ### Extract specific fields from a package index in DCF format
@@ -321,12 +684,12 @@ def getPkgFieldFromDCF(dcf, pkg, field, data_desc):
 ### Return the list of package names if 'as_dict' is False, otherwise a dict
 ### with the package names as keys.
 def get_meat_packages(meat_index_file, as_dict=False):
-    dcf_records = parse_DCF(meat_index_file)
     if as_dict:
         meat_index = {}
-        for dcf_record in dcf_records:
+        for dcf_record in iter_DCF(meat_index_file):
             meat_index[dcf_record['Package']] = dcf_record
         return meat_index
+    dcf_records = iter_DCF(meat_index_file, fields=['Package'])
     pkgs = [dcf_record['Package'] for dcf_record in dcf_records]
     pkgs.sort(key=str.lower)
     return pkgs
@@ -364,7 +727,8 @@ def _is_supported(unsupported_platforms, node_hostname,
 ### 'node_hostname', as specified in BBS/nodes/nodespecs.py.
 def get_meat_packages_for_node(meat_index_file, node_hostname,
                                node_Arch=None, node_pkgType=None):
-    dcf_records = parse_DCF(meat_index_file)
+    dcf_records = iter_DCF(meat_index_file,
+                           fields=['Package', 'UnsupportedPlatforms'])
     pkgs = []
     for dcf_record in dcf_records:
         pkg = dcf_record['Package']
@@ -456,37 +820,43 @@ def load_pkg_dep_graph(filepath):
 ### and 'R CMD check' output.
 ###
 
+### Return the last 'n' lines of a file (as a list of strings, with the
+### trailing newlines). The file is read backwards by blocks, starting from
+### the end, until we have enough lines, so only the end of the file is read
+### no matter how big the file is.
+_TAIL_BLOCK_SIZE = 8192
+
 def readFileTail(filename, n):
-    last_lines = n * [None]
+    if n <= 0:
+        return []
     f = open(filename, 'rb')
-    nb_lines = i = 0
-    for line in f:
-        line = bytes2str(line)
-        nb_lines += 1
-        if n != 0:
-            last_lines[i] = line
-            i += 1
-            if i >= n:
-                i = 0
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    data = b''
+    ## We need n+1 newlines to be sure that the first of the last n lines
+    ## is complete (the last line might not end with a newline).
+    while pos > 0 and data.count(b'\n') <= n:
+        size = min(_TAIL_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        data = f.read(size) + data
     f.close()
-    if nb_lines < n:
-        n2 = nb_lines
-        i = 0
-    else:
-        n2 = n
-    tail = n2 * [None]
-    for j in range(n2):
-        tail[j] = last_lines[i]
-        i += 1
-        if i >= n:
-            i = 0
-    return tail
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last != b'':
+        lines.append(last)
+    if pos > 0:
+        ## The first line is incomplete.
+        lines = lines[1:]
+    return [bytes2str(line) for line in lines[-n:]]
 
 ### Assume 'out_file' is a file containing the output of 'R CMD INSTALL' or
 ### 'install.packages()'.
 ### Only parse the last 12 lines of the output file.
-def installPkgWasOK(out_file, pkg):
-    tail = readFileTail(out_file, 12)
+def installPkgWasOK(out_file, pkg, tail=None):
+    if tail == None:
+        tail = readFileTail(out_file, 12)
     # We're looking for bad news instead of good news. That's because there is
     # nothing that indicates success in the output of 'install.packages()' when
     # installing a binary package on Mac.
@@ -518,8 +888,9 @@ def installPkgWasOK(out_file, pkg):
 ### Assume 'out_file' is a file containing the output of install.packages().
 ### Extract the name of the locking package from the last 12 lines of the output
 ### file.
-def extractLockingPackage(out_file):
-    tail = readFileTail(out_file, 12)
+def extractLockingPackage(out_file, tail=None):
+    if tail == None:
+        tail = readFileTail(out_file, 12)
     regex = r'^Try removing .*/00LOCK-([\w\.]*)'
     p = re.compile(regex)
     for line in tail:
@@ -528,6 +899,17 @@ def extractLockingPackage(out_file):
             return m.group(1)
     return None
 
+### Assume 'out_file' is a file containing the output of 'R CMD INSTALL' or
+### 'install.packages()'.
+### Return all the verdicts that we need about the output in a dict, reading
+### the tail of the file only once:
+###   - 'ok': what installPkgWasOK() returns;
+###   - 'locking_pkg': what extractLockingPackage() returns.
+def analyzeInstallOutput(out_file, pkg):
+    tail = readFileTail(out_file, 12)
+    return {'ok': installPkgWasOK(out_file, pkg, tail),
+            'locking_pkg': extractLockingPackage(out_file, tail)}
+
 ### Assume 'out_file' is a file containing the output of 'R CMD check'.
 ### Only parse the last 6 lines of the output file.
 ### Return a string!
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.pkgstore module
+###
+### A store of installed R packages shared by the builds running on the same
+### node (e.g. the bioc, data-experiment, workflows, and bioc-longtests
+### builds). STAGE2 adds the packages it installs to the store, and can then
+### get a package from the store (by hardlinking or copying it into the
+### library) instead of compiling it again, when the store has an entry for
+### the exact same package.
+###
+### Each entry is addressed by a key (see make_key()) derived from the
+### package name and version, the R installation (see get_R_signature()),
+### the versions of the package direct deps (a package can embed stuff from
+### its deps at installation time, e.g. S4 class definitions), and the
+### git_last_commit of the package (for the target packages).
+###
+### Layout of the store:
+###   <store>/.lock               lock file
+###   <store>/tmp/                work area
+###   <store>/<xx>/<key>/<pkg>/   the installed package (xx = key[:2])
+###   <store>/<xx>/<key>/entry.json
+### The mtime of entry.json is the time of last use of the entry. When the
+### store gets bigger than its maximum size, the least recently used entries
+### are evicted.
+###
+
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+
+sys.path.insert(0, os.path.dirname(__file__))
+import fileutils
+
+### Return the "R <version>; <platform>" part of the Built field of an
+### installed package, e.g. "R 4.4.1; x86_64-pc-linux-gnu". Applied to the
+### Built field of the base package, this identifies the R version and
+### platform that the packages get built for.
+def get_R_signature_from_Built(Built):
+    return '; '.join(part.strip() for part in Built.split(';')[0:2])
+
+### Return the svn revision of the R installed in 'r_home' (as a string), or
+### None if we can't find it. R-devel and R-patched change between 2 builds
+### without a change of version.
+def get_R_svn_revision(r_home):
+    Rversion_h = os.path.join(r_home, 'include', 'Rversion.h')
+    try:
+        with open(Rversion_h, 'r') as f:
+            for line in f:
+                m = re.match(r'#define\s+R_SVN_REVISION\s+(\d+)', line)
+                if m != None:
+                    return m.group(1)
+    except OSError:
+        pass
+    return None
+
+### Return the SHA-256 of the content of the files in 'paths'. Paths that
+### are None or that don't exist are skipped.
+def hash_files(paths):
+    h = hashlib.sha256()
+    for path in paths:
+        if path == None:
+            continue
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except OSError:
+            continue
+        h.update(b'%d\n' % len(content))
+        h.update(content)
+    return h.hexdigest()
+
+### Return a string that identifies the R installation that the packages
+### get built with: the R version and platform (from 'Built', the Built
+### field of the base package), the svn revision of R, and a hash of the
+### files that define the compilers and compilation flags ('makefiles',
+### i.e. R's Makeconf file and the user Makevars file).
+def get_R_signature(r_home, Built, makefiles):
+    return '; '.join([get_R_signature_from_Built(Built),
+                      'r%s' % get_R_svn_revision(r_home),
+                      hash_files(makefiles)[0:16]])
+
+### Normalize a version string the way R's package_version() does (i.e.
+### "0.9-1" and "0.9.1" are the same version).
+def normalize_version(version):
+    try:
+        return '.'.join(str(int(x)) for x in re.split('[.-]', version.strip()))
+    except ValueError:
+        return version
+
+### 'dep_versions' must be a dict that maps each direct dep of 'pkg' to its
+### version. Deps with an unknown version (e.g. base packages) should be
+### mapped to None.
+def make_key(pkg, version, R_signature, dep_versions, git_last_commit=None):
+    data = [pkg, normalize_version(version), git_last_commit, R_signature,
+            sorted((dep, dep_version if dep_version == None
+                              else normalize_version(dep_version))
+                   for dep, dep_version in dep_versions.items())]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+### Copy tree 'src' to 'dst' using hardlinks if possible.
+def _link_tree(src, dst, use_hardlinks):
+    if use_hardlinks and fileutils.same_filesystem(src,
+                                                   os.path.dirname(dst)):
+        try:
+            shutil.copytree(src, dst, copy_function=os.link)
+            return
+        except (OSError, shutil.Error):
+            fileutils.nuke_tree(dst, ignore_errors=True)
+    fileutils.clone_tree(src, dst)
+
+class PkgStore:
+
+    ## 'max_size' is in bytes.
+    def __init__(self, path, max_size, use_hardlinks=True):
+        self.path = path
+        self.max_size = max_size
+        self.use_hardlinks = use_hardlinks
+        self._tmp_dir = os.path.join(path, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock_path = os.path.join(path, '.lock')
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[0:2], key)
+
+    def _tmp_path(self, name):
+        return os.path.join(self._tmp_dir, '%s.%d.%d' % \
+                            (name, os.getpid(), time.time_ns()))
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self._entry_path(key),
+                                           'entry.json'))
+
+    ## Install package 'pkg' from entry 'key' into library 'lib_path'. Any
+    ## existing installation of the package in 'lib_path' is replaced.
+    ## Return True on success and False if the store has no such entry or if
+    ## the package could not be installed.
+    def materialize(self, key, pkg, lib_path):
+        entry_path = self._entry_path(key)
+        dst = os.path.join(lib_path, pkg)
+        ## Like R CMD INSTALL, we use a 00LOCK-* dir so that a partially
+        ## installed package is never seen as installed.
+        lock_dir = os.path.join(lib_path, '00LOCK-bbs-%s' % pkg)
+        fileutils.nuke_tree(lock_dir, ignore_errors=True)
+        os.makedirs(lock_dir)
+        try:
+            ## A shared lock is enough to prevent the entry from being
+            ## evicted while we're using it.
+            with fileutils.FileLock(self._lock_path, exclusive=False):
+                if not self.has(key):
+                    return False
+                _link_tree(os.path.join(entry_path, pkg),
+                           os.path.join(lock_dir, pkg), self.use_hardlinks)
+                os.utime(os.path.join(entry_path, 'entry.json'))
+            if os.path.exists(dst):
+                os.rename(dst, os.path.join(lock_dir, 'old'))
+            os.rename(os.path.join(lock_dir, pkg), dst)
+            return True
+        except OSError:
+            return False
+        finally:
+            fileutils.nuke_tree(lock_dir, ignore_errors=True)
+
+    ## Add the package installed in 'pkg_path' to the store under 'key'.
+    ## Return True if a new entry was added.
+    def add(self, key, pkg, pkg_path):
+        if self.has(key):
+            return False
+        tmp_path = self._tmp_path(key)
+        try:
+            os.makedirs(tmp_path)
+            _link_tree(pkg_path, os.path.join(tmp_path, pkg),
+                       self.use_hardlinks)
+            entry = {'Package': pkg,
+                     'size': fileutils.total_size(tmp_path)}
+            with open(os.path.join(tmp_path, 'entry.json'), 'w') as f:
+                json.dump(entry, f)
+            entry_path = self._entry_path(key)
+            with fileutils.FileLock(self._lock_path):
+                if os.path.exists(entry_path):
+                    return False
+                os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+                os.rename(tmp_path, entry_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            fileutils.nuke_tree(tmp_path, ignore_errors=True)
+
+    ## Return a list of (last_use, size, entry_path) tuples.
+    def _list_entries(self):
+        entries = []
+        for subdir in os.listdir(self.path):
+            if len(subdir) != 2:
+                continue
+            subdir_path = os.path.join(self.path, subdir)
+            for key in os.listdir(subdir_path):
+                entry_path = os.path.join(subdir_path, key)
+                entry_file = os.path.join(entry_path, 'entry.json')
+                try:
+                    last_use = os.path.getmtime(entry_file)
+                    with open(entry_file, 'r') as f:
+                        size = json.load(f)['size']
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((last_use, size, entry_path))
+        return entries
+
+    def size(self):
+        return sum(size for last_use, size, entry_path in self._list_entries())
+
+    ## Evict the least recently used entries until the size of the store is
+    ## <= 'max_size'. Return the nb of evicted entries.
+    def evict(self, max_size=None):
+        if max_size == None:
+            max_size = self.max_size
+        evicted_paths = []
+        with fileutils.FileLock(self._lock_path):
+            entries = sorted(self._list_entries())
+            total_size = sum(size for last_use, size, entry_path in entries)
+            for last_use, size, entry_path in entries:
+                if total_size <= max_size:
+                    break
+                evicted_path = self._tmp_path(os.path.basename(entry_path))
+                try:
+                    os.rename(entry_path, evicted_path)
+                except OSError:
+                    continue
+                evicted_paths.append(evicted_path)
+                total_size -= size
+        ## The evicted entries are not visible anymore so they can be deleted
+        ## without holding the lock.
+        for evicted_path in evicted_paths:
+            fileutils.nuke_tree(evicted_path, ignore_errors=True)
+        return len(evicted_paths)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit('Usage: %s <store>' % sys.argv[0])
+    store = PkgStore(sys.argv[1], 0)
+    entries = store._list_entries()
+    size = sum(size for last_use, size, entry_path in entries)
+    print('%d entries, %s' % (len(entries), fileutils.human_readable_size(size)))
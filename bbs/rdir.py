@@ -4,18 +4,28 @@
 ### This file is part of the BBS software (Bioconductor Build System).
 ###
 ### Author: Hervé Pagès <hpages.on.github@gmail.com>
-### Last modification: Sep 3, 2020
+### Last modification: Oct 19, 2026
 ###
 ### bbs.rdir module
 ###
 
 import sys
 import os
-import urllib.request
+import re
+import shlex
+import posixpath
+import subprocess
+import time
+import http.client
+import urllib.parse
+import urllib.error
 
 sys.path.insert(0, os.path.dirname(__file__))
 import fileutils
+import parse
 import jobs
+import httputils
+import ingest
 
 def set_readable_flag(path, verbose=False):
     if sys.platform == "win32" and \
@@ -27,15 +37,143 @@ def set_readable_flag(path, verbose=False):
         jobs.runJob(cmd, None, 60.0, verbose)
     return
 
-### Expected bandwidth (in kilobits/s) for transferring data back and forth
+### Default bandwidth (in kilobits/s) for transferring data back and forth
 ### between the central and the secondary build nodes.
 ### Notes:
 ###   - This is used for triggering timeouts so in doubt estimate low.
-###   - Right now it's only used for transferring data back from the secondary
-###     nodes to the central node.
+###   - It's only used until we have measured the real throughput to a given
+###     remote (see below).
 bandwidth_in_kbps = 800.0  # 100 kilobytes per sec
 bandwidth_in_bytes_per_sec = bandwidth_in_kbps * 1000.0 / 8.0
 
+
+##############################################################################
+### Measured throughput
+###
+### We measure the throughput of each transfer to or from a remote host and
+### keep a rolling estimate (exponentially weighted moving average) per
+### remote. The estimates are persisted across runs in 'transfer_rates_file'
+### (a DCF file, typically BBS_WORK_TOPDIR/transfer-rates.dcf, set by
+### BBSvars). They are used to compute the timeouts and retry delays of the
+### transfers and the batch size of the asynchronous products pushes.
+###
+
+transfer_rates_file = None
+
+### Weight of the latest measurement in the rolling estimate.
+_rate_alpha = 0.3
+### Transfers smaller than this are dominated by latency (ssh handshake etc)
+### and don't tell us anything about the bandwidth.
+_min_sample_size = 512 * 1024
+### When computing a timeout, we allow the transfer to be this many times
+### slower than the current estimate.
+_timeout_slack = 4.0
+
+_transfer_rates = None  # dict remote -> (bytes_per_sec, nb_samples)
+
+def _load_transfer_rates():
+    global _transfer_rates
+    if _transfer_rates != None:
+        return _transfer_rates
+    _transfer_rates = {}
+    if transfer_rates_file == None or not os.path.exists(transfer_rates_file):
+        return _transfer_rates
+    try:
+        records = parse.parse_DCF(transfer_rates_file)
+        for record in records:
+            _transfer_rates[record['Remote']] = \
+                (float(record['BytesPerSec']), int(record['NbSamples']))
+    except (parse.DcfParsingError, KeyError, ValueError):
+        print("BBS>   Ignoring invalid file %s" % transfer_rates_file)
+        _transfer_rates = {}
+    return _transfer_rates
+
+def _save_transfer_rates():
+    if transfer_rates_file == None:
+        return
+    tmp = '%s.%d.tmp' % (transfer_rates_file, os.getpid())
+    f = open(tmp, 'w')
+    for remote in sorted(_transfer_rates.keys()):
+        bytes_per_sec, nb_samples = _transfer_rates[remote]
+        f.write('Remote: %s\n' % remote)
+        f.write('BytesPerSec: %.1f\n' % bytes_per_sec)
+        f.write('NbSamples: %d\n' % nb_samples)
+        f.write('\n')
+    f.close()
+    os.replace(tmp, transfer_rates_file)
+    return
+
+def record_transfer(remote, nbytes, dt):
+    if remote == None or nbytes < _min_sample_size or dt <= 0.0:
+        return
+    rates = _load_transfer_rates()
+    sample = nbytes / dt
+    if remote in rates:
+        bytes_per_sec, nb_samples = rates[remote]
+        bytes_per_sec = _rate_alpha * sample + \
+                        (1.0 - _rate_alpha) * bytes_per_sec
+        nb_samples += 1
+    else:
+        bytes_per_sec, nb_samples = sample, 1
+    rates[remote] = (bytes_per_sec, nb_samples)
+    _save_transfer_rates()
+    return
+
+### Run rsync command 'cmd' (which must include the --stats option) with
+### jobs.tryHardToRunJob() and return a (retcode, nbytes) tuple where
+### 'nbytes' is the nb of bytes that rsync actually sent (direction='sent')
+### or received (direction='received') over the wire. This can be much less
+### than the size of the transferred files when rsync only sends deltas.
+### 'nbytes' is None if it cannot be extracted from the output of rsync.
+### The output of rsync is still displayed as it comes (including the
+### output of the failed attempts, and before we exit if 'failure_is_fatal'
+### is True and all the attempts failed).
+def _run_rsync_with_stats(cmd, direction, nb_attempts, maxtime, sleeptime,
+                          failure_is_fatal, verbose):
+    capture = []
+    retcode = jobs.tryHardToRunJob(cmd, nb_attempts, None, maxtime,
+                                   sleeptime, failure_is_fatal, verbose,
+                                   capture)
+    out = b''.join(capture).decode(errors='replace')
+    ## The stats of the last attempt.
+    m = re.findall(r'^Total bytes %s: ([0-9,.]+)' % direction, out, re.M)
+    if len(m) == 0:
+        return (retcode, None)
+    ## rsync >= 3.1 uses thousands separators.
+    return (retcode, int(m[-1].replace(',', '').replace('.', '')))
+
+### Return the estimated throughput (in bytes/s) to 'remote'.
+def get_bytes_per_sec(remote):
+    rates = _load_transfer_rates()
+    if remote not in rates:
+        return bandwidth_in_bytes_per_sec
+    return rates[remote][0]
+
+### Timeout for transferring 'nbytes' to or from 'remote'. The estimate
+### used is never allowed to be lower than the default bandwidth so a couple
+### of bad nights can't make the timeouts absurdly long.
+def transfer_maxtime(remote, nbytes):
+    bytes_per_sec = get_bytes_per_sec(remote) / _timeout_slack
+    bytes_per_sec = max(bytes_per_sec, bandwidth_in_bytes_per_sec)
+    return 120.0 + nbytes / bytes_per_sec
+
+### How long to wait before retrying a failed transfer. Failures of big
+### transfers on a slow link are more likely to be caused by congestion so
+### we back off longer in that case (but never more than 5 min).
+def transfer_sleeptime(remote, nbytes, base=30.0):
+    expected_time = nbytes / get_bytes_per_sec(remote)
+    return min(base + expected_time / 10.0, 300.0)
+
+### Number of jobs to complete between 2 asynchronous pushes of the build
+### products to 'remote'. The default (10 jobs) was tuned for the default
+### bandwidth. On a faster link we push more often so products reach the
+### central node sooner, on a slower link we push less often so the fixed
+### cost of each rsync+ssh call is amortized over more products.
+def push_batch_size(remote, default=10):
+    ratio = get_bytes_per_sec(remote) / bandwidth_in_bytes_per_sec
+    batch_size = int(round(default / ratio ** 0.5))
+    return min(max(batch_size, 1), 50)
+
 class WOpenError(Exception):
     def __init__(self, file):
         self.file = file
@@ -77,11 +215,11 @@ class RemoteDir:
 
     # Open local or remote file in binary mode.
     def WOpen(self, file, return_None_on_error=False):
-        if self.host == None or self.host == 'localhost':
+        if self.path != None and (self.host == None or self.host == 'localhost'):
             # self is a local dir
             filepath = os.path.join(self.path, file)
             try:
-                # urllib.request.urlopen() below opens the URL in binary mode
+                # httputils.urlopen() below opens the URL in binary mode
                 # so we do the same here.
                 f = open(filepath, 'rb')
             except IOError:
@@ -89,16 +227,30 @@ class RemoteDir:
                     return None
                 raise WOpenError(filepath)
         else:
-            # self is a remote dir accessible via HTTP
+            # self is a remote dir accessible via HTTP. We use
+            # httputils.urlopen() instead of urllib.request.urlopen() to
+            # reuse the connection to the server and to take advantage of
+            # the on-disk cache (if BBS_HTTP_CACHE_DIR is set).
             fileurl = self.url + '/' + file
             try:
-                f = urllib.request.urlopen(fileurl)
+                f = httputils.urlopen(fileurl)
             except urllib.error.HTTPError:
                 if return_None_on_error:
                     return None
                 raise WOpenError(fileurl)
         return f
 
+    # Key used to identify the remote in the measured transfer rates.
+    # Returns None for a local dir.
+    def transfer_rate_key(self):
+        if self.path == None:
+            return urllib.parse.urlsplit(self.url).netloc
+        if self.host == None or self.host == 'localhost':
+            return None
+        if self.user == None:
+            return self.host
+        return "%s@%s" % (self.user, self.host)
+
     def get_full_remote_path(self):
         if self.host == None or self.host == 'localhost':
             # self is a local dir
@@ -116,26 +268,45 @@ class RemoteDir:
             # 'self' is a web-based only remote dir. 'src_path' must be
             # pointing to a remote file accessible thru HTTP. 'dest_path'
             # must be pointing to a local folder into which the remote file
-            # will be downloaded (replacing any existing file).
-            src_file = self.WOpen(src_path)
+            # will be downloaded (replacing any existing file). The file
+            # is streamed to disk in binary mode and an interrupted download
+            # is resumed on the next call.
+            fileurl = self.url + '/' + src_path
             dest_path = os.path.join(dest_path, src_path)
-            dest_file = open(dest_path, 'w')
-            for line in src_file:
-                dest_file.write(line)
-            dest_file.close()
-            src_file.close()
+            nb_attempts = 5
+            for i in range(nb_attempts):
+                t1 = time.time()
+                try:
+                    nbytes = httputils.download(fileurl, dest_path, verbose)
+                except urllib.error.HTTPError:
+                    raise WOpenError(fileurl)
+                except (OSError, http.client.HTTPException) as e:
+                    if i == nb_attempts - 1:
+                        raise
+                    print("BBS>   Download of %s interrupted (%s). " % \
+                          (fileurl, e) + "Will resume in 20 sec.")
+                    jobs.sleep(20.0)
+                else:
+                    record_transfer(self.transfer_rate_key(), nbytes,
+                                    time.time() - t1)
+                    break
             return
         if self.host == None or self.host == 'localhost':
             # self is a local dir
             src_path = os.path.join(self.path, src_path)
-            cmd = "%s %s %s %s" % \
+            cmd = "%s %s --stats %s %s" % \
                 (self.rsync_cmd, self.rsync_options, src_path, dest_path)
         else:
             # self is a remote dir
             src_path = "%s/%s" % (self.get_full_remote_path(), src_path)
-            cmd = "%s %s %s %s" % \
+            cmd = "%s %s --stats %s %s" % \
                 (self.rsync_rsh_cmd, self.rsync_options, src_path, dest_path)
-        jobs.tryHardToRunJob(cmd, 5, None, 60.0, 20.0, True, verbose)
+        remote = self.transfer_rate_key()
+        t1 = time.time()
+        retcode, nbytes = _run_rsync_with_stats(cmd, 'received', 5, 60.0,
+                                                20.0, True, verbose)
+        if nbytes != None:
+            record_transfer(remote, nbytes, time.time() - t1)
         return
 
     def _Call(self, remote_cmd):
@@ -176,11 +347,37 @@ class RemoteDir:
             print("OK")
         return
 
+    ## A local dir is remade with fileutils.remake_dir(). A remote dir is
+    ## renamed into a fresh 'mktemp -d' dir next to it, recreated, and the
+    ## renamed dir is deleted in the background. All in a single remote call.
+    ## We don't know the work dir of the remote node so the renamed dir is a
+    ## hidden sibling of the remote dir until it's deleted. The background
+    ## 'rm' also deletes the siblings left by previous calls whose 'rm' got
+    ## killed (like fileutils.reap_trash() does for the local trash dir).
     def RemakeMe(self, verbose=False):
         if verbose:
             print("BBS>   (Re)make %s/..." % self.label, end=" ")
-        self.RemoveMe()
-        self.MakeMe()
+        if self.host == None or self.host == 'localhost':
+            fileutils.remake_dir(self.path)
+            if verbose:
+                print("OK")
+            return
+        path = posixpath.normpath(self.path)
+        trash_template = posixpath.join(posixpath.dirname(path),
+                             '.%s.trash.XXXXXX' % posixpath.basename(path))
+        ## Matches the new 'mktemp -d' dir and the ones left behind.
+        trash_glob = trash_template.replace('XXXXXX', '??????')
+        remote_cmd = 'mkdir -p %s' % posixpath.dirname(path) + \
+                     ' && t=$(mktemp -d %s)' % trash_template + \
+                     ' && (test ! -e %s || mv %s $t/)' % (path, path) + \
+                     ' && mkdir -p %s' % path + \
+                     ' && (nohup nice -n 19 rm -rf %s ' % trash_glob + \
+                     '</dev/null >/dev/null 2>&1 &)'
+        retcode = self._Call(remote_cmd)
+        if retcode != 0:
+            ## Try the old way.
+            self.RemoveMe()
+            self.MakeMe()
         if verbose:
             print("OK")
         return
@@ -213,23 +410,36 @@ class RemoteDir:
     # current dir
     def Put(self, src_path, failure_is_fatal=True, verbose=False):
         set_readable_flag(src_path, verbose)
+        ## --stats gives us the nb of bytes actually sent (see
+        ## _run_rsync_with_stats()).
         if self.host == None or self.host == 'localhost':
             # self is a local dir
-            cmd = "%s %s %s %s" % \
+            cmd = "%s %s --stats %s %s" % \
                 (self.rsync_cmd, self.rsync_options, src_path, self.path)
         else:
             # self is a remote dir
-            cmd = "%s %s %s %s" % \
+            cmd = "%s %s --stats %s %s" % \
                 (self.rsync_rsh_cmd, self.rsync_options, src_path,
                  self.get_full_remote_path())
-        maxtime = 120.0 + fileutils.total_size(src_path) / bandwidth_in_bytes_per_sec
+        remote = self.transfer_rate_key()
+        size = fileutils.total_size(src_path)
+        maxtime = transfer_maxtime(remote, size)
+        sleeptime = transfer_sleeptime(remote, size)
         if verbose:
             if self.host == None or self.host == 'localhost':
                 action = "Copying"
             else:
                 action = "Sending"
             print("BBS>   %s %s to %s/:" % (action, src_path, self.label))
-        jobs.tryHardToRunJob(cmd, 5, None, maxtime, 30.0, failure_is_fatal, verbose)
+        t1 = time.time()
+        retcode, nbytes = _run_rsync_with_stats(cmd, 'sent', 5, maxtime,
+                                                sleeptime, failure_is_fatal,
+                                                verbose)
+        ## Note that 'dt' includes the time spent in failed attempts (if
+        ## any) so the measurement errs on the side of a low estimate, which
+        ## is what we want since it's used for timeouts.
+        if retcode == 0 and nbytes != None:
+            record_transfer(remote, nbytes, time.time() - t1)
         return
 
     def Mput(self, paths, failure_is_fatal=True, verbose=False):
@@ -264,7 +474,8 @@ class RemoteDir:
         if verbose:
             print("BBS>   Syncing local '%s' with %s" % (local_dir, self.label))
         ## This can take a veeeeeeeeery long time on Windows!
-        jobs.tryHardToRunJob(cmd, 3, None, 2400.0, 30.0, True, verbose)
+        jobs.tryHardToRunJob(jobs.makeBackgroundCmd(cmd), 3, None, 2400.0,
+                             30.0, True, verbose)
         ## Workaround a strange problem observed so far on Windows Server
         ## 2008 R2 Enterprise (64-bit) only. After running rsync (from Cygwin)
         ## on this machine to sync a local folder, the local filesystem seems
@@ -284,6 +495,113 @@ class RemoteDir:
         os.chdir(oldcwd)
         return
 
+
+### A RemoteDir that receives files through the ingest server running on the
+### central node (see bbs/ingest.py) instead of rsync+ssh. Only Put() and
+### Mput() are affected: each Mput() call sends all its files in a single
+### bundle. Everything else (MakeMe, RemakeMe, Call, etc...) works like for
+### an ordinary RemoteDir. 'ingest_root' must be the path of the directory
+### served by the ingest server (on the central node).
+class IngestRemoteDir(RemoteDir):
+
+    def __init__(self, label, url,
+                 path=None, host=None, user=None, rsh_cmd=None,
+                 rsync_cmd=None, rsync_rsh_cmd=None, rsync_options=None,
+                 ingest_root=None, ingest_port=ingest.default_port):
+        RemoteDir.__init__(self, label, url, path, host, user, rsh_cmd,
+                           rsync_cmd, rsync_rsh_cmd, rsync_options)
+        if ingest_root == None:
+            ingest_root = path
+        self.ingest_root = ingest_root
+        self.ingest_port = ingest_port
+        return
+
+    @classmethod
+    def from_RemoteDir(cls, rdir, ingest_root=None,
+                       ingest_port=ingest.default_port):
+        return cls(rdir.label, rdir.url,
+                   rdir.path, rdir.host, rdir.user, rdir.rsh_cmd,
+                   rdir.rsync_cmd, rdir.rsync_rsh_cmd, rdir.rsync_options,
+                   ingest_root, ingest_port)
+
+    def subdir(self, subdir):
+        rdir = RemoteDir.subdir(self, subdir)
+        return IngestRemoteDir.from_RemoteDir(rdir, self.ingest_root,
+                                              self.ingest_port)
+
+    def Put(self, src_path, failure_is_fatal=True, verbose=False):
+        self.Mput([src_path], failure_is_fatal, verbose, wait=True)
+        return
+
+    # By default, don't wait for the ingest server to acknowledge the
+    # bundles so the next Mput() calls can keep up to ingest.window bundles
+    # in flight. Call flush_ingest_channels() to wait for all of them.
+    def Mput(self, paths, failure_is_fatal=True, verbose=False, wait=False):
+        # Paths on the central node are always POSIX paths.
+        dest = posixpath.relpath(self.path, self.ingest_root)
+        if verbose:
+            print("BBS>   Sending %s to %s/ (ingest channel) ..." % \
+                  (' '.join(paths), self.label), end=" ")
+            sys.stdout.flush()
+        t1 = time.time()
+        try:
+            client = ingest.get_client(self.host, self.ingest_port,
+                                       self.rsh_cmd, self.user)
+            bundles = ingest.make_bundles(paths, dest)
+        except (ingest.IngestError, OSError) as e:
+            if verbose:
+                print("ERROR!")
+            print("BBS>   Ingest channel failed (%s). " % e + \
+                  "Falling back to rsync.")
+            RemoteDir.Mput(self, paths, failure_is_fatal, verbose)
+            return
+        for bundle in bundles:
+            bundle.context = (self, failure_is_fatal)
+        nbytes = client.send_bundles(bundles, wait)
+        failed = client.take_failed()
+        if verbose:
+            if any(bundle in bundles for bundle, msg in failed):
+                print("ERROR!")
+            else:
+                print("OK")
+        record_transfer(self.transfer_rate_key(), nbytes, time.time() - t1)
+        _deliver_failed_bundles(failed, verbose)
+        return
+
+    # Returns the command that pushes the content of 'local_dir' to 'self'
+    # thru the ingest channel (see 'python3 bbs/ingest.py push').
+    def make_push_cmd(self, local_dir):
+        dest = posixpath.relpath(self.path, self.ingest_root)
+        args = [sys.executable, os.path.abspath(ingest.__file__), 'push',
+                '--port', str(self.ingest_port)]
+        if self.host != None and self.host != 'localhost':
+            args += ['--host', self.host, '--rsh', self.rsh_cmd]
+            if self.user != None:
+                args += ['--user', self.user]
+        args += [local_dir, dest]
+        if sys.platform == 'win32':
+            return subprocess.list2cmdline(args)
+        return ' '.join(shlex.quote(arg) for arg in args)
+
+# Send the bundles that the ingest channel failed to deliver with rsync.
+def _deliver_failed_bundles(failed, verbose=False):
+    for bundle, msg in failed:
+        rdir, failure_is_fatal = bundle.context
+        bundle.close()
+        print("BBS>   Ingest channel failed to deliver %s to %s/ (%s). " % \
+              (' '.join(bundle.paths), rdir.label, msg) + \
+              "Falling back to rsync.")
+        RemoteDir.Mput(rdir, bundle.paths, failure_is_fatal, verbose)
+    return
+
+# Wait for the ingest server to acknowledge all the bundles sent by
+# IngestRemoteDir.Mput().
+def flush_ingest_channels(verbose=False):
+    for client in ingest.get_clients():
+        client.flush()
+        _deliver_failed_bundles(client.take_failed(), verbose)
+    return
+
 if __name__ == "__main__":
     sys.exit("ERROR: this Python module can't be used as a standalone script yet")
 
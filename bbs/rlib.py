@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.rlib module
+###
+### Python-side inspection of R package libraries. This allows us to answer
+### questions like "which packages are installed?" without starting an R
+### process.
+###
+
+import sys
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+import parse
+
+### Same as the 'path.sep' argument of R's .libPaths().
+_lib_path_sep = ';' if sys.platform == 'win32' else ':'
+
+def _split_lib_paths(val):
+    if val == None or val == '' or val == 'NULL':
+        return []
+    lib_paths = []
+    for path in val.split(_lib_path_sep):
+        path = os.path.expanduser(os.path.expandvars(path.strip()))
+        if path != '':
+            lib_paths.append(path)
+    return lib_paths
+
+def _unique_existing_dirs(paths):
+    ans = []
+    seen = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        key = os.path.normcase(os.path.realpath(path))
+        if key in seen:
+            continue
+        seen.add(key)
+        ans.append(path)
+    return ans
+
+### Expand the ${VAR}, ${VAR-default}, and ${VAR:-default} terms in the
+### value of a line of an Renviron file, like R does (see ?Startup). The
+### defaults can contain such terms themselves, and can be quoted.
+def _expand_Renviron_value(val, environ):
+    ans = []
+    i = 0
+    while i < len(val):
+        if not val.startswith('${', i):
+            ans.append(val[i])
+            i += 1
+            continue
+        ## Find the matching brace.
+        depth = 0
+        for j in range(i, len(val)):
+            if val.startswith('${', j):
+                depth += 1
+            elif val[j] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+        else:
+            ans.append(val[i:])  # unterminated term: keep it as-is
+            break
+        m = re.match(r'([^-:]*)(:?-)?(.*)$', val[i+2:j], re.S)
+        name, op, default = m.group(1).strip(), m.group(2), m.group(3)
+        current = environ.get(name)
+        if op == None:
+            ans.append(current if current != None else '')
+        elif current == None or (op == ':-' and current == ''):
+            ans.append(_unquote(_expand_Renviron_value(default, environ)))
+        else:
+            ans.append(current)
+        i = j + 1
+    return ''.join(ans)
+
+def _unquote(val):
+    val = val.strip()
+    if len(val) >= 2 and val[0] == val[-1] and val[0] in '\'"':
+        return val[1:-1]
+    return val
+
+### Process Renviron file 'path' like R does at startup: set the variables in
+### dict 'environ' (existing values are overwritten, the files use
+### ${VAR-default} to avoid that). Nothing happens if the file doesn't
+### exist.
+def _process_Renviron(path, environ):
+    try:
+        f = open(path, 'r', errors='replace')
+    except OSError:
+        return
+    with f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#') or '=' not in line:
+                continue
+            name, val = line.split('=', 1)
+            environ[name.strip()] = _unquote(_expand_Renviron_value(val.strip(),
+                                                                   environ))
+    return
+
+### The Renviron files read by R at startup, in that order (see ?Startup).
+def _get_Renviron_files(r_home, environ):
+    etc_dir = os.path.join(r_home, 'etc' + environ.get('R_ARCH', ''))
+    paths = [os.path.join(etc_dir, 'Renviron')]
+    site_file = environ.get('R_ENVIRON', '')
+    if site_file == '':
+        site_file = os.path.join(etc_dir, 'Renviron.site')
+    paths.append(site_file)
+    user_file = environ.get('R_ENVIRON_USER', '')
+    if user_file == '':
+        user_file = '.Renviron'
+        if not os.path.exists(user_file):
+            user_file = os.path.join(os.path.expanduser('~'), '.Renviron')
+    paths.append(os.path.expanduser(user_file))
+    return paths
+
+### Expand the %V, %v, %p, %a, %o, %U, and %S specifiers in R_LIBS_USER or
+### R_LIBS_SITE, like R's .expand_R_libs_env_var() does. 'R_built' is the
+### Built field of the base package e.g. "R 4.4.1; x86_64-pc-linux-gnu; ...".
+def _expand_R_libs_env_var(val, r_home, R_built, environ):
+    parts = [part.strip() for part in R_built.split(';')]
+    R_version, platform = parts[0].split()[-1], parts[1]
+    short_version = '.'.join(R_version.split('.')[0:2])
+    arch, os_ = platform.split('-')[0], platform.split('-', 2)[-1]
+    if sys.platform == 'win32':
+        user_lib = os.path.join(environ.get('LOCALAPPDATA', ''), 'R',
+                                'win-library', short_version)
+    elif sys.platform == 'darwin':
+        user_lib = os.path.join('~', 'Library', 'R', arch, short_version,
+                                'library')
+    else:
+        user_lib = os.path.join('~', 'R', platform + '-library',
+                                short_version)
+    expansions = {'V': R_version, 'v': short_version, 'p': platform,
+                  'a': arch, 'o': os_, 'U': user_lib,
+                  'S': os.path.join(r_home, 'site-library'), '%': '%'}
+    return re.sub(r'%(.)', lambda m: expansions.get(m.group(1), m.group(0)),
+                  val)
+
+### Return the library paths that R would return with .libPaths(), in the
+### same order: R_LIBS, then R_LIBS_USER, then R_LIBS_SITE (which defaults
+### to <r_home>/site-library), then <r_home>/library. Like R, we take the
+### values set in the Renviron files into account, and the default value of
+### R_LIBS_USER. Only existing directories are returned, and duplicates are
+### removed. This doesn't start R. Note that we ignore the library paths set
+### in an Rprofile file thru .libPaths().
+### test/python/check_installed_pkgs.py compares the result with what R
+### returns.
+def get_lib_paths(r_home, environ=None):
+    if environ == None:
+        environ = os.environ
+    environ = dict(environ)
+    for path in _get_Renviron_files(r_home, environ):
+        _process_Renviron(path, environ)
+    base_desc = read_installed_DESCRIPTION(os.path.join(r_home, 'library',
+                                                        'base'))
+    for var in ('R_LIBS_USER', 'R_LIBS_SITE'):
+        if base_desc != None and var in environ:
+            environ[var] = _expand_R_libs_env_var(environ[var], r_home,
+                                                  base_desc['Built'], environ)
+    lib_paths = _split_lib_paths(environ.get('R_LIBS'))
+    lib_paths += _split_lib_paths(environ.get('R_LIBS_USER'))
+    if environ.get('R_LIBS_SITE', '') != '':
+        lib_paths += _split_lib_paths(environ['R_LIBS_SITE'])
+    else:
+        lib_paths.append(os.path.join(r_home, 'site-library'))
+    lib_paths.append(os.path.join(r_home, 'library'))
+    return _unique_existing_dirs(lib_paths)
+
+_DESCRIPTION_fields = ('Package', 'Version', 'Built', 'git_last_commit')
+
+### Return a dict with the Package, Version, Built, and LibPath fields (plus
+### the git_last_commit field if present) of the package installed in
+### 'pkg_path', or None if 'pkg_path' is not the path
+### to an installed package. Like R's installed.packages(), we only consider
+### directories that contain a Meta/package.rds file, and a DESCRIPTION file
+### with a Built field. The DESCRIPTION file contains the same fields as the
+### package.rds file (which we cannot read from Python).
+def read_installed_DESCRIPTION(pkg_path):
+    if not os.path.isfile(os.path.join(pkg_path, 'Meta', 'package.rds')):
+        return None
+    desc_path = os.path.join(pkg_path, 'DESCRIPTION')
+    try:
+        desc = parse.parse_DCF(desc_path, merge_records=True,
+                               fields=_DESCRIPTION_fields)
+    except (OSError, parse.DcfParsingError):
+        return None
+    if 'Built' not in desc or 'Package' not in desc:
+        return None
+    desc['Version'] = desc.get('Version')
+    desc['LibPath'] = os.path.dirname(pkg_path)
+    return desc
+
+### Scan the library directories and return a list of (pkg, desc) tuples
+### where 'desc' is what read_installed_DESCRIPTION() returns for the
+### package. The list is ordered like the rows of installed.packages(lib_paths)
+### and the 'pkg' values are its rownames (i.e. the names of the package
+### directories with the "_<suffix>" part removed). The DESCRIPTION files are
+### read in parallel, which makes a big difference when the library is on a
+### network filesystem.
+def list_installed_pkgs(lib_paths, nb_threads=8):
+    pkg_paths = []
+    for lib_path in lib_paths:
+        try:
+            subdirs = sorted(os.listdir(lib_path))
+        except OSError:
+            continue
+        for subdir in subdirs:
+            ## Skip the lock dirs left behind by R CMD INSTALL.
+            if subdir.startswith('00LOCK'):
+                continue
+            pkg_paths.append(os.path.join(lib_path, subdir))
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        descs = list(executor.map(read_installed_DESCRIPTION, pkg_paths))
+    return [(os.path.basename(pkg_path).split('_', 1)[0], desc)
+            for pkg_path, desc in zip(pkg_paths, descs) if desc != None]
+
+### Return a dict that maps each installed package to what
+### read_installed_DESCRIPTION() returns for it. If a package is installed
+### in more than one library, only the first one is reported (this is the
+### one that library() would load).
+def get_installed_pkgs(lib_paths, nb_threads=8):
+    installed_pkgs = {}
+    for pkg, desc in list_installed_pkgs(lib_paths, nb_threads):
+        installed_pkgs.setdefault(pkg, desc)
+    return installed_pkgs
+
+### Write the LibPath, Version, and Built columns of installed.packages() to
+### 'filepath' in the format used by
+###   options(width=500)
+###   print(installed.packages()[,c('LibPath','Version','Built')], quote=FALSE)
+def write_installed_pkgs_table(lib_paths, filepath):
+    colnames = ['LibPath', 'Version', 'Built']
+    rows = [[pkg] + [str(desc[col]) for col in colnames]
+            for pkg, desc in list_installed_pkgs(lib_paths)]
+    header = [''] + colnames
+    widths = [max([len(row[j]) for row in rows] + [len(header[j])])
+              for j in range(len(header))]
+    with open(filepath, 'w') as f:
+        for row in [header] + rows:
+            f.write(' '.join(val.ljust(width)
+                             for val, width in zip(row, widths)) + '\n')
+    return
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s <r_home> [<lib_path> ...]' % sys.argv[0])
+    lib_paths = sys.argv[2:]
+    if len(lib_paths) == 0:
+        lib_paths = get_lib_paths(sys.argv[1])
+    installed_pkgs = get_installed_pkgs(lib_paths)
+    for pkg, desc in installed_pkgs.items():
+        print('%s\t%s\t%s' % (pkg, desc['Version'], desc['LibPath']))
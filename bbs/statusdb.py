@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### This file is part of the BBS software (Bioconductor Build System).
+###
+### bbs.statusdb module
+###
+### A SQLite store for the package statuses of all the runs (one run per
+### night). Unlike BUILD_STATUS_DB.txt, which only holds the statuses of the
+### current run and is rewritten every night, it keeps the history so we
+### can answer questions like "since how many days has this package been
+### failing on this node?" without having to scrape archived reports.
+###
+### BUILD_STATUS_DB.txt is still produced (see export_txt()) for the
+### components that read it.
+###
+### Usage as a script (history of a package):
+###
+###   python3 bbs/statusdb.py <path/to/db> <pkg> [<node_id>]
+###
+
+import sys
+import os
+import time
+import sqlite3
+
+failure_statuses = ('ERROR', 'TIMEOUT')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    label        TEXT NOT NULL UNIQUE,
+    buildtype    TEXT,
+    bioc_version TEXT,
+    created_at   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS statuses (
+    run_id       INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    pkg          TEXT NOT NULL,
+    node_id      TEXT NOT NULL,
+    stage        TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    version      TEXT,
+    ellapsed     REAL,
+    warnings     INTEGER,
+    PRIMARY KEY (run_id, pkg, node_id, stage)
+);
+CREATE INDEX IF NOT EXISTS statuses_by_pkg
+    ON statuses (pkg, node_id, stage, run_id);
+'''
+
+class BuildStatusDB:
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60.0)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+        return
+
+    ## Start recording a new run. If a run with the same label already
+    ## exists (e.g. stage6 is run twice the same day), its statuses are
+    ## discarded and replaced. The label defaults to today's date.
+    def new_run(self, label=None, buildtype=None, bioc_version=None):
+        if label == None:
+            label = time.strftime('%Y-%m-%d')
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S %z')
+        with self.conn:
+            self.conn.execute('DELETE FROM runs WHERE label = ?', (label,))
+            cur = self.conn.execute(
+                'INSERT INTO runs (label, buildtype, bioc_version, created_at)'
+                ' VALUES (?, ?, ?, ?)',
+                (label, buildtype, bioc_version, created_at))
+        return cur.lastrowid
+
+    ## 'rows' must be an iterable of (pkg, node_id, stage, status, version,
+    ## ellapsed, warnings) tuples.
+    def add_statuses(self, run_id, rows):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO statuses (run_id, pkg, node_id,'
+                ' stage, status, version, ellapsed, warnings)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((run_id,) + tuple(row) for row in rows))
+        return
+
+    def latest_run_id(self):
+        row = self.conn.execute('SELECT MAX(run_id) FROM runs').fetchone()
+        return row[0]
+
+    def runs(self):
+        return self.conn.execute(
+                   'SELECT run_id, label, buildtype, bioc_version, created_at'
+                   ' FROM runs ORDER BY run_id').fetchall()
+
+    ## Return a dict mapping 'pkg#node_id#stage' keys to statuses (same keys
+    ## as in BUILD_STATUS_DB.txt).
+    def get_statuses(self, run_id=None):
+        if run_id == None:
+            run_id = self.latest_run_id()
+        rows = self.conn.execute(
+                   'SELECT pkg, node_id, stage, status FROM statuses'
+                   ' WHERE run_id = ? ORDER BY rowid', (run_id,))
+        return {'%s#%s#%s' % row[0:3]: row[3] for row in rows}
+
+    def get_status(self, pkg, node_id, stage, run_id=None):
+        if run_id == None:
+            run_id = self.latest_run_id()
+        row = self.conn.execute(
+                  'SELECT status FROM statuses WHERE run_id = ? AND pkg = ?'
+                  ' AND node_id = ? AND stage = ?',
+                  (run_id, pkg, node_id, stage)).fetchone()
+        return None if row == None else row[0]
+
+    ## Write the statuses of a run to a file in the BUILD_STATUS_DB.txt format.
+    def export_txt(self, path, run_id=None):
+        with open(path, 'w') as out:
+            for key, status in self.get_statuses(run_id).items():
+                out.write('%s: %s\n' % (key, status))
+        return
+
+    ## Return the list of (label, stage, status, version, ellapsed, warnings)
+    ## tuples for a package on a node, most recent run first.
+    def history(self, pkg, node_id, stage=None, limit=None):
+        sql = 'SELECT runs.label, stage, status, version, ellapsed, warnings' \
+              ' FROM statuses JOIN runs USING (run_id)' \
+              ' WHERE pkg = ? AND node_id = ?'
+        args = [pkg, node_id]
+        if stage != None:
+            sql += ' AND stage = ?'
+            args.append(stage)
+        sql += ' ORDER BY run_id DESC, stage'
+        if limit != None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        return self.conn.execute(sql, args).fetchall()
+
+    ## Number of consecutive runs (ending with the most recent run) for
+    ## which the package failed at the specified stage on the node. A run
+    ## where the package was not built at all breaks the streak.
+    def nb_consecutive_failures(self, pkg, node_id, stage):
+        rows = self.conn.execute(
+                   'SELECT runs.run_id, status FROM runs LEFT JOIN statuses'
+                   ' ON statuses.run_id = runs.run_id AND pkg = ?'
+                   ' AND node_id = ? AND stage = ?'
+                   ' ORDER BY runs.run_id DESC',
+                   (pkg, node_id, stage))
+        n = 0
+        for run_id, status in rows:
+            if status not in failure_statuses:
+                break
+            n += 1
+        return n
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        sys.exit('Usage: %s <path/to/db> <pkg> [<node_id>]' % sys.argv[0])
+    db = BuildStatusDB(sys.argv[1])
+    pkg = sys.argv[2]
+    if len(sys.argv) == 4:
+        node_ids = [sys.argv[3]]
+    else:
+        node_ids = [row[0] for row in db.conn.execute(
+                        'SELECT DISTINCT node_id FROM statuses WHERE pkg = ?'
+                        ' ORDER BY node_id', (pkg,))]
+    for node_id in node_ids:
+        print('%s on %s:' % (pkg, node_id))
+        for row in db.history(pkg, node_id):
+            label, stage, status, version, ellapsed, warnings = row
+            print('  %s  %-9s %-9s %s' % (label, stage, status,
+                                          version if version else ''))
+    db.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Benchmark the DCF parser of the bbs.parse module.
+###
+### Usage:
+###   python3 test/python/benchmark_DCF_parser.py [<dcf-file> ...]
+###
+### Without arguments, synthetic files are generated: a meat-index.dcf for
+### a Bioconductor-sized build (2300 packages) and a PACKAGES file for a
+### CRAN-sized repository (20000 packages). Real files (e.g. the
+### meat-index.dcf of a build, or a PACKAGES file downloaded from CRAN) can
+### be passed instead.
+###
+### For each file, check that parse_DCF() returns exactly the same result as
+### the original line-by-line implementation (_parse_DCF_linewise()), then
+### report timings.
+###
+
+import sys
+import os
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.parse
+
+def _random_pkgs(n):
+    random.seed(123)
+    letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return ['%s%d' % (''.join(random.choice(letters) for j in range(8)), i)
+            for i in range(n)]
+
+def _make_deps_val(pkgs, k):
+    deps = random.sample(pkgs, k)
+    return ', '.join('%s (>= 1.%d.0)' % (dep, i) for i, dep in enumerate(deps))
+
+def _write_synthetic_meat_index(path, nb_pkgs=2300):
+    pkgs = _random_pkgs(nb_pkgs)
+    with open(path, 'w') as f:
+        for pkg in pkgs:
+            f.write('Package: %s\n' % pkg)
+            f.write('Version: 1.%d.2\n' % random.randint(0, 40))
+            f.write('Maintainer: Jöhn Doe <jdoe@example.org>\n')
+            f.write('Depends: R (>= 4.0.0), %s\n' % _make_deps_val(pkgs, 2))
+            f.write('Imports: %s,\n' % _make_deps_val(pkgs, 6))
+            f.write('        %s\n' % _make_deps_val(pkgs, 6))
+            f.write('Suggests: %s\n' % _make_deps_val(pkgs, 5))
+            f.write('UnsupportedPlatforms: win\n')
+            f.write('git_url: https://git.bioconductor.org/packages/%s\n' % pkg)
+            f.write('git_branch: devel\n')
+            f.write('git_last_commit: %040x\n' % random.getrandbits(160))
+            f.write('git_last_commit_date: 2026-10-18 09:12:44 -0400\n')
+            f.write('\n')
+    return
+
+def _write_synthetic_PACKAGES(path, nb_pkgs=20000):
+    pkgs = _random_pkgs(nb_pkgs)
+    with open(path, 'w') as f:
+        for pkg in pkgs:
+            f.write('Package: %s\n' % pkg)
+            f.write('Version: %d.%d-%d\n' % (random.randint(0, 9),
+                                              random.randint(0, 99),
+                                              random.randint(0, 9)))
+            f.write('Depends: R (>= 3.5.0)\n')
+            f.write('Imports: %s\n' % _make_deps_val(pkgs, 4))
+            f.write('LinkingTo: Rcpp\n')
+            f.write('Suggests: %s,\n' % _make_deps_val(pkgs, 4))
+            f.write('        %s\n' % _make_deps_val(pkgs, 4))
+            f.write('License: GPL (>= 2)\n')
+            f.write('MD5sum: %032x\n' % random.getrandbits(128))
+            f.write('NeedsCompilation: %s\n' % random.choice(['yes', 'no']))
+            f.write('\n')
+    return
+
+def _time_it(FUN, *args, **kwargs):
+    nb_runs = 5
+    best = None
+    for i in range(nb_runs):
+        t1 = time.perf_counter()
+        res = FUN(*args, **kwargs)
+        dt = time.perf_counter() - t1
+        if best == None or dt < best:
+            best = dt
+    return (res, best)
+
+def benchmark(path):
+    size = os.path.getsize(path)
+    print('%s (%d bytes)' % (path, size))
+    ref, dt0 = _time_it(bbs.parse._parse_DCF_linewise, path)
+    res, dt1 = _time_it(bbs.parse.parse_DCF, path)
+    if res != ref:
+        sys.exit('ERROR: parse_DCF() and _parse_DCF_linewise() disagree!')
+    fields = ['Package', 'Version']
+    proj, dt2 = _time_it(bbs.parse.parse_DCF, path, fields=fields)
+    ref_proj = [{k: v for k, v in rec.items() if k in fields} for rec in ref]
+    if proj != ref_proj:
+        sys.exit('ERROR: field projection returned unexpected records!')
+    print('  %d records (results are identical)' % len(ref))
+    print('  _parse_DCF_linewise():            %8.1f ms' % (dt0 * 1000))
+    print('  parse_DCF():                      %8.1f ms  (x%.1f)' % \
+          (dt1 * 1000, dt0 / dt1))
+    print('  parse_DCF(fields=%s): %8.1f ms  (x%.1f)' % \
+          ("['Package',...]", dt2 * 1000, dt0 / dt2))
+    return
+
+if __name__ == "__main__":
+    paths = sys.argv[1:]
+    if len(paths) != 0:
+        for path in paths:
+            benchmark(path)
+        sys.exit(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        meat_index = os.path.join(tmpdir, 'meat-index.dcf')
+        _write_synthetic_meat_index(meat_index)
+        benchmark(meat_index)
+        PACKAGES = os.path.join(tmpdir, 'PACKAGES')
+        _write_synthetic_PACKAGES(PACKAGES)
+        benchmark(PACKAGES)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Check that bbs.rlib.get_installed_pkgs() finds the same packages (with
+### the same versions) as R's installed.packages(), and compare timings.
+### Without lib paths, also check that bbs.rlib.get_lib_paths() returns the
+### same library paths as R's .libPaths().
+###
+### Usage:
+###   python3 test/python/check_installed_pkgs.py <Rscript> [<lib_path> ...]
+###
+### Without lib paths, the library paths returned by .libPaths() are used.
+###
+
+import sys
+import os
+import time
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.rlib
+
+def _run_Rscript(Rscript, Rexpr, options=['--vanilla']):
+    out = subprocess.run([Rscript] + options + ['-e', Rexpr],
+                         check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True).stdout
+    return out.splitlines()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('Usage: %s <Rscript> [<lib_path> ...]' % sys.argv[0])
+    Rscript = sys.argv[1]
+    lib_paths = sys.argv[2:]
+    if len(lib_paths) == 0:
+        ## Not --vanilla: R must read its Renviron files. But
+        ## get_lib_paths() ignores the Rprofile files.
+        lib_paths = _run_Rscript(Rscript, 'writeLines(.libPaths())',
+                                 ['--no-site-file', '--no-init-file'])
+        r_home = _run_Rscript(Rscript, 'writeLines(R.home())')[0]
+        current = bbs.rlib.get_lib_paths(r_home)
+        if [os.path.realpath(path) for path in current] != \
+           [os.path.realpath(path) for path in lib_paths]:
+            print('.libPaths(): %s' % lib_paths)
+            print('get_lib_paths(): %s' % current)
+            sys.exit('MISMATCH')
+        print('get_lib_paths(): %d lib paths' % len(current))
+    Rlib_paths = 'c(%s)' % ', '.join("'%s'" % path for path in lib_paths)
+    Rexpr = 'm <- installed.packages(%s, noCache=TRUE); ' % Rlib_paths + \
+            'm <- m[!duplicated(rownames(m)), , drop=FALSE]; ' + \
+            'writeLines(paste(rownames(m), m[ , "Version"], sep="\\t"))'
+    t0 = time.time()
+    expected = dict(line.split('\t') for line in _run_Rscript(Rscript, Rexpr))
+    t1 = time.time()
+    installed_pkgs = bbs.rlib.get_installed_pkgs(lib_paths)
+    t2 = time.time()
+    current = {pkg: desc['Version'] for pkg, desc in installed_pkgs.items()}
+    print('installed.packages(): %d pkgs in %.3f s' % (len(expected), t1 - t0))
+    print('get_installed_pkgs(): %d pkgs in %.3f s' % (len(current), t2 - t1))
+    if current != expected:
+        for pkg in sorted(set(expected) | set(current)):
+            if expected.get(pkg) != current.get(pkg):
+                print('  %s: R says %s, Python says %s' % \
+                      (pkg, expected.get(pkg), current.get(pkg)))
+        sys.exit('MISMATCH')
+    print('OK')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Check that the lookups in a bbs.dcfstore.IndexedDCF object return the
+### same values as bbs.parse.parse_DCF(), in particular for fields with
+### continuation lines and fields with an empty value, that the index is
+### cached under BBS_WORK_TOPDIR and not next to the file, and that no file
+### descriptor is left open.
+###
+### Usage:
+###   python3 test/python/test_dcfstore.py
+###
+
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.parse
+import bbs.dcfstore
+
+flat_dcf = '''\
+pkgA#node1#install: OK
+pkgA#node1#checksrc: WARNINGS
+Empty:
+EmptyWithSpaces:   \n\
+Long: first line
+  second line
+# a comment inside a field
+\tthird line
+Trailing: value with trailing spaces   \n\
+Empty2:
+  continuation of an empty value
+pkgA#node1#install: ERROR
+Last: last line without newline'''
+
+records_dcf = '''\
+Package: pkgA
+Version: 1.0
+Description: A package with a long
+  description.
+Suggests:
+
+# a comment between the records
+Package: pkgB
+Version: 2.0
+Depends: R (>= 4.0),
+    pkgA
+'''
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+def _nb_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+def _check(label, got, expected):
+    if got != expected:
+        sys.exit('%s: FAILED (got %r, expected %r)' % (label, got, expected))
+
+def _check_flat(path):
+    ## parse_DCF() keeps the last occurrence of a key (pkgA#node1#install
+    ## appears twice), the index the first one (checked below).
+    expected = bbs.parse.parse_DCF(path, merge_records=True)
+    with open(path, 'rb') as f:
+        first_line_keys = set(line.split(b':')[0].decode() for line in f
+                              if b':' in line and line[:1] not in b' \t#')
+    store = bbs.dcfstore.IndexedDCF(path)
+    _check('flat index keys', sorted(store.keys()), sorted(first_line_keys))
+    for key in store:
+        if key != 'pkgA#node1#install':
+            _check('flat index value for %r' % key, store[key], expected[key])
+    _check('duplicate key', store['pkgA#node1#install'], 'OK')
+    _check('empty value', store['Empty'], '')
+    _check('continuation', store['Long'],
+           'first line second line third line')
+    _check('missing key', store.get('Missing'), None)
+    print('flat index: OK')
+
+def _check_records(path):
+    store = bbs.dcfstore.IndexedDCF(path, 'Package')
+    for rec in bbs.parse.parse_DCF(path):
+        _check('record %s' % rec['Package'], store[rec['Package']], rec)
+    print('record index: OK')
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['BBS_WORK_TOPDIR'] = os.path.join(tmp_dir, 'work')
+    flat_path = os.path.join(tmp_dir, 'BUILD_STATUS_DB.txt')
+    records_path = os.path.join(tmp_dir, 'meat-index.dcf')
+    _write(flat_path, flat_dcf)
+    _write(records_path, records_dcf)
+
+    ## Write the indexes to disk, then use the cached ones.
+    bbs.dcfstore.min_size_to_cache_index = 0
+    for i in range(2):
+        _check_flat(flat_path)
+        _check_records(records_path)
+    cache_dir = bbs.dcfstore._get_index_cache_dir()
+    _check('nb of cached indexes', len(os.listdir(cache_dir)), 2)
+    _check('files next to the DCF files', sorted(os.listdir(tmp_dir)),
+           ['BUILD_STATUS_DB.txt', 'meat-index.dcf', 'work'])
+    print('index cache: OK')
+
+    ## One store per file (like the vcs-meta files): no fd must stay open.
+    nb_fds = _nb_open_fds()
+    for i in range(200):
+        path = os.path.join(tmp_dir, 'git-log-pkg%d.dcf' % i)
+        _write(path, 'Last Commit: %d\nLast Changed Date: today\n' % i)
+        _check('vcs-meta', bbs.dcfstore.open_indexed_DCF(path)['Last Commit'],
+               str(i))
+    _check('nb of open fds', _nb_open_fds(), nb_fds)
+    print('open fds: OK')
+    print('OK')
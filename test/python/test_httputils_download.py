@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Test bbs.httputils.download() against a local http.server that
+### supports Range and If-Range requests, in particular the resuming of an
+### interrupted download and what happens when the file changed on the
+### server in the meantime. Also test the conditional GETs (If-None-Match)
+### sent by bbs.httputils.urlopen() when the cache is enabled.
+###
+### Usage:
+###   python3 test/python/test_httputils_download.py
+###
+
+import sys
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.httputils
+
+### Content of the files served by the server, and the requests it got.
+files = {}
+requests = []
+### Set to an int to make the server send a bogus Content-Range.
+bogus_range_start = None
+
+def _etag(content):
+    return '"%s"' % hashlib.sha1(content).hexdigest()
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        content = files.get(self.path)
+        requests.append((self.path, self.headers.get('Range'),
+                         self.headers.get('If-Range'),
+                         self.headers.get('If-None-Match')))
+        if content == None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = _etag(content)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        range_ = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_ != None and (if_range == None or if_range == etag):
+            start = int(range_[len('bytes='):].split('-')[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = content[start:]
+            if bogus_range_start != None:
+                start = bogus_range_start
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % \
+                             (start, len(content) - 1, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _check(label, dest_path, expected):
+    with open(dest_path, 'rb') as f:
+        current = f.read()
+    if current != expected:
+        sys.exit('%s: FAILED (got %d bytes, expected %d)' % \
+                 (label, len(current), len(expected)))
+    for path in [dest_path + '.part', dest_path + '.part.validator']:
+        if os.path.exists(path):
+            sys.exit('%s: FAILED (%s not removed)' % (label, path))
+    print('%s: OK' % label)
+
+def _check_urlopen(label, url, expected, from_cache, if_none_match):
+    del requests[:]
+    f = bbs.httputils.urlopen(url)
+    if f.read() != expected:
+        sys.exit('%s: FAILED (wrong content)' % label)
+    if f.from_cache != from_cache:
+        sys.exit('%s: FAILED (from_cache is %s)' % (label, f.from_cache))
+    if requests[0][3] != if_none_match:
+        sys.exit('%s: FAILED (sent If-None-Match: %s)' % \
+                 (label, requests[0][3]))
+    print('%s: OK' % label)
+
+def _make_part(dest_path, content, validator):
+    with open(dest_path + '.part', 'wb') as f:
+        f.write(content)
+    if validator != None:
+        with open(dest_path + '.part.validator', 'w') as f:
+            json.dump({'validator': validator}, f)
+
+if __name__ == "__main__":
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%d/file' % server.server_address[1]
+    tmp_dir = tempfile.mkdtemp()
+    dest_path = os.path.join(tmp_dir, 'file')
+    v1 = os.urandom(100000)
+    v2 = v1[0:50000] + os.urandom(80000)  # same head, grew
+
+    files['/file'] = v1
+    bbs.httputils.download(url, dest_path)
+    _check('full download', dest_path, v1)
+
+    ## Interrupted download of the current version.
+    _make_part(dest_path, v1[0:30000], _etag(v1))
+    del requests[:]
+    nbytes = bbs.httputils.download(url, dest_path)
+    _check('resume', dest_path, v1)
+    if nbytes != len(v1) - 30000 or requests[0][1] != 'bytes=30000-':
+        sys.exit('resume: FAILED (download was not resumed)')
+
+    ## Interrupted download of v1, but the file was replaced with v2 (which
+    ## is bigger) in the meantime. The server must send the whole file.
+    _make_part(dest_path, v1[0:60000], _etag(v1))
+    files['/file'] = v2
+    bbs.httputils.download(url, dest_path)
+    _check('resume after the file changed', dest_path, v2)
+
+    ## .part file with no validator: we can't resume.
+    _make_part(dest_path, v2[0:60000], None)
+    del requests[:]
+    bbs.httputils.download(url, dest_path)
+    _check('.part file with no validator', dest_path, v2)
+    if requests[0][1] != None:
+        sys.exit('.part file with no validator: FAILED (sent a Range)')
+
+    ## The server sends a range that doesn't start where we asked.
+    _make_part(dest_path, v2[0:60000], _etag(v2))
+    bogus_range_start = 0
+    files['/file'] = v2
+    try:
+        bbs.httputils.download(url, dest_path)
+    finally:
+        bogus_range_start = None
+    _check('bogus Content-Range', dest_path, v2)
+
+    ## .part file bigger than the file on the server.
+    _make_part(dest_path, v2 + b'xxx', _etag(v2))
+    bbs.httputils.download(url, dest_path)
+    _check('.part file too big', dest_path, v2)
+
+    ## Conditional GETs. The 2nd fetch must get a 304 and return the cached
+    ## content, and a fetch after the file changed must get the new content
+    ## and update the cache.
+    bbs.httputils.cache_dir = os.path.join(tmp_dir, 'cache')
+    url = 'http://127.0.0.1:%d/index.dcf' % server.server_address[1]
+    files['/index.dcf'] = b'Package: pkgA\n'
+    _check_urlopen('urlopen (1st fetch)', url, files['/index.dcf'],
+                   False, None)
+    _check_urlopen('urlopen (not modified)', url, files['/index.dcf'],
+                   True, _etag(files['/index.dcf']))
+    old_etag = _etag(files['/index.dcf'])
+    files['/index.dcf'] = b'Package: pkgA\n\nPackage: pkgB\n'
+    _check_urlopen('urlopen (modified)', url, files['/index.dcf'],
+                   False, old_etag)
+    _check_urlopen('urlopen (cache updated)', url, files['/index.dcf'],
+                   True, _etag(files['/index.dcf']))
+    bbs.httputils.clear_cache()
+    _check_urlopen('urlopen (cache cleared)', url, files['/index.dcf'],
+                   False, None)
+
+    bbs.httputils.close_all_connections()
+    server.shutdown()
+    print('OK')
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Round-trip test of the ingest channel (bbs/ingest.py) on localhost:
+### send files and dirs to a local ingest server and check what ends up in
+### the server root. Also checks that the server survives a connection that
+### drops in the middle of a frame, that the client resumes an interrupted
+### bundle, and that a push only sends what changed.
+###
+### Usage:
+###   python3 test/python/test_ingest_roundtrip.py
+###
+
+import sys
+import os
+import gzip
+import socket
+import filecmp
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.ingest
+import bbs.rdir
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def _check_same_tree(label, dir1, dir2):
+    cmp = filecmp.dircmp(dir1, dir2, ignore=[bbs.ingest.push_manifest_file])
+    def diffs(cmp):
+        d = cmp.left_only + cmp.right_only + cmp.diff_files + cmp.funny_files
+        for sub in cmp.subdirs.values():
+            d += diffs(sub)
+        return d
+    d = diffs(cmp)
+    if len(d) != 0:
+        sys.exit('%s: FAILED (differences: %s)' % (label, ', '.join(d)))
+    print('%s: OK' % label)
+
+def _make_src(src_dir):
+    _write(os.path.join(src_dir, 'pkg.Rcheck', '00check.log'),
+           b'* checking ...\n' * 1000)
+    _write(os.path.join(src_dir, 'pkg.Rcheck', 'tests', 'testthat.Rout'),
+           os.urandom(5 * bbs.ingest.chunk_size // 2))
+    os.link(os.path.join(src_dir, 'pkg.Rcheck', '00check.log'),
+            os.path.join(src_dir, 'pkg.Rcheck', 'tests', '00check.log'))
+    os.symlink('../00check.log',
+               os.path.join(src_dir, 'pkg.Rcheck', 'tests', 'link.log'))
+    _write(os.path.join(src_dir, 'pkg_1.0.tar.gz'),
+           gzip.compress(os.urandom(100000)))
+    _write(os.path.join(src_dir, 'pkg.checksrc-out.txt'), b'OK\n')
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp()
+    root = os.path.join(tmp_dir, 'root')
+    src_dir = os.path.join(tmp_dir, 'src')
+    _make_src(src_dir)
+    server = bbs.ingest.start_local_server(root)
+    paths = [os.path.join(src_dir, name) for name in sorted(os.listdir(src_dir))]
+
+    ## The package tarball is stored as-is, the rest is gzipped.
+    bundles = bbs.ingest.make_bundles(paths, 'node1')
+    modes = sorted((tuple(os.path.basename(p) for p in b.paths),
+                    bbs.ingest._is_compressed(b.paths[0])) for b in bundles)
+    if modes != [(('pkg.Rcheck', 'pkg.checksrc-out.txt'), False),
+                 (('pkg_1.0.tar.gz',), True)]:
+        sys.exit('make_bundles: FAILED (%s)' % modes)
+    for bundle in bundles:
+        bundle.close()
+    print('make_bundles: OK')
+
+    ## Pipelined Mput() calls thru an IngestRemoteDir, then flush.
+    rdir = bbs.rdir.IngestRemoteDir('central', None, os.path.join(root, 'node1'),
+                                    ingest_root=root, ingest_port=server.port)
+    for path in paths:
+        rdir.Mput([path])
+    ## bbs.rdir imports the ingest module as 'ingest', not 'bbs.ingest'.
+    client = bbs.rdir.ingest.get_client(None, server.port)
+    if len(client.pending) == 0:
+        sys.exit('pipelining: FAILED (all bundles were already acknowledged)')
+    bbs.rdir.flush_ingest_channels()
+    if len(client.pending) != 0:
+        sys.exit('flush: FAILED (%d bundles pending)' % len(client.pending))
+    _check_same_tree('Mput', src_dir, os.path.join(root, 'node1'))
+    tests_dir = os.path.join(root, 'node1', 'pkg.Rcheck', 'tests')
+    if not os.path.samefile(os.path.join(tests_dir, '00check.log'),
+                            os.path.join(tests_dir, '..', '00check.log')):
+        sys.exit('hard link: FAILED')
+    if os.readlink(os.path.join(tests_dir, 'link.log')) != '../00check.log':
+        sys.exit('symlink: FAILED')
+    print('links: OK')
+
+    ## A hard link pointing outside the destination is rejected.
+    evil = os.path.join(tmp_dir, 'evil.tar')
+    with tarfile.open(evil, 'w') as tar:
+        info = tarfile.TarInfo('a/b')
+        info.type = tarfile.LNKTYPE
+        info.linkname = '../outside'
+        tar.addfile(info)
+    try:
+        bbs.ingest.unpack_bundle(evil, os.path.join(root, 'evil'))
+        sys.exit('unsafe hard link: FAILED (not rejected)')
+    except bbs.ingest.IngestError:
+        print('unsafe hard link: OK')
+
+    ## Connection dropped in the middle of a frame: the server must keep
+    ## serving, and the client must resume the bundle.
+    bundle = bbs.ingest.Bundle(paths, 'node2')
+    sock = socket.create_connection(('127.0.0.1', server.port))
+    frame = bbs.ingest._pack_frame(bbs.ingest.CHUNK,
+                {'id': bundle.id, 'dest': bundle.dest, 'size': bundle.size,
+                 'offset': 0}, bundle.read(0, bbs.ingest.chunk_size))
+    sock.sendall(frame)  # first chunk
+    sock.sendall(frame[0:len(frame) // 2])  # half of a frame
+    sock.close()
+    client = bbs.ingest.IngestClient('127.0.0.1', server.port)
+    client.connect()
+    for i in range(50):  # the server may still be reading the 1st chunk
+        offset = client._query_offset(bundle.id)
+        if offset != 0:
+            break
+        time.sleep(0.1)
+    if offset != bbs.ingest.chunk_size:
+        sys.exit('mid-frame drop: FAILED (server has %d bytes)' % offset)
+    client.pending[bundle.id] = bundle
+    client.close()
+    nbytes = client.send_bundles([], nb_attempts=2, sleeptime=0)
+    if nbytes != bundle.size - offset or len(client.take_failed()) != 0:
+        sys.exit('resume: FAILED (%d bytes sent)' % nbytes)
+    client.close()
+    _check_same_tree('resume', src_dir, os.path.join(root, 'node2'))
+
+    ## Push: a 2nd push with no changes sends nothing, then only what
+    ## changed is sent.
+    client = bbs.ingest.get_client(None, server.port)
+    bbs.ingest.push_dir(client, src_dir, 'node3')
+    _check_same_tree('push', src_dir, os.path.join(root, 'node3'))
+    if bbs.ingest.push_dir(client, src_dir, 'node3') != 0:
+        sys.exit('push (no change): FAILED')
+    _write(os.path.join(src_dir, 'pkg.buildbin-out.txt'), b'OK\n')
+    nbytes = bbs.ingest.push_dir(client, src_dir, 'node3')
+    if nbytes == 0 or nbytes > 10000:
+        sys.exit('push (1 new file): FAILED (%d bytes sent)' % nbytes)
+    _check_same_tree('push (1 new file)', src_dir,
+                     os.path.join(root, 'node3'))
+
+    for client in bbs.ingest.get_clients() + bbs.rdir.ingest.get_clients():
+        client.close()
+    server.stop()
+    print('OK')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+##############################################################################
+###
+### Test the store of installed R packages (bbs/pkgstore.py): the keys, and
+### adding, materializing, and evicting entries.
+###
+### Usage:
+###   python3 test/python/test_pkgstore.py
+###
+
+import sys
+import os
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import bbs.pkgstore
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+def _check(label, got, expected):
+    if got != expected:
+        sys.exit('%s: FAILED (got %r, expected %r)' % (label, got, expected))
+
+### A fake installed package.
+def _make_pkg(lib_path, pkg, version, size=1000):
+    pkg_path = os.path.join(lib_path, pkg)
+    _write(os.path.join(pkg_path, 'DESCRIPTION'),
+           'Package: %s\nVersion: %s\n' % (pkg, version))
+    _write(os.path.join(pkg_path, 'R', pkg), 'x' * size)
+    return pkg_path
+
+def _check_keys(tmp_dir):
+    make_key = bbs.pkgstore.make_key
+    R_sig = 'R 4.4.1; x86_64-pc-linux-gnu; r86474; 0123456789abcdef'
+    key = make_key('pkgA', '1.0-1', R_sig, {'pkgB': '2.0', 'methods': None})
+    _check('key (same version)',
+           make_key('pkgA', '1.0.1', R_sig, {'methods': None, 'pkgB': '2-0'}),
+           key)
+    for label, other_key in [
+        ('key (version)', make_key('pkgA', '1.0.2', R_sig, {'pkgB': '2.0'})),
+        ('key (R)', make_key('pkgA', '1.0.1', R_sig.replace('r86474', 'r86475'),
+                             {'pkgB': '2.0', 'methods': None})),
+        ('key (dep version)', make_key('pkgA', '1.0.1', R_sig,
+                                       {'pkgB': '2.1', 'methods': None})),
+        ('key (git_last_commit)', make_key('pkgA', '1.0.1', R_sig,
+                                           {'pkgB': '2.0', 'methods': None},
+                                           'abc1234'))]:
+        if other_key == key:
+            sys.exit('%s: FAILED (same key)' % label)
+
+    ## The R signature changes with the svn revision of R and the content of
+    ## the makefiles.
+    r_home = os.path.join(tmp_dir, 'R')
+    Rversion_h = os.path.join(r_home, 'include', 'Rversion.h')
+    _write(Rversion_h, '#define R_VERSION 263169\n'
+                       '#define R_SVN_REVISION 86474\n')
+    Makeconf = os.path.join(r_home, 'etc', 'Makeconf')
+    Makevars = os.path.join(tmp_dir, 'Makevars')
+    _write(Makeconf, 'CC = gcc\n')
+    Built = 'R 4.4.1; x86_64-pc-linux-gnu; 2024-06-14 08:20:40 UTC; unix'
+    sig = bbs.pkgstore.get_R_signature(r_home, Built, [Makeconf, Makevars])
+    if not sig.startswith('R 4.4.1; x86_64-pc-linux-gnu; r86474; '):
+        sys.exit('R signature: FAILED (%r)' % sig)
+    _write(Makevars, 'CFLAGS = -O3\n')
+    sig2 = bbs.pkgstore.get_R_signature(r_home, Built, [Makeconf, Makevars])
+    _write(Rversion_h, '#define R_SVN_REVISION 86475\n')
+    sig3 = bbs.pkgstore.get_R_signature(r_home, Built, [Makeconf, Makevars])
+    if len(set([sig, sig2, sig3])) != 3:
+        sys.exit('R signature: FAILED (%r, %r, %r)' % (sig, sig2, sig3))
+    print('keys: OK')
+
+def _check_add_and_materialize(store, lib_path):
+    pkg_path = _make_pkg(os.path.join(lib_path, 'src'), 'pkgA', '1.0')
+    key = bbs.pkgstore.make_key('pkgA', '1.0', 'R', {})
+    _check('has (before add)', store.has(key), False)
+    _check('materialize (no entry)',
+           store.materialize(key, 'pkgA', lib_path), False)
+    _check('add', store.add(key, 'pkgA', pkg_path), True)
+    _check('add (again)', store.add(key, 'pkgA', pkg_path), False)
+    _check('has', store.has(key), True)
+    _check('tmp dir', os.listdir(os.path.join(store.path, 'tmp')), [])
+
+    ## An existing installation of the package is replaced.
+    _make_pkg(lib_path, 'pkgA', '0.9')
+    _check('materialize', store.materialize(key, 'pkgA', lib_path), True)
+    _check('materialized DESCRIPTION',
+           _read(os.path.join(lib_path, 'pkgA', 'DESCRIPTION')),
+           'Package: pkgA\nVersion: 1.0\n')
+    _check('lib content', sorted(os.listdir(lib_path)), ['pkgA', 'src'])
+    ## With hardlinks, the materialized files are the files of the entry.
+    entry_file = os.path.join(store._entry_path(key), 'pkgA', 'DESCRIPTION')
+    _check('hardlinks',
+           os.path.samefile(entry_file,
+                            os.path.join(lib_path, 'pkgA', 'DESCRIPTION')),
+           True)
+    print('add and materialize: OK')
+
+def _check_evict(store, lib_path):
+    keys = []
+    for i in range(4):
+        pkg = 'pkg%d' % i
+        pkg_path = _make_pkg(os.path.join(lib_path, 'src'), pkg, '1.0', 10000)
+        key = bbs.pkgstore.make_key(pkg, '1.0', 'R', {})
+        store.add(key, pkg, pkg_path)
+        keys.append(key)
+    entry_size = store.size() // 5  # pkgA + pkg0..pkg3
+    ## Use pkg0 so pkgA and pkg1 are now the least recently used entries.
+    ## The mtimes must differ.
+    time.sleep(0.05)
+    store.materialize(keys[0], 'pkg0', lib_path)
+    _check('evict', store.evict(3 * entry_size + entry_size // 2), 2)
+    _check('evicted entries',
+           [store.has(key) for key in keys], [True, False, True, True])
+    _check('evict (nothing to evict)', store.evict(), 0)
+    _check('evict (everything)', store.evict(0), 3)
+    _check('size', store.size(), 0)
+    _check('tmp dir', os.listdir(os.path.join(store.path, 'tmp')), [])
+    print('evict: OK')
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp()
+    _check_keys(tmp_dir)
+    store = bbs.pkgstore.PkgStore(os.path.join(tmp_dir, 'store'), 10**9)
+    lib_path = os.path.join(tmp_dir, 'lib')
+    _check_add_and_materialize(store, lib_path)
+    _check_evict(store, lib_path)
+    print('OK')
@@ -7,3 +7,11 @@ rm -rf "$BBS_R_HOME/library/00LOCK"
 # Note: The trailing / in /tmp/ is required on Mac OS X!
 find /tmp/ -depth -user $USER -mtime +1 -exec rm -rfv {} \; 2>/dev/null
 
+# Remove the private temporary dirs left behind by the jobs of an interrupted
+# run (see bbs.jobs.JobTmpDirs).
+if [ -n "$BBS_JOB_TMPDIR_ROOT" ]; then
+    rm -rf "$BBS_JOB_TMPDIR_ROOT"/*
+fi
+if [ -n "$BBS_JOB_TMPDIR_SPILL_ROOT" ]; then
+    rm -rf "$BBS_JOB_TMPDIR_SPILL_ROOT"/*
+fi